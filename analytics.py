@@ -0,0 +1,388 @@
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+from sqlalchemy import case, event, func, inspect, select, type_coerce
+from app import db
+from app import Customer, Invoice, InvoiceDailyRollup
+from money import ZERO, to_decimal
+from stats import OPEN_STATUSES, previous_value, upsert_insert
+
+PAID_STATUS = 'Paid'
+CANCELLED_STATUS = 'Cancelled'
+
+# Figures kept per (user, customer, day) in invoice_daily_rollups
+ROLLUP_COLUMNS = (
+    'issued_count', 'issued_amount',
+    'paid_count', 'paid_amount', 'days_to_pay_total',
+    'open_count', 'open_amount',
+)
+
+# Attributes of an invoice that move its figures between rollup rows
+TRACKED_FIELDS = ('user_id', 'customer_id', 'status', 'date_issued', 'date_due', 'paid_at', 'total')
+
+# (label, min days past due, max days past due), None leaves a side open
+AGING_BUCKETS = (
+    ('not_due', None, -1),
+    ('0-30', 0, 30),
+    ('31-60', 31, 60),
+    ('61-90', 61, 90),
+    ('90+', 91, None),
+)
+
+@dataclass(frozen=True)
+class MonthlyRevenue:
+    """Invoiced and collected amounts of one calendar month"""
+    month: str
+    invoiced: Decimal
+    revenue: Decimal
+    paid_count: int
+
+@dataclass(frozen=True)
+class CustomerRevenue:
+    """Amount collected from one customer"""
+    customer_id: int
+    name: str
+    revenue: Decimal
+    paid_count: int
+
+@dataclass(frozen=True)
+class AgingBucket:
+    """Open invoices whose due date is a given number of days in the past"""
+    label: str
+    count: int
+    amount: Decimal
+
+@dataclass(frozen=True)
+class DaysToPay:
+    """Average number of days between issue and payment"""
+    average: Decimal
+    paid_count: int
+
+# Incremental maintenance
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+def _add_contribution(deltas, sign, user_id, customer_id, status, date_issued, date_due, paid_at, total):
+    """Adds (sign=1) or removes (sign=-1) the figures of one invoice state"""
+    if user_id is None or customer_id is None:
+        return
+    status = status or 'Unpaid'
+    amount = sign * (to_decimal(total) if total else ZERO)
+
+    def add(day, **values):
+        delta = deltas.setdefault((user_id, customer_id, _as_date(day)), dict.fromkeys(ROLLUP_COLUMNS, 0))
+        for name, value in values.items():
+            delta[name] += value
+
+    if status != CANCELLED_STATUS and date_issued is not None:
+        add(date_issued, issued_count=sign, issued_amount=amount)
+    if status == PAID_STATUS and paid_at is not None:
+        days = (_as_date(paid_at) - _as_date(date_issued)).days if date_issued is not None else 0
+        add(paid_at, paid_count=sign, paid_amount=amount, days_to_pay_total=sign * max(days, 0))
+    if status in OPEN_STATUSES and date_due is not None:
+        add(date_due, open_count=sign, open_amount=amount)
+
+def add_invoice(deltas, sign, values):
+    """
+    Adds the rollup figures of an invoice to a deltas dict
+
+    Args:
+        deltas: Dict of (user_id, customer_id, day) -> {column: delta}
+        sign: 1 to add the invoice, -1 to remove it
+        values: Invoice object, row or dict with the TRACKED_FIELDS
+    """
+    get = values.get if isinstance(values, dict) else lambda name: getattr(values, name)
+    _add_contribution(deltas, sign, *(get(name) for name in TRACKED_FIELDS))
+
+def apply_rollup_deltas(connection, deltas):
+    """
+    Adds figure deltas to invoice_daily_rollups in the current transaction
+
+    Args:
+        connection: Connection bound to the transaction that changed the invoices
+        deltas: Dict of (user_id, customer_id, day) -> {column: delta}
+    """
+    table = InvoiceDailyRollup.__table__
+    insert = upsert_insert(connection)
+
+    for (user_id, customer_id, day), values in deltas.items():
+        if not any(values.values()):
+            continue
+        statement = insert(table).values(user_id=user_id, customer_id=customer_id, day=day, **values)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.user_id, table.c.customer_id, table.c.day],
+            set_={name: table.c[name] + statement.excluded[name] for name in ROLLUP_COLUMNS}
+        )
+        connection.execute(statement)
+
+@event.listens_for(db.session, 'before_flush')
+def _stamp_paid_at(session, flush_context, instances):
+    """Records when an invoice became Paid and forgets it when it stops being Paid"""
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Invoice):
+            continue
+        if obj.status == PAID_STATUS:
+            if obj.paid_at is None:
+                obj.paid_at = datetime.utcnow()
+        elif obj.paid_at is not None:
+            obj.paid_at = None
+
+@event.listens_for(db.session, 'after_flush')
+def _track_rollup_changes(session, flush_context):
+    """Keeps invoice_daily_rollups in step with every flushed invoice change"""
+    deltas = {}
+
+    for obj in session.new:
+        if isinstance(obj, Invoice):
+            add_invoice(deltas, 1, obj)
+
+    for obj in session.deleted:
+        if isinstance(obj, Invoice):
+            state = inspect(obj)
+            add_invoice(deltas, -1, {name: previous_value(state, name) for name in TRACKED_FIELDS})
+
+    for obj in session.dirty:
+        if not isinstance(obj, Invoice) or obj in session.deleted:
+            continue
+        state = inspect(obj)
+        if not any(state.attrs[name].history.has_changes() for name in TRACKED_FIELDS):
+            continue
+        add_invoice(deltas, -1, {name: previous_value(state, name) for name in TRACKED_FIELDS})
+        add_invoice(deltas, 1, obj)
+
+    if deltas:
+        apply_rollup_deltas(session.connection(), deltas)
+
+# Rebuild and verification
+
+def _aggregate_invoices(user_id=None, connection=None, batch_size=5000):
+    """Recomputes the rollup rows by folding every invoice, like the incremental path does"""
+    query = select(*(getattr(Invoice, name) for name in TRACKED_FIELDS))
+    if user_id is not None:
+        query = query.where(Invoice.user_id == user_id)
+
+    deltas = {}
+    for row in (connection or db.session).execute(query.execution_options(yield_per=batch_size)):
+        add_invoice(deltas, 1, row)
+    return {key: values for key, values in deltas.items() if any(values.values())}
+
+def _stored_rollups(user_id=None, connection=None):
+    table = InvoiceDailyRollup.__table__
+    query = select(table)
+    if user_id is not None:
+        query = query.where(table.c.user_id == user_id)
+    return {
+        (row.user_id, row.customer_id, row.day): {name: row._mapping[name] for name in ROLLUP_COLUMNS}
+        for row in (connection or db.session).execute(query)
+        if any(row._mapping[name] for name in ROLLUP_COLUMNS)
+    }
+
+def verify_rollups(user_id=None, connection=None):
+    """
+    Compares invoice_daily_rollups with a fresh fold of the invoices table
+
+    Returns:
+        list: (user_id, customer_id, day) keys whose stored figures are wrong
+    """
+    actual = _aggregate_invoices(user_id, connection)
+    stored = _stored_rollups(user_id, connection)
+    empty = dict.fromkeys(ROLLUP_COLUMNS, 0)
+    return sorted(
+        key for key in set(actual) | set(stored)
+        if actual.get(key, empty) != stored.get(key, empty)
+    )
+
+def rebuild_rollups(user_id=None, connection=None):
+    """
+    Recomputes invoice_daily_rollups from scratch
+
+    Args:
+        user_id: Restrict the rebuild to one user (all users when None)
+        connection: Connection whose transaction the caller commits; the
+            session is used and committed when None
+
+    Returns:
+        int: Number of rollup rows written
+    """
+    executor = connection or db.session
+    table = InvoiceDailyRollup.__table__
+    rows = [
+        dict(values, user_id=key[0], customer_id=key[1], day=key[2])
+        for key, values in _aggregate_invoices(user_id, connection).items()
+    ]
+
+    delete_query = table.delete()
+    if user_id is not None:
+        delete_query = delete_query.where(table.c.user_id == user_id)
+    executor.execute(delete_query)
+    if rows:
+        executor.execute(table.insert(), rows)
+
+    if connection is None:
+        db.session.commit()
+    return len(rows)
+
+# Reports, all read from invoice_daily_rollups
+
+def _month(column):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return func.to_char(column, 'YYYY-MM')
+    return func.strftime('%Y-%m', column)
+
+def _months(date_from, date_to):
+    """Yields every YYYY-MM from date_from to date_to"""
+    year, month = date_from.year, date_from.month
+    while (year, month) <= (date_to.year, date_to.month):
+        yield f"{year:04d}-{month:02d}"
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+def _in_range(query, user_id, date_from, date_to):
+    return query.where(
+        InvoiceDailyRollup.user_id == user_id,
+        InvoiceDailyRollup.day >= date_from,
+        InvoiceDailyRollup.day <= date_to
+    )
+
+def monthly_revenue(user_id, date_from, date_to):
+    """
+    Returns invoiced and collected amounts per month, months without activity included
+
+    Invoiced counts invoices by issue date (cancelled ones excluded),
+    revenue counts paid invoices by payment date.
+    """
+    month = _month(InvoiceDailyRollup.day).label('month')
+    query = _in_range(
+        select(
+            month,
+            func.sum(InvoiceDailyRollup.issued_amount),
+            func.sum(InvoiceDailyRollup.paid_amount),
+            func.sum(InvoiceDailyRollup.paid_count)
+        ),
+        user_id, date_from, date_to
+    ).group_by(month)
+
+    found = {row[0]: row for row in db.session.execute(query)}
+    return [
+        MonthlyRevenue(
+            month=label,
+            invoiced=found[label][1] if label in found else ZERO,
+            revenue=found[label][2] if label in found else ZERO,
+            paid_count=int(found[label][3]) if label in found else 0
+        )
+        for label in _months(date_from, date_to)
+    ]
+
+def revenue_by_customer(user_id, date_from, date_to, limit=10):
+    """Returns the customers with the highest collected amount in a period"""
+    revenue = func.sum(InvoiceDailyRollup.paid_amount).label('revenue')
+    totals = _in_range(
+        select(InvoiceDailyRollup.customer_id, revenue, func.sum(InvoiceDailyRollup.paid_count).label('paid_count')),
+        user_id, date_from, date_to
+    ).where(InvoiceDailyRollup.paid_count != 0).group_by(InvoiceDailyRollup.customer_id).subquery()
+
+    query = (
+        select(totals.c.customer_id, Customer.name, totals.c.revenue, totals.c.paid_count)
+        .outerjoin(Customer, Customer.id == totals.c.customer_id)
+        .order_by(totals.c.revenue.desc(), totals.c.customer_id)
+        .limit(limit)
+    )
+    return [
+        CustomerRevenue(customer_id, name, amount, int(count))
+        for customer_id, name, amount, count in db.session.execute(query)
+    ]
+
+def aging_report(user_id, today=None):
+    """
+    Buckets the open (Unpaid and Overdue) invoices by days past their due date
+
+    Returns:
+        list: AgingBucket per AGING_BUCKETS entry, in order
+    """
+    today = today or date.today()
+    day = InvoiceDailyRollup.day
+    columns = []
+    for label, min_days, max_days in AGING_BUCKETS:
+        conditions = []
+        if min_days is not None:
+            conditions.append(day <= today - timedelta(days=min_days))
+        if max_days is not None:
+            conditions.append(day >= today - timedelta(days=max_days))
+        in_bucket = conditions[0] if len(conditions) == 1 else conditions[0] & conditions[1]
+        columns.append(func.sum(case((in_bucket, InvoiceDailyRollup.open_count), else_=0)))
+        columns.append(type_coerce(
+            func.sum(case((in_bucket, InvoiceDailyRollup.open_amount), else_=0)),
+            InvoiceDailyRollup.open_amount.type
+        ))
+
+    row = db.session.execute(
+        select(*columns).where(InvoiceDailyRollup.user_id == user_id, InvoiceDailyRollup.open_count != 0)
+    ).one()
+    return [
+        AgingBucket(label, int(row[2 * index] or 0), row[2 * index + 1] or ZERO)
+        for index, (label, _, _) in enumerate(AGING_BUCKETS)
+    ]
+
+def days_to_pay(user_id, date_from, date_to):
+    """Returns the average days from issue to payment of invoices paid in a period"""
+    total_days, paid_count = db.session.execute(_in_range(
+        select(func.sum(InvoiceDailyRollup.days_to_pay_total), func.sum(InvoiceDailyRollup.paid_count)),
+        user_id, date_from, date_to
+    )).one()
+    paid_count = int(paid_count or 0)
+    if not paid_count:
+        return DaysToPay(ZERO, 0)
+    average = (Decimal(int(total_days or 0)) / paid_count).quantize(Decimal('0.1'), rounding=ROUND_HALF_UP)
+    return DaysToPay(average, paid_count)
+
+class ReportError(ValueError):
+    """Raised when a report name or its parameters cannot be used"""
+
+REPORTS = ('monthly-revenue', 'revenue-by-customer', 'aging', 'days-to-pay')
+
+# Months covered by a report when no date_from is given, the current one included
+DEFAULT_REPORT_MONTHS = 12
+
+def _parse_date(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ReportError(f"Invalid value for {name}: {value}")
+
+def report_period(args, today=None):
+    """
+    Reads date_from and date_to from request arguments
+
+    Returns:
+        tuple: (date_from, date_to), the last DEFAULT_REPORT_MONTHS months by default
+    """
+    today = today or date.today()
+    date_to = _parse_date(args, 'date_to') or today
+    date_from = _parse_date(args, 'date_from')
+    if date_from is None:
+        month_index = date_to.year * 12 + date_to.month - DEFAULT_REPORT_MONTHS
+        date_from = date(month_index // 12, month_index % 12 + 1, 1)
+    if date_from > date_to:
+        raise ReportError('date_from must not be after date_to')
+    return date_from, date_to
+
+def run_report(name, user_id, date_from, date_to, today=None):
+    """
+    Computes one of the REPORTS for a user
+
+    Returns:
+        list: MonthlyRevenue, CustomerRevenue or AgingBucket rows, or a
+        single DaysToPay for 'days-to-pay'
+    """
+    if name == 'monthly-revenue':
+        return monthly_revenue(user_id, date_from, date_to)
+    if name == 'revenue-by-customer':
+        return revenue_by_customer(user_id, date_from, date_to)
+    if name == 'aging':
+        return aging_report(user_id, today)
+    if name == 'days-to-pay':
+        return days_to_pay(user_id, date_from, date_to)
+    raise ReportError(f"Unknown report: {name}")
@@ -8,8 +8,8 @@ from flask_login import LoginManager
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_mail import Mail
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging, DEBUG logs every request and is costly under load
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 
 # Define base model class
 class Base(DeclarativeBase):
@@ -19,6 +19,8 @@ class Base(DeclarativeBase):
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "invoicemanagersecretkey")
 app.config['WTF_CSRF_ENABLED'] = True
+app.config['ITEMS_PER_PAGE'] = int(os.environ.get('ITEMS_PER_PAGE', 25))
+app.config['MAX_ITEMS_PER_PAGE'] = int(os.environ.get('MAX_ITEMS_PER_PAGE', 100))
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # Context processor
@@ -34,13 +36,86 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
 }
 
+# Invoice numbering: {period} is the date formatted with INVOICE_NUMBER_PERIOD,
+# {number} the per-user sequence zero padded to INVOICE_NUMBER_WIDTH digits
+app.config['INVOICE_NUMBER_FORMAT'] = os.environ.get('INVOICE_NUMBER_FORMAT', 'INV-{period}-{number}')
+app.config['INVOICE_NUMBER_PERIOD'] = os.environ.get('INVOICE_NUMBER_PERIOD', '%Y%m')
+app.config['INVOICE_NUMBER_WIDTH'] = int(os.environ.get('INVOICE_NUMBER_WIDTH', 3))
+
 # Email configuration
 app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
 app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
-app.config['MAIL_USE_TLS'] = True
+app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', 'true').lower() == 'true'
 app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER')
+app.config['MAIL_MAX_EMAILS'] = int(os.environ.get('MAIL_MAX_EMAILS', 100))
+
+# Outbound mail queue
+app.config['MAIL_QUEUE_BATCH_SIZE'] = int(os.environ.get('MAIL_QUEUE_BATCH_SIZE', 50))
+app.config['MAIL_QUEUE_MAX_ATTEMPTS'] = int(os.environ.get('MAIL_QUEUE_MAX_ATTEMPTS', 5))
+app.config['MAIL_QUEUE_RETRY_DELAY'] = int(os.environ.get('MAIL_QUEUE_RETRY_DELAY', 60))
+app.config['MAIL_QUEUE_SEND_TIMEOUT'] = int(os.environ.get('MAIL_QUEUE_SEND_TIMEOUT', 600))
+app.config['MAIL_CONNECTION_IDLE_TIMEOUT'] = int(os.environ.get('MAIL_CONNECTION_IDLE_TIMEOUT', 30))
+app.config['MAIL_CAMPAIGN_CONNECTIONS'] = int(os.environ.get('MAIL_CAMPAIGN_CONNECTIONS', 2))
+app.config['MAIL_WORKER_THREAD'] = os.environ.get('MAIL_WORKER_THREAD', 'false').lower() == 'true'
+
+# Seconds between in-process overdue sweeps, 0 leaves it to `flask sweep-overdue`
+app.config['OVERDUE_SWEEP_INTERVAL'] = int(os.environ.get('OVERDUE_SWEEP_INTERVAL', 0))
+
+# Seconds between in-process recurring invoice runs, 0 leaves it to `flask recurring run`
+app.config['RECURRING_INVOICE_INTERVAL'] = int(os.environ.get('RECURRING_INVOICE_INTERVAL', 0))
+
+# PDF rendering worker pool
+app.config['PDF_WORKER_PROCESSES'] = int(os.environ.get('PDF_WORKER_PROCESSES', os.cpu_count() or 1))
+app.config['PDF_JOB_TIMEOUT'] = int(os.environ.get('PDF_JOB_TIMEOUT', 300))
+app.config['PDF_JOB_MAX_ATTEMPTS'] = int(os.environ.get('PDF_JOB_MAX_ATTEMPTS', 3))
+app.config['BULK_EXPORT_PROCESSES'] = int(os.environ.get('BULK_EXPORT_PROCESSES', app.config['PDF_WORKER_PROCESSES']))
+
+# Rendered PDF cache
+app.config['PDF_CACHE_DIR'] = os.environ.get('PDF_CACHE_DIR', os.path.join(app.instance_path, 'pdf_cache'))
+app.config['PDF_CACHE_MAX_BYTES'] = int(os.environ.get('PDF_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+app.config['PDF_TEMPLATE_VERSION'] = os.environ.get('PDF_TEMPLATE_VERSION', '1')
+
+# Warm PDF renderer: a stylesheet compiled once per render thread (skipped
+# when the file does not exist) and the local logo copies written by
+# `flask pdf-logos sync`; renders never fetch images over the network
+app.config['PDF_STYLESHEET'] = os.environ.get('PDF_STYLESHEET', os.path.join(app.root_path, 'static', 'css', 'invoice_pdf.css'))
+app.config['PDF_LOGO_DIR'] = os.environ.get('PDF_LOGO_DIR', os.path.join(app.instance_path, 'pdf_logos'))
+
+# Logged in user identity cache: 'sqlite' (shared by the workers of a host
+# through USER_CACHE_PATH), 'memory' (per process LRU, only for a single
+# process: other workers would keep a changed password or profile until
+# USER_CACHE_TTL runs out) or 'none'
+app.config['USER_CACHE_BACKEND'] = os.environ.get('USER_CACHE_BACKEND', 'sqlite')
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_PATH'] = os.environ.get('USER_CACHE_PATH', os.path.join(app.instance_path, 'user_cache.sqlite3'))
+
+# Request instrumentation: per-route timings exposed for Prometheus at
+# INSTRUMENTATION_METRICS_PATH and as Server-Timing headers. Requests slower
+# than PROFILE_SLOW_REQUEST_MS (0 disables the sampler) write stack samples
+# taken every PROFILE_SAMPLE_INTERVAL_MS to PROFILE_DIR
+app.config['INSTRUMENTATION_ENABLED'] = os.environ.get('INSTRUMENTATION_ENABLED', 'false').lower() == 'true'
+app.config['INSTRUMENTATION_METRICS_PATH'] = os.environ.get('INSTRUMENTATION_METRICS_PATH', '/metrics')
+# The metrics are only served to a request with the bearer token
+# INSTRUMENTATION_METRICS_TOKEN or coming from an address or network listed in
+# INSTRUMENTATION_METRICS_ALLOW (comma separated); with neither set nobody gets them
+app.config['INSTRUMENTATION_METRICS_TOKEN'] = os.environ.get('INSTRUMENTATION_METRICS_TOKEN')
+app.config['INSTRUMENTATION_METRICS_ALLOW'] = os.environ.get('INSTRUMENTATION_METRICS_ALLOW', '')
+app.config['INSTRUMENTATION_SERVER_TIMING'] = os.environ.get('INSTRUMENTATION_SERVER_TIMING', 'true').lower() == 'true'
+app.config['PROFILE_SLOW_REQUEST_MS'] = int(os.environ.get('PROFILE_SLOW_REQUEST_MS', 0))
+app.config['PROFILE_SAMPLE_INTERVAL_MS'] = int(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', 5))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+
+# Rendered page cache for the dashboard, invoice, customer and profile pages:
+# 'memory', 'sqlite' or 'none' like the identity cache. Entries are keyed by
+# the user's data version, so a write makes them unreachable instead of
+# having to find and delete them
+app.config['PAGE_CACHE_BACKEND'] = os.environ.get('PAGE_CACHE_BACKEND', 'memory')
+app.config['PAGE_CACHE_TTL'] = int(os.environ.get('PAGE_CACHE_TTL', 300))
+app.config['PAGE_CACHE_SIZE'] = int(os.environ.get('PAGE_CACHE_SIZE', 256))
+app.config['PAGE_CACHE_PATH'] = os.environ.get('PAGE_CACHE_PATH', os.path.join(app.instance_path, 'page_cache.sqlite3'))
 
 # Initialize extensions
 db = SQLAlchemy(app, model_class=Base)
@@ -56,15 +131,53 @@ User = models_dict['User']
 Customer = models_dict['Customer']
 Invoice = models_dict['Invoice']
 InvoiceItem = models_dict['InvoiceItem']
+UserInvoiceStats = models_dict['UserInvoiceStats']
+PdfJob = models_dict['PdfJob']
+OutboundEmail = models_dict['OutboundEmail']
+EmailCampaign = models_dict['EmailCampaign']
+StatusSweep = models_dict['StatusSweep']
+InvoiceStatusChange = models_dict['InvoiceStatusChange']
+InvoiceSequence = models_dict['InvoiceSequence']
+InvoiceDailyRollup = models_dict['InvoiceDailyRollup']
+UserDataVersion = models_dict['UserDataVersion']
+SearchDocument = models_dict['SearchDocument']
+RecurringInvoice = models_dict['RecurringInvoice']
+RecurringInvoiceItem = models_dict['RecurringInvoiceItem']
+
+import user_cache
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.load_user(user_id)
+
+# Registers the SQLite casefold() function before the first connection, the
+# customer name index needs it
+import customer_lookup
 
-# Create database tables
+# Create or upgrade database tables
+import migrations
 with app.app_context():
-    db.create_all()
-    logging.info("Database tables created")
+    migrations.upgrade()
 
 # Import routes after models are initialized
-import routes
\ No newline at end of file
+import routes
+import commands
+
+if app.config['INSTRUMENTATION_ENABLED']:
+    import instrumentation
+    instrumentation.init_app(app)
+
+# Optionally deliver queued mail from this process instead of a separate worker
+if app.config['MAIL_WORKER_THREAD']:
+    import mail_queue
+    mail_queue.start_worker_thread()
+
+# Optionally mark past-due invoices as Overdue on a schedule
+if app.config['OVERDUE_SWEEP_INTERVAL'] > 0:
+    import overdue
+    overdue.start_scheduler(app.config['OVERDUE_SWEEP_INTERVAL'])
+
+# Optionally issue due recurring invoices on a schedule
+if app.config['RECURRING_INVOICE_INTERVAL'] > 0:
+    import recurring
+    recurring.start_scheduler(app.config['RECURRING_INVOICE_INTERVAL'])
\ No newline at end of file
@@ -0,0 +1,13 @@
+"""
+Reproducible benchmarks of the busiest routes
+
+generator.py builds seeded data sets at fixed scales, scenarios.py drives
+the routes through the Flask test client and reports latency percentiles
+and query counts as JSON. Run them with `flask benchmark run`; pdf.py
+compares cold and warm PDF renders (`flask benchmark pdf`) and campaign.py
+one-by-one reminders with a campaign (`flask benchmark campaign`).
+"""
+from benchmarks.generator import SCALES, generate_dataset
+from benchmarks.scenarios import SCENARIOS, compare_results, run_benchmark
+from benchmarks.pdf import run_pdf_benchmark
+from benchmarks.campaign import run_campaign_benchmark
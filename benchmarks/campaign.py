@@ -0,0 +1,160 @@
+import os
+import platform
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from sqlalchemy import select, update
+from app import app, db, mail
+from app import Invoice, OutboundEmail, User
+from benchmarks.generator import Scale, _generate_user
+from benchmarks.scenarios import _git_commit
+import analytics
+import campaigns
+import mail_queue
+import scratch
+import stats
+
+class _CountingHandler:
+    """aiosmtpd handler that only counts the messages it accepts"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        with self.lock:
+            self.received += 1
+        return '250 Message accepted'
+
+def _free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def _seed_reminder_user(invoice_count, seed):
+    """Creates a throwaway user whose invoices are all overdue, so every one gets a reminder"""
+    scale = Scale(users=1, customers_per_user=max(1, invoice_count // 10), invoices_per_user=invoice_count, items_per_invoice=3)
+    user_id = _generate_user(random.Random(seed), scale, scratch.scratch_username('bench-campaign'), date.today())
+    db.session.execute(
+        update(Invoice)
+        .where(Invoice.user_id == user_id)
+        .values(status='Overdue', date_due=date.today() - timedelta(days=7), paid_at=None)
+    )
+    db.session.commit()
+    stats.rebuild_invoice_stats(user_id)
+    analytics.rebuild_rollups(user_id)
+    return user_id
+
+def _reset_delivery(user_id):
+    """Empties the user's mail queue so the next mode starts from the same state"""
+    db.session.execute(OutboundEmail.__table__.delete().where(OutboundEmail.user_id == user_id))
+    db.session.execute(update(Invoice).where(Invoice.user_id == user_id).values(email_status=None, emailed_at=None))
+    db.session.commit()
+
+def _send_one_by_one(user_id):
+    """Posts /invoice/<id>/send for every invoice, then lets the mail worker drain the queue"""
+    with app.app_context():
+        invoice_ids = db.session.scalars(select(Invoice.id).where(Invoice.user_id == user_id).order_by(Invoice.id)).all()
+    client = scratch.logged_in_client(user_id)
+    for invoice_id in invoice_ids:
+        with app.app_context():
+            client.post(f'/invoice/{invoice_id}/send')
+    return mail_queue.run_worker(once=True)
+
+def _send_campaign(user_id, processes, connections):
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        campaign = campaigns.create_campaign(user_id, list(campaigns.DEFAULT_STATUSES), date.today(), user.business_name)
+        campaign_id = campaign.id
+    progress = campaigns.run_campaign(campaign_id, processes=processes, connections=connections)
+    return progress.get(mail_queue.SENT, 0)
+
+def run_campaign_benchmark(invoices=1000, seed=0, processes=None, connections=None):
+    """
+    Compares sending reminders one invoice at a time with a campaign
+
+    Both modes deliver a reminder for each of `invoices` overdue invoices
+    of a throwaway user to a local aiosmtpd server that accepts and counts
+    the messages. The one-by-one mode posts the send route per invoice and
+    lets mail_queue.run_worker render and send them over one connection,
+    the campaign mode runs campaigns.create_campaign and run_campaign.
+    Each mode starts with an empty PDF cache and is timed until the last
+    message is accepted. Needs the aiosmtpd package and a scratch database.
+
+    Args:
+        invoices: Invoices to remind about
+        seed: Seed of the generated invoices
+        processes: Render processes of the campaign (PDF_WORKER_PROCESSES by default)
+        connections: SMTP connections of the campaign (MAIL_CAMPAIGN_CONNECTIONS by default)
+
+    Returns:
+        dict: JSON serializable results with the duration and throughput of both modes
+
+    Raises:
+        ValueError: If aiosmtpd is not installed
+        scratch.ScratchDatabaseError: If the database has real users
+    """
+    try:
+        from aiosmtpd.controller import Controller
+    except ImportError:
+        raise ValueError('The campaign benchmark needs aiosmtpd, install it with `pip install aiosmtpd`')
+
+    with app.app_context():
+        scratch.require_scratch_database()
+        user_id = _seed_reminder_user(invoices, seed)
+
+    handler = _CountingHandler()
+    port = _free_port()
+    controller = Controller(handler, hostname='127.0.0.1', port=port)
+    pdf_cache_dir = tempfile.mkdtemp(prefix='benchmark-campaign-')
+    saved_mail = app.extensions['mail']
+    modes = {
+        'one_by_one': lambda: _send_one_by_one(user_id),
+        'campaign': lambda: _send_campaign(user_id, processes, connections),
+    }
+    results = {}
+    controller.start()
+    try:
+        with scratch.harness_config(
+            MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_USE_TLS=False, MAIL_USE_SSL=False,
+            MAIL_USERNAME=None, MAIL_PASSWORD=None, MAIL_SUPPRESS_SEND=False,
+            MAIL_DEFAULT_SENDER='benchmark@example.invalid', PDF_CACHE_DIR=pdf_cache_dir
+        ):
+            # Flask-Mail reads its settings once, give it a state for the local server
+            app.extensions['mail'] = mail.init_mail(app.config, app.debug, app.testing)
+            for name, send in modes.items():
+                app.config['PDF_CACHE_DIR'] = os.path.join(pdf_cache_dir, name)
+                with app.app_context():
+                    _reset_delivery(user_id)
+                received = handler.received
+                start = time.perf_counter()
+                sent = send()
+                elapsed = time.perf_counter() - start
+                results[name] = {
+                    'sent': sent,
+                    'received': handler.received - received,
+                    'seconds': round(elapsed, 3),
+                    'messages_per_second': round(sent / elapsed, 1) if elapsed else None,
+                }
+    finally:
+        app.extensions['mail'] = saved_mail
+        controller.stop()
+        shutil.rmtree(pdf_cache_dir, ignore_errors=True)
+        with app.app_context():
+            scratch.delete_user_data(user_id)
+
+    one_by_one, campaign = results['one_by_one']['seconds'], results['campaign']['seconds']
+    return {
+        'invoices': invoices,
+        'seed': seed,
+        'processes': processes or app.config['PDF_WORKER_PROCESSES'],
+        'connections': connections or app.config['MAIL_CAMPAIGN_CONNECTIONS'],
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'modes': results,
+        'speedup': round(one_by_one / campaign, 2) if campaign else None,
+    }
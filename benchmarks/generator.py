@@ -0,0 +1,171 @@
+import random
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from sqlalchemy import func, insert, select
+from app import db
+from app import Customer, Invoice, InvoiceItem, User
+from money import QUANTITY_SCALE, invoice_totals, line_amount, to_decimal
+import analytics
+import numbering
+import scratch
+import search
+import stats
+
+@dataclass(frozen=True)
+class Scale:
+    """Size of a generated data set; items per invoice vary from 1 to 2 * items_per_invoice - 1"""
+    users: int
+    customers_per_user: int
+    invoices_per_user: int
+    items_per_invoice: int
+
+    @property
+    def approximate_items(self):
+        return self.users * self.invoices_per_user * self.items_per_invoice
+
+SCALES = {
+    '1k': Scale(users=1, customers_per_user=20, invoices_per_user=200, items_per_invoice=5),
+    '100k': Scale(users=2, customers_per_user=500, invoices_per_user=10000, items_per_invoice=5),
+    '1m': Scale(users=4, customers_per_user=2500, invoices_per_user=50000, items_per_invoice=5),
+}
+
+# Share of generated invoices per status
+STATUS_WEIGHTS = {'Paid': 60, 'Unpaid': 25, 'Overdue': 10, 'Cancelled': 5}
+TAX_RATES = ('0', '7', '19', '20')
+DESCRIPTIONS = (
+    'Consulting hours', 'Design work', 'Hosting', 'Support contract', 'Travel expenses',
+    'Software licence', 'Training session', 'Maintenance', 'Hardware', 'Project management',
+)
+
+# Days of history the invoice dates are spread over
+HISTORY_DAYS = 730
+
+# Invoices written per INSERT batch
+BATCH_SIZE = 1000
+
+def benchmark_username(scale_name, seed, index):
+    return f"bench-{scale_name}-{seed}-{index}"
+
+def _customer_rows(rng, user_id, count):
+    return [
+        {
+            'name': f"{rng.choice(('Acme', 'Globex', 'Initech', 'Umbrella', 'Hooli', 'Stark'))} {number:05d}",
+            'email': f"billing{number}@customer.example.invalid",
+            'address': f"{rng.randint(1, 999)} Benchmark Street",
+            'user_id': user_id,
+        }
+        for number in range(count)
+    ]
+
+def _invoice_row(rng, scale, user_id, customer_ids, today):
+    issued = today - timedelta(days=rng.randrange(HISTORY_DAYS))
+    due = issued + timedelta(days=rng.choice((14, 30, 60)))
+    status = rng.choices(list(STATUS_WEIGHTS), weights=list(STATUS_WEIGHTS.values()))[0]
+    if status in stats.OPEN_STATUSES:
+        status = 'Overdue' if due < today else 'Unpaid'
+    created = datetime.combine(issued, datetime.min.time()) + timedelta(seconds=rng.randrange(86400))
+
+    items = []
+    for _ in range(rng.randint(1, 2 * scale.items_per_invoice - 1)):
+        quantity = to_decimal(rng.randint(1, 40) / 4, QUANTITY_SCALE)
+        unit_price = to_decimal(rng.randint(500, 250000) / 100)
+        items.append({
+            'description': rng.choice(DESCRIPTIONS),
+            'quantity': quantity,
+            'unit_price': unit_price,
+            'amount': line_amount(quantity, unit_price),
+            'created_at': created,
+        })
+    tax_rate = to_decimal(rng.choice(TAX_RATES))
+    subtotal, tax_amount, total = invoice_totals((item['amount'] for item in items), tax_rate)
+
+    paid_at = None
+    if status == 'Paid':
+        paid_at = created + timedelta(days=rng.randint(0, 90))
+    invoice = {
+        'date_issued': issued,
+        'date_due': due,
+        'status': status,
+        'notes': None,
+        'tax_rate': tax_rate,
+        'subtotal': subtotal,
+        'tax_amount': tax_amount,
+        'total': total,
+        'user_id': user_id,
+        'customer_id': rng.choice(customer_ids),
+        'created_at': created,
+        'updated_at': paid_at or created,
+        'paid_at': paid_at,
+    }
+    return invoice, items
+
+def _generate_user(rng, scale, username, today):
+    user_id = scratch.create_scratch_user(username, business_name=f"Benchmark {username}").id
+    db.session.commit()
+
+    customer_ids = db.session.scalars(
+        insert(Customer).returning(Customer.id, sort_by_parameter_order=True),
+        _customer_rows(rng, user_id, scale.customers_per_user)
+    ).all()
+
+    remaining = scale.invoices_per_user
+    while remaining:
+        batch = [_invoice_row(rng, scale, user_id, customer_ids, today) for _ in range(min(BATCH_SIZE, remaining))]
+        for (invoice, _), number in zip(batch, numbering.reserve_block(user_id, len(batch))):
+            invoice['invoice_number'] = number
+        invoice_ids = db.session.scalars(
+            insert(Invoice).returning(Invoice.id, sort_by_parameter_order=True),
+            [invoice for invoice, _ in batch]
+        ).all()
+        db.session.execute(insert(InvoiceItem), [
+            dict(item, invoice_id=invoice_id)
+            for invoice_id, (_, items) in zip(invoice_ids, batch)
+            for item in items
+        ])
+        db.session.commit()
+        remaining -= len(batch)
+
+    # The bulk inserts bypass the flush listeners, derive the summary tables once
+    stats.rebuild_invoice_stats(user_id)
+    analytics.rebuild_rollups(user_id)
+    search.rebuild_index(user_id)
+    return user_id
+
+def _invoice_count(user_id):
+    return db.session.scalar(select(func.count(Invoice.id)).where(Invoice.user_id == user_id))
+
+def generate_dataset(scale_name, seed=0, today=None):
+    """
+    Creates the users, customers, invoices and items of a benchmark scale
+
+    The same scale and seed always produce the same data. Users are named
+    bench-<scale>-<seed>-<n>, and a data set that already exists is reused
+    instead of generated again, so several benchmark runs (or commits) can
+    be compared on one database. Generate into a scratch database: the
+    1m scale writes about a million invoice items.
+
+    Args:
+        scale_name: Key of SCALES
+        seed: Seed of the random generator
+        today: Date the invoice history ends at (today by default)
+
+    Returns:
+        list: IDs of the benchmark users
+
+    Raises:
+        ValueError: If an earlier generation of the data set was interrupted
+        scratch.ScratchDatabaseError: If the database has users other than generated ones
+    """
+    scratch.require_scratch_database()
+    scale = SCALES[scale_name]
+    today = today or date.today()
+    user_ids = []
+    for index in range(scale.users):
+        username = benchmark_username(scale_name, seed, index)
+        user_id = db.session.scalar(select(User.id).where(User.username == username))
+        if user_id is None:
+            user_id = _generate_user(random.Random(f"{seed}-{index}"), scale, username, today)
+        elif _invoice_count(user_id) < scale.invoices_per_user:
+            raise ValueError(f"Benchmark user {username} is incomplete, delete it or use a fresh database")
+        user_ids.append(user_id)
+    return user_ids
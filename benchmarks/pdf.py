@@ -0,0 +1,62 @@
+import platform
+import random
+import time
+from flask import render_template
+from sqlalchemy import select
+from app import app, db
+from app import Invoice
+from pdf_renderer import PdfRenderer
+from query_profiles import invoice_detail_options
+from benchmarks.generator import generate_dataset
+from benchmarks.scenarios import _git_commit, latency_summary
+
+def _invoice_documents(user_id, seed, count):
+    """Renders the HTML of a sample of the user's invoices"""
+    invoice_ids = db.session.scalars(select(Invoice.id).where(Invoice.user_id == user_id).order_by(Invoice.id)).all()
+    sample = random.Random(seed).sample(invoice_ids, min(len(invoice_ids), count))
+    invoices = db.session.scalars(select(Invoice).where(Invoice.id.in_(sample)).options(*invoice_detail_options())).all()
+    return [render_template('invoice_pdf_template.html', invoice=invoice) for invoice in invoices]
+
+def _time_renders(documents, renderer_for):
+    durations = []
+    for html in documents:
+        start = time.perf_counter()
+        renderer_for().render(html)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def run_pdf_benchmark(scale_name='1k', seed=0, iterations=20, warmup=2):
+    """
+    Compares cold and warm PDF renders of the same invoices
+
+    Cold renders build a new PdfRenderer per invoice, paying for font
+    setup, stylesheet parsing and image decoding every time as renders did
+    before the warm renderer. Warm renders share one renderer that already
+    rendered `warmup` invoices. Only WeasyPrint is timed, the HTML of the
+    invoices is rendered beforehand.
+
+    Returns:
+        dict: JSON serializable results with the latency of both modes and the speedup of the median
+    """
+    with app.app_context():
+        user_ids = generate_dataset(scale_name, seed)
+        documents = _invoice_documents(user_ids[0], seed, warmup + iterations)
+        stylesheet, logo_dir = app.config['PDF_STYLESHEET'], app.config['PDF_LOGO_DIR']
+    warm_up, measured = documents[:warmup], documents[warmup:] or documents
+
+    cold = _time_renders(measured, lambda: PdfRenderer(stylesheet, logo_dir))
+    renderer = PdfRenderer(stylesheet, logo_dir)
+    _time_renders(warm_up, lambda: renderer)
+    warm = _time_renders(measured, lambda: renderer)
+
+    cold_latency, warm_latency = latency_summary(cold), latency_summary(warm)
+    return {
+        'scale': scale_name,
+        'seed': seed,
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'iterations': len(measured),
+        'cold_latency_ms': cold_latency,
+        'warm_latency_ms': warm_latency,
+        'p50_speedup': round(cold_latency['p50'] / warm_latency['p50'], 2) if warm_latency['p50'] else None,
+    }
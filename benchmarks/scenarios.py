@@ -0,0 +1,291 @@
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from sqlalchemy import bindparam, delete, select, update
+from app import app, db
+from app import Invoice, InvoiceItem, OutboundEmail, PdfJob
+from query_plans import QueryCounter
+from benchmarks.generator import SCALES, generate_dataset
+import mail_queue
+import page_cache
+import pdf_worker
+import scratch
+
+PERCENTILES = (50, 90, 95, 99)
+
+# Default relative increase of p95 latency or mean query count reported as a regression
+REGRESSION_THRESHOLD = 0.2
+
+class StubMailConnection:
+    """Stands in for the SMTP connection, keeping the messages instead of sending them"""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+
+class Bench:
+    """State shared by the scenarios of one run"""
+
+    def __init__(self, user_id, seed, iterations):
+        self.user_id = user_id
+        self.client = scratch.logged_in_client(user_id)
+
+        invoice_ids = db.session.scalars(select(Invoice.id).where(Invoice.user_id == user_id).order_by(Invoice.id)).all()
+        rng = random.Random(seed)
+        # Every PDF and email iteration gets an invoice of its own, so each one renders
+        self.invoice_pool = rng.sample(invoice_ids, min(len(invoice_ids), iterations))
+        self.customer_id = db.session.scalar(select(Invoice.customer_id).where(Invoice.id == self.invoice_pool[0]))
+        # The email scenario marks these invoices as sent, the cleanup puts the old delivery state back
+        self.email_states = [
+            {'b_id': row.id, 'b_email_status': row.email_status, 'b_emailed_at': row.emailed_at}
+            for row in db.session.execute(
+                select(Invoice.id, Invoice.email_status, Invoice.emailed_at).where(Invoice.id.in_(self.invoice_pool))
+            )
+        ]
+        self.created_ids = []
+        self.email_ids = []
+        self.pdf_job_ids = []
+        self.mailer = StubMailConnection()
+
+    def pooled_invoice(self, iteration):
+        return self.invoice_pool[iteration % len(self.invoice_pool)]
+
+def _invoice_form(bench, number='', items=None, notes=''):
+    today = date.today()
+    form = {
+        'invoice_number': number,
+        'date_issued': today.isoformat(),
+        'date_due': (today + timedelta(days=30)).isoformat(),
+        'customer_id': str(bench.customer_id),
+        'status': 'Unpaid',
+        'tax_rate': '19',
+        'notes': notes,
+    }
+    for index, item in enumerate(items or [{'description': f"Benchmark item {n}", 'quantity': '2', 'unit_price': '12.50'} for n in range(3)]):
+        for name, value in item.items():
+            form[f"items-{index}-{name}"] = value
+    return form
+
+def _create(bench, iteration):
+    form = _invoice_form(bench)
+
+    def request():
+        response = bench.client.post('/create_invoice', data=form)
+        match = re.search(r'/invoice/(\d+)', response.location or '')
+        if match:
+            bench.created_ids.append(int(match.group(1)))
+        return response
+    return request
+
+def _edit(bench, iteration):
+    invoice_id = bench.created_ids[iteration % len(bench.created_ids)]
+    invoice = db.session.get(Invoice, invoice_id)
+    items = db.session.scalars(select(InvoiceItem).where(InvoiceItem.invoice_id == invoice_id).order_by(InvoiceItem.id)).all()
+    # Change one line, keep the others
+    rows = [
+        {'id': str(item.id), 'description': item.description, 'quantity': str(item.quantity), 'unit_price': str(item.unit_price)}
+        for item in items
+    ]
+    rows[0]['quantity'] = str(iteration % 9 + 1)
+    form = _invoice_form(bench, invoice.invoice_number, rows, notes=f"Edited {iteration}")
+    return lambda: bench.client.post(f'/invoice/{invoice_id}/edit', data=form)
+
+def _email(bench, iteration):
+    invoice_id = bench.pooled_invoice(iteration)
+
+    def request():
+        response = bench.client.post(f'/invoice/{invoice_id}/send')
+        # Deliver the queued message like the mail worker would, through the stub
+        email_ids = db.session.scalars(
+            select(OutboundEmail.id).where(OutboundEmail.invoice_id == invoice_id, OutboundEmail.status == mail_queue.QUEUED)
+        ).all()
+        mail_queue.deliver(bench.mailer, email_ids)
+        bench.email_ids.extend(email_ids)
+        return response
+    return request
+
+def _pdf(bench, iteration):
+    invoice_id = bench.pooled_invoice(iteration)
+
+    def request():
+        response = bench.client.get(f'/invoice/{invoice_id}/pdf')
+        # A cache miss queues the render, run it here like the PDF worker would
+        if response.status_code == 202:
+            job_id = response.get_json()['id']
+            pdf_worker.run_job(job_id)
+            bench.pdf_job_ids.append(job_id)
+        return response
+    return request
+
+def _get(url):
+    return lambda bench, iteration: (lambda: bench.client.get(url(bench, iteration) if callable(url) else url))
+
+# Scenario name -> function(bench, iteration) returning the timed callable;
+# the function itself runs untimed, so it prepares what the request needs
+SCENARIOS = {
+    'dashboard': _get('/dashboard'),
+    'invoice-list': _get('/invoices'),
+    'invoice-list-unpaid': _get('/invoices?status=Unpaid'),
+    'invoice-view': _get(lambda bench, iteration: f'/invoice/{bench.pooled_invoice(iteration)}'),
+    'create': _create,
+    'edit': _edit,
+    'pdf': _pdf,
+    'email': _email,
+}
+
+def percentile(values, rank):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    index = max(0, -(-rank * len(ordered) // 100) - 1)
+    return ordered[index]
+
+def latency_summary(durations):
+    """Mean, percentiles and maximum in milliseconds of durations in seconds"""
+    milliseconds = [duration * 1000 for duration in durations]
+    latency = {'mean': round(sum(milliseconds) / len(milliseconds), 3)}
+    latency.update({f"p{rank}": round(percentile(milliseconds, rank), 3) for rank in PERCENTILES})
+    latency['max'] = round(max(milliseconds), 3)
+    return latency
+
+def summarize(durations, query_counts, statuses):
+    """Builds the JSON entry of one scenario"""
+    return {
+        'iterations': len(durations),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'latency_ms': latency_summary(durations),
+        'queries': {
+            'mean': round(sum(query_counts) / len(query_counts), 2),
+            'max': max(query_counts),
+        },
+    }
+
+def _run_scenario(bench, scenario, iterations, warmup):
+    durations, query_counts, statuses = [], [], Counter()
+    for iteration in range(warmup + iterations):
+        with app.app_context():
+            request = scenario(bench, iteration)
+        with app.app_context(), QueryCounter() as counter:
+            start = time.perf_counter()
+            response = request()
+            elapsed = time.perf_counter() - start
+        if iteration >= warmup:
+            durations.append(elapsed)
+            query_counts.append(counter.count)
+            statuses[response.status_code] += 1
+    return summarize(durations, query_counts, statuses)
+
+def _cleanup(bench):
+    """Deletes what the run created, through the ORM so the summary tables follow, and restores the sampled invoices"""
+    with app.app_context():
+        db.session.execute(delete(OutboundEmail).where(OutboundEmail.id.in_(bench.email_ids)))
+        db.session.execute(delete(PdfJob).where(PdfJob.id.in_(bench.pdf_job_ids)))
+        for invoice in db.session.scalars(select(Invoice).where(Invoice.id.in_(bench.created_ids))):
+            db.session.delete(invoice)
+        if bench.email_states:
+            table = Invoice.__table__
+            db.session.connection().execute(
+                update(table)
+                .where(table.c.id == bindparam('b_id'))
+                .values(email_status=bindparam('b_email_status'), emailed_at=bindparam('b_emailed_at')),
+                bench.email_states
+            )
+            page_cache.bump_data_version(db.session.connection(), [bench.user_id])
+        db.session.commit()
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=app.root_path,
+            capture_output=True, text=True, timeout=5, check=True
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def run_benchmark(scale_name='1k', seed=0, iterations=20, warmup=2, scenarios=None):
+    """
+    Runs the benchmark scenarios against a generated data set
+
+    Requests go through the Flask test client as the first benchmark user,
+    with CSRF checks off, the page cache off, outgoing mail replaced by
+    StubMailConnection and an empty PDF cache, so page requests render
+    and PDF and email iterations render every time; the
+    render job a PDF download queues is run inside the timed request.
+    Invoices created by the run are deleted afterwards and the delivery
+    state of the emailed invoices is put back. Only runs against a scratch
+    database, see scratch.require_scratch_database. Scenarios run in
+    the order given; 'edit' changes the invoices made by 'create'.
+
+    Args:
+        scale_name: Key of benchmarks.generator.SCALES
+        seed: Seed of the data set and of the invoice sample
+        iterations: Measured requests per scenario
+        warmup: Unmeasured requests run before them
+        scenarios: Names of SCENARIOS to run (all by default)
+
+    Returns:
+        dict: JSON serializable results with latency percentiles and query counts
+    """
+    names = list(scenarios or SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise ValueError(f"Unknown scenarios: {', '.join(unknown)}")
+    if 'edit' in names and 'create' not in names[:names.index('edit')]:
+        raise ValueError("The edit scenario needs the create scenario to run before it")
+
+    started_at = datetime.utcnow().isoformat(timespec='seconds')
+    with app.app_context():
+        user_ids = generate_dataset(scale_name, seed)
+        bench = Bench(user_ids[0], seed, warmup + iterations)
+        dialect = db.engine.dialect.name
+
+    pdf_cache_dir = tempfile.mkdtemp(prefix='benchmark-pdf-')
+    results = {}
+    try:
+        with scratch.harness_config(PDF_CACHE_DIR=pdf_cache_dir):
+            for name in names:
+                # A cache directory per scenario, the email scenario reuses the PDF scenario's invoices
+                app.config['PDF_CACHE_DIR'] = os.path.join(pdf_cache_dir, name)
+                results[name] = _run_scenario(bench, SCENARIOS[name], iterations, warmup)
+    finally:
+        shutil.rmtree(pdf_cache_dir, ignore_errors=True)
+        _cleanup(bench)
+
+    return {
+        'scale': scale_name,
+        'seed': seed,
+        'approximate_items': SCALES[scale_name].approximate_items,
+        'database': dialect,
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'started_at': started_at,
+        'scenarios': results,
+    }
+
+def compare_results(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """
+    Lists the scenarios that got slower or issue more SQL than in a baseline run
+
+    Returns:
+        list: Human readable regression messages, empty when none
+    """
+    regressions = []
+    for name, result in current['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        old_p95, new_p95 = before['latency_ms']['p95'], result['latency_ms']['p95']
+        if old_p95 and new_p95 > old_p95 * (1 + threshold):
+            regressions.append(f"{name}: p95 {old_p95:.1f} ms -> {new_p95:.1f} ms")
+        old_queries, new_queries = before['queries']['mean'], result['queries']['mean']
+        if new_queries > old_queries * (1 + threshold) and new_queries - old_queries >= 1:
+            regressions.append(f"{name}: {old_queries:g} -> {new_queries:g} queries per request")
+    return regressions
@@ -0,0 +1,124 @@
+import logging
+import threading
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, wait
+from flask import current_app
+from app import db
+from app import Invoice
+from pagination import invoice_query
+import pdf_worker
+
+_pool = None
+_pool_lock = threading.Lock()
+
+class ZipSink:
+    """
+    Write-only file object that hands over whatever zipfile wrote so far
+
+    It has no tell() or seek(), which makes zipfile use data descriptors and
+    never go back to patch earlier bytes, so entries can be sent as soon as
+    they are complete.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def get_export_pool():
+    """Returns the process pool shared by bulk exports of this web worker"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = pdf_worker.create_render_pool(current_app.config['BULK_EXPORT_PROCESSES'])
+        return _pool
+
+def _invoice_refs(user_id, filters, batch_size=500):
+    """
+    Yields (id, invoice number) of the matching invoices without loading them all
+
+    Ids are read in keyset batches and the read transaction is ended after
+    each one, so no transaction stays open while the PDFs render. An open
+    cursor would hold SQLite's shared lock, and block every writer, for the
+    whole export.
+    """
+    query = invoice_query(user_id, filters).with_only_columns(Invoice.id, Invoice.invoice_number)
+    last_id = None
+    while True:
+        batch_query = query if last_id is None else query.where(Invoice.id > last_id)
+        batch = db.session.execute(batch_query.order_by(Invoice.id).limit(batch_size)).all()
+        db.session.rollback()
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1].id
+
+def stream_invoice_zip(user_id, filters):
+    """
+    Yields a ZIP archive with the PDF of every matching invoice
+
+    PDFs are rendered in the export process pool. At most two renders per
+    process are in flight and each finished PDF is written to the archive and
+    yielded immediately, so memory use does not grow with the export size.
+
+    Args:
+        user_id: ID of the user
+        filters: InvoiceFilters from the invoice list
+
+    Yields:
+        bytes: Consecutive chunks of the ZIP archive
+    """
+    pool = get_export_pool()
+    window = current_app.config['BULK_EXPORT_PROCESSES'] * 2
+    sink = ZipSink()
+    failures = []
+
+    in_flight = {}
+    try:
+        with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED) as archive:
+            refs = _invoice_refs(user_id, filters)
+            exhausted = False
+
+            while in_flight or not exhausted:
+                while not exhausted and len(in_flight) < window:
+                    ref = next(refs, None)
+                    if ref is None:
+                        exhausted = True
+                        break
+                    invoice_id, invoice_number = ref
+                    in_flight[pool.submit(pdf_worker.render_invoice_pdf, invoice_id)] = invoice_number
+
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    invoice_number = in_flight.pop(future)
+                    try:
+                        pdf = future.result()
+                    except Exception as e:
+                        logging.exception(f"Bulk export could not render invoice {invoice_number}")
+                        failures.append(f"{invoice_number}: {e}")
+                        continue
+                    archive.writestr(f"Invoice-{invoice_number}.pdf", pdf)
+                yield sink.drain()
+
+            if failures:
+                archive.writestr('export-errors.txt', '\n'.join(failures) + '\n')
+
+        yield sink.drain()
+    finally:
+        # A client that disconnects closes the generator mid-export; leave the
+        # shared pool to other exports instead of finishing renders nobody reads
+        for future in in_flight:
+            future.cancel()
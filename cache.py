@@ -0,0 +1,135 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+class MemoryCache:
+    """
+    In-process LRU cache whose entries expire after `ttl` seconds
+
+    Each process has its own copy, so an invalidation only reaches the
+    process that made it; the others see the change once the TTL runs out.
+    """
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class SQLiteCache:
+    """
+    Cache shared by all processes on a host through a local SQLite file
+
+    Values are stored as JSON. Writes go through WAL so readers in other
+    gunicorn workers are never blocked, and an invalidation is seen by every
+    worker on its next read. Expired rows are skipped on read and pruned
+    when written over.
+    """
+
+    def __init__(self, path, ttl=60):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)'
+            )
+
+    def _connection(self):
+        # sqlite3 connections may not be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        """Returns the cached value, or None on a miss"""
+        row = self._connection().execute(
+            'SELECT value FROM cache WHERE key = ? AND expires >= ?', (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+            (key, json.dumps(value, separators=(',', ':')), time.time() + self.ttl)
+        )
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+
+class NullCache:
+    """Cache that never holds anything, for USER_CACHE_BACKEND=none"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+def create_cache(backend, ttl, max_entries=1024, path=None):
+    """
+    Builds a cache backend by name
+
+    Args:
+        backend: 'memory', 'sqlite' or 'none'
+        ttl: Seconds an entry stays valid
+        max_entries: Size of the in-process LRU
+        path: File of the SQLite backend
+
+    Raises:
+        ValueError: If the backend is unknown
+    """
+    if backend == 'memory':
+        return MemoryCache(max_entries, ttl)
+    if backend == 'sqlite':
+        return SQLiteCache(path, ttl)
+    if backend == 'none':
+        return NullCache()
+    raise ValueError(f"Unknown cache backend: {backend!r}")
@@ -0,0 +1,283 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from datetime import datetime
+from sqlalchemy import func, select, update
+from app import app, db
+from app import Customer, EmailCampaign, Invoice, OutboundEmail
+from money import ZERO
+import mail_queue
+import pdf_worker
+
+DEFAULT_STATUSES = ('Unpaid', 'Overdue')
+
+def reminder_email_body(invoice_number, customer_name, total, date_due, sender_name):
+    """Returns the plain text body of a payment reminder"""
+    return f"""
+Dear {customer_name},
+
+This is a friendly reminder that invoice {invoice_number} for the amount of ${total:.2f} was due on {date_due.strftime('%B %d, %Y')}.
+
+Please find the invoice attached. If you have already paid, please disregard this message.
+
+Best regards,
+{sender_name}
+"""
+
+def create_campaign(user_id, statuses, due_before, sender_name, batch_size=500):
+    """
+    Queues a reminder email for every matching invoice of a user
+
+    Invoices are read as plain rows and the messages written with
+    executemany batches, so creating a campaign for thousands of invoices
+    takes a handful of statements.
+
+    Args:
+        user_id: ID of the user
+        statuses: Invoice statuses to remind about
+        due_before: Only invoices due before this date (all when None)
+        sender_name: Business or user name used in subject and signature
+        batch_size: Messages inserted per statement
+
+    Returns:
+        EmailCampaign: The created campaign
+    """
+    campaign = EmailCampaign(
+        kind='reminder',
+        statuses=','.join(statuses),
+        due_before=due_before,
+        status='running',
+        user_id=user_id
+    )
+    db.session.add(campaign)
+    db.session.flush()
+
+    query = (
+        select(Invoice.id, Invoice.invoice_number, Invoice.total, Invoice.date_due, Customer.name, Customer.email)
+        .join(Customer, Customer.id == Invoice.customer_id)
+        .where(Invoice.user_id == user_id, Invoice.status.in_(statuses))
+        .where(Customer.email.is_not(None), Customer.email != '')
+        .order_by(Invoice.id)
+    )
+    if due_before is not None:
+        query = query.where(Invoice.date_due < due_before)
+
+    now = datetime.utcnow()
+    sender = app.config.get('MAIL_DEFAULT_SENDER')
+    table = OutboundEmail.__table__
+    total = 0
+    rows = []
+    for invoice_id, number, amount, date_due, customer_name, customer_email in db.session.execute(
+        query.execution_options(yield_per=batch_size)
+    ):
+        rows.append({
+            'status': mail_queue.QUEUED,
+            'subject': f"Payment reminder: invoice {number} from {sender_name}",
+            'sender': sender,
+            'recipients': customer_email,
+            'body': reminder_email_body(number, customer_name, amount or ZERO, date_due, sender_name),
+            'attach_invoice_pdf': True,
+            'attempts': 0,
+            'next_attempt_at': now,
+            'user_id': user_id,
+            'invoice_id': invoice_id,
+            'campaign_id': campaign.id,
+            'created_at': now
+        })
+        if len(rows) >= batch_size:
+            db.session.execute(table.insert(), rows)
+            total += len(rows)
+            rows = []
+    if rows:
+        db.session.execute(table.insert(), rows)
+        total += len(rows)
+
+    # Flag every selected invoice in one statement
+    db.session.execute(
+        update(Invoice)
+        .where(Invoice.id.in_(select(OutboundEmail.invoice_id).where(OutboundEmail.campaign_id == campaign.id)))
+        .values(email_status=mail_queue.QUEUED)
+    )
+
+    campaign.total = total
+    if total == 0:
+        campaign.status = 'done'
+        campaign.finished_at = now
+    db.session.commit()
+    return campaign
+
+def campaign_progress(campaign_id):
+    """
+    Counts the campaign's messages per delivery status
+
+    Returns:
+        dict: Status -> count, plus 'total'
+    """
+    counts = dict(db.session.execute(
+        select(OutboundEmail.status, func.count(OutboundEmail.id))
+        .where(OutboundEmail.campaign_id == campaign_id)
+        .group_by(OutboundEmail.status)
+    ).all())
+    counts['total'] = sum(counts.values())
+    return counts
+
+def _finish_if_complete(campaign_id):
+    progress = campaign_progress(campaign_id)
+    if not progress.get(mail_queue.QUEUED) and not progress.get(mail_queue.SENDING):
+        db.session.execute(
+            update(EmailCampaign)
+            .where(EmailCampaign.id == campaign_id)
+            .values(status='done', finished_at=datetime.utcnow())
+        )
+        db.session.commit()
+    return progress
+
+def _send_loop(ready):
+    """Sender thread: delivers rendered messages over its own SMTP connection"""
+    connection = mail_queue.PooledConnection()
+    with app.app_context():
+        try:
+            while True:
+                entry = ready.get()
+                if entry is None:
+                    break
+                email_id, pdf = entry
+                if isinstance(pdf, Exception):
+                    email = db.session.get(OutboundEmail, email_id)
+                    mail_queue.record_failure(email, pdf)
+                    db.session.commit()
+                    continue
+                mail_queue.deliver(connection, [email_id], {email_id: pdf})
+        finally:
+            connection.close()
+
+def run_campaign(campaign_id, processes=None, connections=None, on_progress=None, progress_interval=5.0):
+    """
+    Delivers a campaign with PDF rendering pipelined into SMTP sending
+
+    A process pool renders attachments while `connections` sender threads,
+    each holding one SMTP connection, send the finished messages. Messages
+    are claimed MAIL_QUEUE_BATCH_SIZE at a time, and a bounded queue
+    between the two stages keeps at most two renders per process in
+    flight. Every message is committed as soon as it is sent, so a crashed
+    run can simply be started again: delivered messages are skipped and
+    the ones left in 'sending' for longer than MAIL_QUEUE_SEND_TIMEOUT are
+    queued again. The mail worker runs the due campaigns through
+    run_due_campaigns, one campaign at a time.
+
+    Args:
+        campaign_id: ID of the campaign
+        processes: Render processes (PDF_WORKER_PROCESSES by default)
+        connections: Parallel SMTP connections (MAIL_CAMPAIGN_CONNECTIONS by default)
+        on_progress: Optional callable receiving campaign_progress() periodically
+        progress_interval: Seconds between on_progress calls
+
+    Returns:
+        dict: Final campaign_progress()
+    """
+    processes = processes or app.config['PDF_WORKER_PROCESSES']
+    connections = connections or app.config['MAIL_CAMPAIGN_CONNECTIONS']
+    window = processes * 2
+    batch_size = max(window, app.config['MAIL_QUEUE_BATCH_SIZE'])
+
+    with app.app_context():
+        # Resume: messages claimed by a crashed run go back to the queue,
+        # the ones another live run is sending are left to it
+        mail_queue.requeue_stale_emails(campaign_id)
+
+    ready = queue.Queue(maxsize=window)
+    senders = [
+        threading.Thread(target=_send_loop, args=(ready,), name=f"campaign-{campaign_id}-sender-{index}", daemon=True)
+        for index in range(connections)
+    ]
+    for sender in senders:
+        sender.start()
+
+    last_report = time.monotonic()
+    try:
+        with pdf_worker.create_render_pool(processes) as pool:
+            in_flight = {}
+            claimed = deque()
+            while True:
+                # Claim a batch at a time, one claim per free slot would commit once per message
+                if not claimed and len(in_flight) < window:
+                    with app.app_context():
+                        email_ids = mail_queue.claim_emails(batch_size, campaign_id)
+                        claimed.extend(db.session.execute(
+                            select(OutboundEmail.id, OutboundEmail.invoice_id)
+                            .where(OutboundEmail.id.in_(email_ids))
+                            .order_by(OutboundEmail.id)
+                        ).all() if email_ids else [])
+                while claimed and len(in_flight) < window:
+                    email_id, invoice_id = claimed.popleft()
+                    in_flight[pool.submit(pdf_worker.render_invoice_pdf, invoice_id)] = email_id
+
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    email_id = in_flight.pop(future)
+                    try:
+                        ready.put((email_id, future.result()))
+                    except Exception as e:
+                        logging.warning(f"Could not render attachment of email {email_id}: {e}")
+                        ready.put((email_id, e))
+
+                if on_progress and time.monotonic() - last_report >= progress_interval:
+                    with app.app_context():
+                        on_progress(campaign_progress(campaign_id))
+                    last_report = time.monotonic()
+    finally:
+        for _ in senders:
+            ready.put(None)
+        for sender in senders:
+            sender.join()
+
+    with app.app_context():
+        return _finish_if_complete(campaign_id)
+
+def run_due_campaigns(processes=None, connections=None):
+    """
+    Delivers the due messages of every running campaign
+
+    Called by the mail worker on each round, so campaigns queued from the
+    web are sent without anyone running `flask campaign run`, and messages
+    record_failure scheduled for a later retry go out once they are due.
+    A campaign whose messages are all sent or failed is marked done.
+
+    Args:
+        processes: Render processes (PDF_WORKER_PROCESSES by default)
+        connections: Parallel SMTP connections (MAIL_CAMPAIGN_CONNECTIONS by default)
+
+    Returns:
+        int: Number of messages sent
+    """
+    with app.app_context():
+        now = datetime.utcnow()
+        due = (
+            select(OutboundEmail.id)
+            .where(OutboundEmail.campaign_id == EmailCampaign.id)
+            .where(OutboundEmail.status == mail_queue.QUEUED, OutboundEmail.next_attempt_at <= now)
+            .exists()
+        )
+        running = db.session.execute(
+            select(EmailCampaign.id, due).where(EmailCampaign.status == 'running').order_by(EmailCampaign.id)
+        ).all()
+        db.session.rollback()
+
+    sent = 0
+    for campaign_id, has_due in running:
+        if not has_due:
+            with app.app_context():
+                _finish_if_complete(campaign_id)
+            continue
+        with app.app_context():
+            before = campaign_progress(campaign_id).get(mail_queue.SENT, 0)
+            db.session.rollback()
+        progress = run_campaign(campaign_id, processes=processes, connections=connections)
+        sent += progress.get(mail_queue.SENT, 0) - before
+    return sent
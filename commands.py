@@ -0,0 +1,432 @@
+from datetime import datetime
+import json
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, select
+from app import app, db
+from app import Invoice, OutboundEmail, RecurringInvoice, User
+import analytics
+import benchmarks
+import campaigns
+import importer
+import load_tests
+import mail_queue
+import migrations
+import overdue
+import pdf_cache
+import pdf_renderer
+import pdf_worker
+import query_plans
+import reconcile
+import recurring
+import scratch
+import search
+import stats
+
+invoice_stats_cli = AppGroup('invoice-stats', help='Maintain the per-user invoice summary table.')
+
+def _echo_drift(drift):
+    for entry in drift:
+        click.echo(
+            f"user={entry.user_id} status={entry.status} "
+            f"count {entry.stored_count} -> {entry.actual_count}, "
+            f"amount {entry.stored_amount:.2f} -> {entry.actual_amount:.2f}"
+        )
+
+@invoice_stats_cli.command('verify')
+@click.option('--user-id', type=int, default=None, help='Only check this user.')
+def verify_invoice_stats_command(user_id):
+    """Report drift between user_invoice_stats and the invoices table."""
+    drift = stats.verify_invoice_stats(user_id)
+    _echo_drift(drift)
+    if drift:
+        raise click.ClickException(f"{len(drift)} summary rows are out of date")
+    click.echo('Invoice summary is up to date.')
+
+@invoice_stats_cli.command('rebuild')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user.')
+def rebuild_invoice_stats_command(user_id):
+    """Recompute user_invoice_stats from the invoices table."""
+    drift = stats.rebuild_invoice_stats(user_id)
+    _echo_drift(drift)
+    click.echo(f"Invoice summary rebuilt, {len(drift)} rows corrected.")
+
+app.cli.add_command(invoice_stats_cli)
+
+search_index_cli = AppGroup('search-index', help='Maintain the full-text search index.')
+
+@search_index_cli.command('rebuild')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user.')
+def rebuild_search_index_command(user_id):
+    """Recompute the search documents from customers, invoices and items."""
+    count = search.rebuild_index(user_id)
+    click.echo(f"Search index rebuilt, {count} documents indexed.")
+
+app.cli.add_command(search_index_cli)
+
+analytics_cli = AppGroup('analytics', help='Maintain the daily invoice rollups behind the reports.')
+
+@analytics_cli.command('verify')
+@click.option('--user-id', type=int, default=None, help='Only check this user.')
+def verify_rollups_command(user_id):
+    """Report rollup rows that differ from the invoices table."""
+    stale = analytics.verify_rollups(user_id)
+    for user, customer, day in stale:
+        click.echo(f"user={user} customer={customer} day={day.isoformat()}")
+    if stale:
+        raise click.ClickException(f"{len(stale)} rollup rows are out of date")
+    click.echo('Invoice rollups are up to date.')
+
+@analytics_cli.command('rebuild')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user.')
+def rebuild_rollups_command(user_id):
+    """Recompute invoice_daily_rollups from the invoices table."""
+    count = analytics.rebuild_rollups(user_id)
+    click.echo(f"Invoice rollups rebuilt, {count} rows written.")
+
+app.cli.add_command(analytics_cli)
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Create missing tables and apply pending schema migrations."""
+    applied = migrations.upgrade()
+    if applied:
+        click.echo(f"Applied migrations: {', '.join(str(version) for version in applied)}")
+    else:
+        click.echo('Database schema is up to date.')
+
+@app.cli.command('db-status')
+def db_status_command():
+    """List applied and pending schema migrations."""
+    with db.engine.connect() as connection:
+        applied = migrations.applied_versions(connection)
+    for version, description, _ in migrations.MIGRATIONS:
+        state = 'applied' if version in applied else 'pending'
+        click.echo(f"{version:>4}  {state:<8} {description}")
+
+@app.cli.command('reconcile-totals')
+@click.option('--user-id', type=int, default=None, help='Only check this user.')
+@click.option('--limit', type=int, default=100, show_default=True, help='Mismatches to print.')
+def reconcile_totals_command(user_id, limit):
+    """Report item amounts and invoice totals that differ from their items."""
+    count = 0
+    for mismatch in reconcile.find_total_mismatches(user_id):
+        count += 1
+        if count <= limit:
+            item = f" item={mismatch.item_id}" if mismatch.item_id else ''
+            click.echo(
+                f"invoice={mismatch.invoice_id} ({mismatch.invoice_number}) user={mismatch.user_id}{item} "
+                f"{mismatch.field}: stored {mismatch.stored} expected {mismatch.expected}"
+            )
+    if count:
+        raise click.ClickException(f"{count} amounts do not match their items")
+    click.echo('All invoice totals match their items.')
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if a hot route query needs a full table scan."""
+    failures = query_plans.check_query_plans()
+    for name, scanned, plan in failures:
+        click.echo(f"{name}: full scan of {', '.join(scanned)}")
+        for line in plan:
+            click.echo(f"    {line}")
+    if failures:
+        raise click.ClickException(f"{len(failures)} hot queries scan whole tables")
+    click.echo('All hot queries use indexes.')
+
+@app.cli.command('check-query-budgets')
+def check_query_budgets_command():
+    """Fail if an invoice page issues more SQL than its budget or scales with data."""
+    try:
+        failures = query_plans.check_query_budgets()
+    except scratch.ScratchDatabaseError as e:
+        raise click.ClickException(str(e))
+    for name, counts, statements in failures:
+        budget = query_plans.QUERY_BUDGETS[name]
+        click.echo(f"{name}: {' / '.join(str(count) for count in counts)} statements (budget {budget})")
+        for statement in statements:
+            click.echo(f"    {' '.join(statement.split())}")
+    if failures:
+        raise click.ClickException(f"{len(failures)} routes exceed their query budget")
+    click.echo('All invoice pages are within their query budgets.')
+
+@app.cli.command('check-invoice-numbers')
+@click.option('--workers', type=int, default=8, show_default=True, help='Parallel threads.')
+@click.option('--invoices', 'invoices_per_worker', type=int, default=10, show_default=True, help='Invoices posted per thread.')
+def check_invoice_numbers_command(workers, invoices_per_worker):
+    """Fail if parallel invoice creation hands out duplicate numbers or leaves gaps."""
+    try:
+        failures = load_tests.check_number_allocation(workers, invoices_per_worker)
+    except scratch.ScratchDatabaseError as e:
+        raise click.ClickException(str(e))
+    for failure in failures:
+        click.echo(failure)
+    if failures:
+        raise click.ClickException('Invoice number allocation is not consistent')
+    click.echo('Parallel allocation produced a gapless sequence without duplicates.')
+
+pdf_jobs_cli = AppGroup('pdf-jobs', help='Run and maintain the PDF rendering queue.')
+
+@pdf_jobs_cli.command('worker')
+@click.option('--processes', type=int, default=None, help='Render processes (PDF_WORKER_PROCESSES).')
+@click.option('--poll-interval', type=float, default=1.0, show_default=True, help='Seconds between queue polls.')
+@click.option('--once', is_flag=True, help='Exit when the queue is empty.')
+def pdf_worker_command(processes, poll_interval, once):
+    """Render queued invoice PDFs with a process pool."""
+    processed = pdf_worker.run_worker(processes=processes, poll_interval=poll_interval, once=once)
+    click.echo(f"Processed {processed} PDF jobs.")
+
+@pdf_jobs_cli.command('purge')
+@click.option('--days', type=int, default=7, show_default=True, help='Keep jobs finished within this many days.')
+def purge_pdf_jobs_command(days):
+    """Delete finished PDF jobs and their stored documents."""
+    deleted = pdf_worker.purge_jobs(days)
+    click.echo(f"Deleted {deleted} PDF jobs.")
+
+app.cli.add_command(pdf_jobs_cli)
+
+pdf_logos_cli = AppGroup('pdf-logos', help='Keep local copies of the logos shown on invoice PDFs.')
+
+@pdf_logos_cli.command('sync')
+@click.option('--refresh', is_flag=True, help='Download logos that are already stored again.')
+def sync_pdf_logos_command(refresh):
+    """Download the business logos of all users into PDF_LOGO_DIR."""
+    user_ids, failures = pdf_renderer.sync_logos(refresh=refresh)
+    for user_id in set(user_ids):
+        pdf_cache.invalidate_user(user_id)
+    for url, error in failures:
+        click.echo(f"{url}: {error}", err=True)
+    click.echo(f"Stored logos of {len(user_ids)} users, {len(failures)} failed.")
+
+app.cli.add_command(pdf_logos_cli)
+
+mail_queue_cli = AppGroup('mail-queue', help='Deliver and inspect queued outbound email.')
+
+@mail_queue_cli.command('worker')
+@click.option('--batch-size', type=int, default=None, help='Messages per round (MAIL_QUEUE_BATCH_SIZE).')
+@click.option('--poll-interval', type=float, default=2.0, show_default=True, help='Seconds between queue polls.')
+@click.option('--once', is_flag=True, help='Exit when no message is due.')
+def mail_worker_command(batch_size, poll_interval, once):
+    """Send queued email over a pooled SMTP connection."""
+    sent = mail_queue.run_worker(batch_size=batch_size, poll_interval=poll_interval, once=once)
+    click.echo(f"Sent {sent} emails.")
+
+@mail_queue_cli.command('status')
+def mail_status_command():
+    """Show the number of queued, sending, sent and failed messages."""
+    counts = db.session.execute(
+        select(OutboundEmail.status, func.count(OutboundEmail.id)).group_by(OutboundEmail.status)
+    ).all()
+    for status, count in sorted(counts):
+        click.echo(f"{status:<8} {count}")
+
+app.cli.add_command(mail_queue_cli)
+
+campaign_cli = AppGroup('campaign', help='Send payment reminders for many invoices at once.')
+
+def _echo_progress(progress):
+    click.echo(', '.join(f"{status}={count}" for status, count in sorted(progress.items())))
+
+@campaign_cli.command('create')
+@click.option('--user-id', type=int, required=True, help='Owner of the invoices.')
+@click.option('--status', 'statuses', multiple=True, type=click.Choice(campaigns.DEFAULT_STATUSES),
+              default=campaigns.DEFAULT_STATUSES, show_default=True,
+              help='Invoice status to include, may be repeated.')
+@click.option('--due-before', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Only invoices due before this date (default: today).')
+def create_campaign_command(user_id, statuses, due_before):
+    """Queue reminder emails for matching invoices."""
+    user = db.session.get(User, user_id)
+    if user is None:
+        raise click.ClickException(f"User {user_id} does not exist")
+    due_date = due_before.date() if due_before else datetime.utcnow().date()
+    campaign = campaigns.create_campaign(user.id, list(statuses), due_date, user.business_name or user.username)
+    click.echo(f"Campaign {campaign.id} queued {campaign.total} reminders.")
+
+@campaign_cli.command('run')
+@click.argument('campaign_id', type=int)
+@click.option('--processes', type=int, default=None, help='Render processes (PDF_WORKER_PROCESSES).')
+@click.option('--connections', type=int, default=None, help='SMTP connections (MAIL_CAMPAIGN_CONNECTIONS).')
+def run_campaign_command(campaign_id, processes, connections):
+    """Deliver a campaign, resuming where a previous run stopped."""
+    progress = campaigns.run_campaign(campaign_id, processes=processes, connections=connections, on_progress=_echo_progress)
+    _echo_progress(progress)
+
+@campaign_cli.command('status')
+@click.argument('campaign_id', type=int)
+def campaign_status_command(campaign_id):
+    """Show delivery progress of a campaign."""
+    _echo_progress(campaigns.campaign_progress(campaign_id))
+
+app.cli.add_command(campaign_cli)
+
+@app.cli.command('sweep-overdue')
+@click.option('--today', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Cutoff date (default: today).')
+def sweep_overdue_command(today):
+    """Mark past-due Unpaid invoices as Overdue."""
+    sweep = overdue.sweep_overdue(today.date() if today else None)
+    if sweep.id is None:
+        click.echo('No invoices to mark as Overdue.')
+    else:
+        click.echo(f"Sweep {sweep.id}: {sweep.changed_count} invoices marked as Overdue.")
+
+recurring_cli = AppGroup('recurring', help='Issue invoices on a schedule.')
+
+@recurring_cli.command('run')
+@click.option('--today', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Generate invoices due up to this date (default: today).')
+def run_recurring_command(today):
+    """Generate every recurring invoice that is due, one transaction per user."""
+    result = recurring.generate_due_invoices(today.date() if today else None)
+    for user_id, error in result.failures:
+        click.echo(f"user {user_id}: {error}", err=True)
+    click.echo(f"Created {result.created} invoices for {result.users} users, {len(result.failures)} users failed.")
+
+@recurring_cli.command('create')
+@click.argument('invoice_id', type=int)
+@click.option('--frequency', type=click.Choice(recurring.FREQUENCIES), default='monthly', show_default=True)
+@click.option('--interval', type=int, default=1, show_default=True, help='Periods between two invoices.')
+@click.option('--start', type=click.DateTime(formats=['%Y-%m-%d']), required=True, help='Date of the first invoice.')
+@click.option('--end', type=click.DateTime(formats=['%Y-%m-%d']), default=None, help='Last possible invoice date.')
+def create_recurring_command(invoice_id, frequency, interval, start, end):
+    """Repeat an existing invoice on a schedule."""
+    invoice = db.session.get(Invoice, invoice_id)
+    if invoice is None:
+        raise click.ClickException(f"Invoice {invoice_id} does not exist")
+    try:
+        template = recurring.create_from_invoice(invoice, frequency, start.date(), interval, end.date() if end else None)
+    except recurring.RecurringInvoiceError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Recurring invoice {template.id} starts on {template.next_run_date}.")
+
+@recurring_cli.command('end')
+@click.argument('recurring_id', type=int)
+def end_recurring_command(recurring_id):
+    """Stop a recurring invoice."""
+    template = db.session.get(RecurringInvoice, recurring_id)
+    if template is None:
+        raise click.ClickException(f"Recurring invoice {recurring_id} does not exist")
+    recurring.end_recurring(template)
+    click.echo(f"Recurring invoice {recurring_id} ended after {template.runs} invoices.")
+
+app.cli.add_command(recurring_cli)
+
+import_cli = AppGroup('import', help='Bulk import customers and invoices from CSV or JSON Lines.')
+
+def _run_import(kind, user_id, path, fmt, batch_size):
+    if db.session.get(User, user_id) is None:
+        raise click.ClickException(f"User {user_id} does not exist")
+    try:
+        fmt = importer.detect_format(path, fmt)
+        with open(path, encoding='utf-8-sig', newline='') as stream:
+            result = importer.IMPORTERS[kind](user_id, stream, fmt, batch_size=batch_size)
+    except importer.ImportFormatError as e:
+        raise click.ClickException(str(e))
+
+    for error in result.errors:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    if result.error_count > len(result.errors):
+        click.echo(f"... {result.error_count - len(result.errors)} more errors", err=True)
+    click.echo(
+        f"Imported {result.created} {kind} ({result.items_created} items, "
+        f"{result.customers_created} new customers), skipped {result.skipped}, "
+        f"{result.error_count} errors."
+    )
+
+@import_cli.command('customers')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user-id', type=int, required=True, help='Owner of the imported customers.')
+@click.option('--format', 'fmt', type=click.Choice(importer.FORMATS), default=None,
+              help='File format (default: from the extension).')
+@click.option('--batch-size', type=int, default=1000, show_default=True, help='Rows per insert batch.')
+def import_customers_command(path, user_id, fmt, batch_size):
+    """Import customers from a CSV or JSON Lines file."""
+    _run_import('customers', user_id, path, fmt, batch_size)
+
+@import_cli.command('invoices')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user-id', type=int, required=True, help='Owner of the imported invoices.')
+@click.option('--format', 'fmt', type=click.Choice(importer.FORMATS), default=None,
+              help='File format (default: from the extension).')
+@click.option('--batch-size', type=int, default=500, show_default=True, help='Invoices per insert batch.')
+def import_invoices_command(path, user_id, fmt, batch_size):
+    """Import invoices and their items from a CSV or JSON Lines file."""
+    _run_import('invoices', user_id, path, fmt, batch_size)
+
+app.cli.add_command(import_cli)
+
+benchmark_cli = AppGroup('benchmark', help='Measure the busiest routes on generated data.')
+
+@benchmark_cli.command('generate')
+@click.option('--scale', type=click.Choice(list(benchmarks.SCALES)), default='1k', show_default=True)
+@click.option('--seed', type=int, default=0, show_default=True, help='Seed of the generated data.')
+def generate_benchmark_data_command(scale, seed):
+    """Create the benchmark data set of a scale, unless it already exists."""
+    user_ids = benchmarks.generate_dataset(scale, seed)
+    click.echo(f"Benchmark data {scale} (seed {seed}) belongs to users {', '.join(map(str, user_ids))}.")
+
+@benchmark_cli.command('run')
+@click.option('--scale', type=click.Choice(list(benchmarks.SCALES)), default='1k', show_default=True)
+@click.option('--seed', type=int, default=0, show_default=True, help='Seed of the generated data.')
+@click.option('--iterations', type=int, default=20, show_default=True, help='Measured requests per scenario.')
+@click.option('--warmup', type=int, default=2, show_default=True, help='Unmeasured requests per scenario.')
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(list(benchmarks.SCENARIOS)),
+              help='Scenario to run, repeatable (default: all).')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), default=None,
+              help='Write the JSON results to this file instead of stdout.')
+def run_benchmark_command(scale, seed, iterations, warmup, scenarios, output):
+    """Run the route scenarios and report latency percentiles and query counts as JSON."""
+    try:
+        results = benchmarks.run_benchmark(scale, seed, iterations, warmup, scenarios or None)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    document = json.dumps(results, indent=2)
+    if output:
+        with open(output, 'w') as output_file:
+            output_file.write(document + '\n')
+        click.echo(f"Benchmark results written to {output}.")
+    else:
+        click.echo(document)
+
+@benchmark_cli.command('compare')
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+@click.option('--threshold', type=float, default=benchmarks.scenarios.REGRESSION_THRESHOLD, show_default=True,
+              help='Relative increase reported as a regression.')
+def compare_benchmarks_command(baseline, current, threshold):
+    """Fail if a scenario got slower or issues more SQL than in a baseline run."""
+    regressions = benchmarks.compare_results(json.load(baseline), json.load(current), threshold)
+    for regression in regressions:
+        click.echo(regression)
+    if regressions:
+        raise click.ClickException(f"{len(regressions)} regressions")
+    click.echo('No regressions.')
+
+@benchmark_cli.command('pdf')
+@click.option('--scale', type=click.Choice(list(benchmarks.SCALES)), default='1k', show_default=True)
+@click.option('--seed', type=int, default=0, show_default=True, help='Seed of the generated data.')
+@click.option('--iterations', type=int, default=20, show_default=True, help='Measured renders per mode.')
+@click.option('--warmup', type=int, default=2, show_default=True, help='Renders that warm up the shared renderer.')
+def pdf_benchmark_command(scale, seed, iterations, warmup):
+    """Compare cold and warm invoice PDF renders and report their latency as JSON."""
+    try:
+        results = benchmarks.run_pdf_benchmark(scale, seed, iterations, warmup)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(results, indent=2))
+
+@benchmark_cli.command('campaign')
+@click.option('--invoices', type=int, default=1000, show_default=True, help='Overdue invoices to remind about.')
+@click.option('--seed', type=int, default=0, show_default=True, help='Seed of the generated data.')
+@click.option('--processes', type=int, default=None, help='Render processes of the campaign.')
+@click.option('--connections', type=int, default=None, help='SMTP connections of the campaign.')
+def campaign_benchmark_command(invoices, seed, processes, connections):
+    """Compare one-by-one reminders with a campaign against a local aiosmtpd server."""
+    try:
+        results = benchmarks.run_campaign_benchmark(invoices, seed, processes, connections)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(results, indent=2))
+
+app.cli.add_command(benchmark_cli)
@@ -0,0 +1,98 @@
+import sqlite3
+import sys
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Engine
+from app import db
+from app import Customer
+
+# Suggestions returned by the autocomplete when the request does not ask for fewer
+AUTOCOMPLETE_LIMIT = 10
+MAX_AUTOCOMPLETE_LIMIT = 50
+
+def casefold_name(name):
+    """Folds a name for caseless matching, the SQLite casefold() function and index use it"""
+    return name.casefold() if name is not None else None
+
+@event.listens_for(Engine, 'connect')
+def _register_casefold(dbapi_connection, connection_record):
+    # SQLite's lower() only folds ASCII letters, the autocomplete index is built on Python's casefold
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('casefold', 1, casefold_name, deterministic=True)
+
+def _folded_name(dialect_name):
+    """The indexed, case folded customer name of a dialect"""
+    if dialect_name == 'postgresql':
+        return func.lower(Customer.name)
+    return func.casefold(Customer.name)
+
+def _upper_bound(prefix):
+    """
+    Returns the smallest string above every string starting with a prefix
+
+    Trailing U+10FFFF characters cannot be incremented and are dropped,
+    surrogates are skipped as they cannot be stored. None when the prefix
+    is only U+10FFFF characters, then there is no upper bound.
+    """
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    code = ord(prefix[-1]) + 1
+    if 0xD800 <= code <= 0xDFFF:
+        code = 0xE000
+    return prefix[:-1] + chr(code)
+
+def _name_prefix_filter(prefix, dialect_name):
+    """
+    Case-insensitive name prefix condition served by the customer name index
+
+    PostgreSQL uses the lower(name) text_pattern_ops index for LIKE
+    'prefix%'. SQLite only applies its LIKE optimisation to plain columns,
+    so it gets the equivalent range on casefold(name), which its expression
+    index serves.
+    """
+    folded_name = _folded_name(dialect_name)
+    if dialect_name == 'postgresql':
+        return folded_name.startswith(prefix.lower(), autoescape=True)
+    prefix = casefold_name(prefix)
+    upper_bound = _upper_bound(prefix)
+    if upper_bound is None:
+        return folded_name >= prefix
+    return (folded_name >= prefix) & (folded_name < upper_bound)
+
+def autocomplete_query(user_id, prefix, limit, dialect_name):
+    """Builds the SELECT behind autocomplete_customers for a dialect"""
+    query = (
+        select(Customer.id, Customer.name, Customer.email)
+        .where(Customer.user_id == user_id)
+        .order_by(_folded_name(dialect_name), Customer.id)
+        .limit(max(1, min(limit, MAX_AUTOCOMPLETE_LIMIT)))
+    )
+    prefix = (prefix or '').strip()
+    if prefix:
+        query = query.where(_name_prefix_filter(prefix, dialect_name))
+    return query
+
+def autocomplete_customers(user_id, prefix, limit=AUTOCOMPLETE_LIMIT):
+    """
+    Returns the user's customers whose name starts with a prefix
+
+    Reads only id, name and email through the (user_id, lower(name))
+    index, sorted by name, so the cost depends on the limit and not on the
+    size of the customer list.
+
+    Args:
+        user_id: ID of the user
+        prefix: Start of the name, any case (all customers when empty)
+        limit: Maximum number of suggestions, capped at MAX_AUTOCOMPLETE_LIMIT
+
+    Returns:
+        list: Rows with id, name and email
+    """
+    dialect_name = db.session.get_bind().dialect.name
+    return db.session.execute(autocomplete_query(user_id, prefix, limit, dialect_name)).all()
+
+def customer_exists(user_id, customer_id):
+    """Tells whether a customer id belongs to the user, with a single primary key lookup"""
+    return db.session.scalar(
+        select(Customer.id).where(Customer.id == customer_id, Customer.user_id == user_id)
+    ) is not None
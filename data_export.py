@@ -0,0 +1,200 @@
+import csv
+import io
+import json
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal
+from xml.sax.saxutils import escape
+from sqlalchemy import select
+from app import db
+from app import Customer, Invoice, InvoiceItem
+from bulk_export import ZipSink
+from pagination import invoice_query
+
+FORMATS = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# Bytes collected before a chunk is handed to the response
+CHUNK_SIZE = 64 * 1024
+
+def _invoice_rows(user_id, filters, args):
+    query = invoice_query(user_id, filters).join(Customer, Customer.id == Invoice.customer_id)
+    return query.with_only_columns(
+        Invoice.id, Invoice.invoice_number, Invoice.date_issued, Invoice.date_due, Invoice.status,
+        Customer.id.label('customer_id'), Customer.name.label('customer_name'),
+        Invoice.subtotal, Invoice.tax_rate, Invoice.tax_amount, Invoice.total, Invoice.notes,
+        Invoice.created_at
+    ).order_by(Invoice.id)
+
+def _item_rows(user_id, filters, args):
+    invoices = invoice_query(user_id, filters).with_only_columns(Invoice.id, Invoice.invoice_number).subquery()
+    return select(
+        InvoiceItem.id, invoices.c.id.label('invoice_id'), invoices.c.invoice_number,
+        InvoiceItem.description, InvoiceItem.quantity, InvoiceItem.unit_price, InvoiceItem.amount
+    ).join(invoices, invoices.c.id == InvoiceItem.invoice_id).order_by(InvoiceItem.invoice_id, InvoiceItem.id)
+
+def _customer_rows(user_id, filters, args):
+    query = select(
+        Customer.id, Customer.name, Customer.email, Customer.address, Customer.phone, Customer.created_at
+    ).where(Customer.user_id == user_id)
+    if filters.customer_id is not None:
+        query = query.where(Customer.id == filters.customer_id)
+    name_prefix = args.get('q', '').strip()
+    if name_prefix:
+        query = query.where(Customer.name.startswith(name_prefix, autoescape=True))
+    return query.order_by(Customer.id)
+
+# Dataset name -> function building its select()
+DATASETS = {
+    'invoices': _invoice_rows,
+    'items': _item_rows,
+    'customers': _customer_rows,
+}
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+def _iter_rows(statement, batch_size):
+    """Streams rows with a server side cursor where the driver supports one"""
+    result = db.session.execute(statement.execution_options(yield_per=batch_size))
+    yield list(result.keys())
+    for row in result:
+        yield row
+
+def _chunked(pieces):
+    buffer, size = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+def _csv_pieces(rows):
+    line = io.StringIO()
+    writer = csv.writer(line)
+    for row in rows:
+        writer.writerow([_text(value) for value in row])
+        yield line.getvalue().encode()
+        line.seek(0)
+        line.truncate()
+
+def _json_pieces(rows):
+    columns = next(rows)
+    separator = b'[\n'
+    for row in rows:
+        record = {column: value for column, value in zip(columns, row)}
+        yield separator + json.dumps(record, default=_text).encode()
+        separator = b',\n'
+    yield b'[]\n' if separator == b'[\n' else b'\n]\n'
+
+# Fixed parts of a one-sheet SpreadsheetML workbook
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+def _workbook_xml(sheet_name):
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        f'<sheets><sheet name="{escape(sheet_name)}" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    )
+
+def _xlsx_cell(value):
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return f'<c><v>{value}</v></c>'
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(_text(value))}</t></is></c>'
+
+def _xlsx_pieces(rows, sheet_name):
+    """
+    Writes the rows as a minimal XLSX workbook, streamed like the PDF archive
+
+    The worksheet uses inline strings, so no shared string table has to be
+    held in memory, and the ZIP entry is written through a ZipSink so each
+    compressed block can be sent as soon as it is produced.
+    """
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_PARTS.items():
+            archive.writestr(name, content)
+        archive.writestr('xl/workbook.xml', _workbook_xml(sheet_name))
+        yield sink.drain()
+
+        with archive.open('xl/worksheets/sheet1.xml', mode='w', force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            for row in rows:
+                sheet.write(('<row>' + ''.join(_xlsx_cell(value) for value in row) + '</row>').encode())
+                data = sink.drain()
+                if data:
+                    yield data
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+def stream_export(user_id, dataset, fmt, filters, args=None, batch_size=1000):
+    """
+    Yields an export of the user's invoices, items or customers
+
+    Rows are read as plain tuples with yield_per, so only one batch is in
+    memory at a time and the first bytes are sent before the query has
+    finished. Invoices and items follow the invoice list filters.
+
+    Args:
+        user_id: ID of the user
+        dataset: 'invoices', 'items' or 'customers'
+        fmt: 'csv', 'json' or 'xlsx'
+        filters: InvoiceFilters from the invoice list
+        args: Query string arguments, customers accept the list's q prefix
+        batch_size: Rows fetched per round trip
+
+    Yields:
+        bytes: Consecutive chunks of the file
+    """
+    statement = DATASETS[dataset](user_id, filters, args or {})
+    rows = _iter_rows(statement, batch_size)
+    if fmt == 'csv':
+        pieces = _csv_pieces(rows)
+    elif fmt == 'json':
+        pieces = _json_pieces(rows)
+    else:
+        pieces = _xlsx_pieces(rows, dataset)
+    return _chunked(pieces)
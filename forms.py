@@ -1,7 +1,9 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, BooleanField, TextAreaField, FloatField, DateField, SelectField, FieldList, FormField
+from wtforms import StringField, PasswordField, SubmitField, BooleanField, TextAreaField, DecimalField, DateField, SelectField, FieldList, FormField, HiddenField, IntegerField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError, Optional
+from flask_login import current_user
 from models import User
+from customer_lookup import customer_exists
 
 class RegistrationForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired(), Length(min=2, max=20)])
@@ -37,24 +39,30 @@ class CustomerForm(FlaskForm):
     submit = SubmitField('Save Customer')
 
 class InvoiceItemForm(FlaskForm):
+    id = HiddenField('Item ID')
     description = StringField('Description', validators=[DataRequired(), Length(max=256)])
-    quantity = FloatField('Quantity', validators=[DataRequired()])
-    unit_price = FloatField('Unit Price', validators=[DataRequired()])
-    amount = FloatField('Amount', validators=[DataRequired()])
+    quantity = DecimalField('Quantity', places=3, validators=[DataRequired()])
+    unit_price = DecimalField('Unit Price', places=2, validators=[DataRequired()])
+    amount = DecimalField('Amount', places=2, validators=[DataRequired()])
 
 class InvoiceForm(FlaskForm):
     invoice_number = StringField('Invoice Number', validators=[DataRequired(), Length(max=20)])
     date_issued = DateField('Date Issued', validators=[DataRequired()], format='%Y-%m-%d')
     date_due = DateField('Date Due', validators=[DataRequired()], format='%Y-%m-%d')
-    customer_id = SelectField('Customer', coerce=int, validators=[DataRequired()])
-    tax_rate = FloatField('Tax Rate (%)', validators=[Optional()], default=0.0)
+    # Filled through the /api/customers/autocomplete typeahead
+    customer_id = IntegerField('Customer', validators=[DataRequired()])
+    tax_rate = DecimalField('Tax Rate (%)', places=2, validators=[Optional()], default=0)
     notes = TextAreaField('Notes', validators=[Optional(), Length(max=1000)])
     status = SelectField('Status', choices=[('Unpaid', 'Unpaid'), ('Paid', 'Paid'), ('Overdue', 'Overdue'), ('Cancelled', 'Cancelled')])
     items = FieldList(FormField(InvoiceItemForm), min_entries=1)
-    subtotal = FloatField('Subtotal', validators=[DataRequired()], default=0.0)
-    tax_amount = FloatField('Tax Amount', validators=[DataRequired()], default=0.0)
-    total = FloatField('Total', validators=[DataRequired()], default=0.0)
+    subtotal = DecimalField('Subtotal', places=2, validators=[DataRequired()], default=0)
+    tax_amount = DecimalField('Tax Amount', places=2, validators=[DataRequired()], default=0)
+    total = DecimalField('Total', places=2, validators=[DataRequired()], default=0)
     submit = SubmitField('Save Invoice')
+    
+    def validate_customer_id(self, customer_id):
+        if not customer_exists(current_user.id, customer_id.data):
+            raise ValidationError('Please choose one of your customers.')
 
 class ProfileForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired(), Length(min=2, max=20)])
@@ -63,3 +71,7 @@ class ProfileForm(FlaskForm):
     business_address = TextAreaField('Business Address', validators=[Optional(), Length(max=256)])
     business_phone = StringField('Business Phone', validators=[Optional(), Length(max=20)])
     submit = SubmitField('Update Profile')
+
+# No fields of its own, validates the CSRF token of POST routes without a form
+class CsrfForm(FlaskForm):
+    pass
@@ -0,0 +1,508 @@
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from decimal import Decimal
+from dataclasses import dataclass, field
+from sqlalchemy import insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.datastructures import MultiDict
+from app import db
+from app import Customer, Invoice, InvoiceItem
+from forms import CustomerForm, InvoiceForm, InvoiceItemForm
+from money import QUANTITY_SCALE, RATE_SCALE, ZERO, invoice_totals, line_amount, to_decimal
+from stats import apply_stats_deltas
+import analytics
+import numbering
+import page_cache
+import search
+
+FORMATS = ('csv', 'jsonl')
+
+# Errors kept for the report, later ones are only counted
+MAX_REPORTED_ERRORS = 1000
+
+CUSTOMER_FIELDS = ('name', 'email', 'address', 'phone')
+INVOICE_FIELDS = ('invoice_number', 'date_issued', 'date_due', 'status', 'tax_rate', 'notes')
+ITEM_FIELDS = ('description', 'quantity', 'unit_price', 'amount')
+
+# Stands in for a missing invoice number while the rest of the row is validated
+NUMBER_PLACEHOLDER = 'PENDING'
+
+class ImportFormatError(ValueError):
+    """Raised when an import file cannot be read at all"""
+
+@dataclass
+class ImportResult:
+    """Outcome of one import run"""
+    kind: str
+    created: int = 0
+    items_created: int = 0
+    customers_created: int = 0
+    skipped: int = 0
+    error_count: int = 0
+    errors: list = field(default_factory=list)
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'created': self.created,
+            'items_created': self.items_created,
+            'customers_created': self.customers_created,
+            'skipped': self.skipped,
+            'error_count': self.error_count,
+            'errors': self.errors,
+        }
+
+def detect_format(filename, requested=None):
+    """
+    Picks the parser for an upload from an explicit format or the file extension
+
+    Returns:
+        str: 'csv' or 'jsonl'
+    """
+    fmt = (requested or os.path.splitext(filename or '')[1].lstrip('.')).lower()
+    if fmt in ('json', 'ndjson'):
+        fmt = 'jsonl'
+    if fmt not in FORMATS:
+        raise ImportFormatError(f"Unsupported import format: {fmt or 'unknown'}")
+    return fmt
+
+def text_stream(binary):
+    """Wraps an uploaded binary stream for line by line text reading"""
+    return io.TextIOWrapper(binary, encoding='utf-8-sig', newline='')
+
+def read_records(stream, fmt):
+    """
+    Streams the records of a CSV or JSON Lines file
+
+    Yields:
+        tuple: (line number, record dict or None, error message or None)
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        if not reader.fieldnames:
+            raise ImportFormatError('The CSV file has no header row')
+        for record in reader:
+            yield reader.line_num, record, None
+        return
+
+    for line, text in enumerate(stream, start=1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError as e:
+            yield line, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield line, None, 'Each line must be a JSON object'
+            continue
+        yield line, record, None
+
+def _formdata(values):
+    return MultiDict({name: '' if value is None else str(value) for name, value in values.items()})
+
+def _form_errors(form, prefix=''):
+    return '; '.join(
+        f"{prefix}{name}: {error}"
+        for name, errors in form.errors.items()
+        for error in errors
+    )
+
+
+class RowValidator:
+    """
+    Validates import rows with the CustomerForm, InvoiceForm and InvoiceItemForm rules
+
+    Binding a form's fields costs far more than validating them, so one
+    instance of each form is built per import and re-processed for every
+    row. Customer results are memoized, as invoice files repeat the same
+    few customers on every row.
+    """
+
+    # Fields the importer computes or resolves itself
+    COMPUTED_INVOICE_FIELDS = ('customer_id', 'subtotal', 'tax_amount', 'total', 'items')
+    MAX_CACHED_CUSTOMERS = 10000
+
+    def __init__(self):
+        self.customer_form = CustomerForm(formdata=None, meta={'csrf': False})
+        self.invoice_form = InvoiceForm(formdata=None, meta={'csrf': False})
+        for name in self.COMPUTED_INVOICE_FIELDS:
+            delattr(self.invoice_form, name)
+        self.item_form = InvoiceItemForm(formdata=None, meta={'csrf': False})
+        self.customers = {}
+
+    def customer(self, record):
+        """
+        Returns:
+            tuple: (customer values, None) or (None, error message)
+        """
+        values = {name: (record.get(name) or '').strip() for name in CUSTOMER_FIELDS}
+        key = tuple(values.values())
+        if key not in self.customers:
+            form = self.customer_form
+            form.process(_formdata(values))
+            if form.validate():
+                outcome = {name: values[name] or None for name in CUSTOMER_FIELDS}, None
+            else:
+                outcome = None, _form_errors(form)
+            if len(self.customers) >= self.MAX_CACHED_CUSTOMERS:
+                self.customers.clear()
+            self.customers[key] = outcome
+        return self.customers[key]
+
+    def invoice(self, invoice):
+        """
+        Checks an invoice record and its items
+
+        Totals are computed from the items instead of being trusted and the
+        customer is matched by name when writing, so those fields are left
+        out of the invoice form.
+
+        Returns:
+            tuple: (values dict, None) or (None, error message)
+        """
+        items = invoice.get('items') or []
+        if not items:
+            return None, 'An invoice needs at least one item'
+
+        try:
+            tax_rate = to_decimal(invoice.get('tax_rate') or 0, RATE_SCALE)
+        except ValueError as e:
+            return None, f"tax_rate: {e}"
+
+        values = {name: invoice.get(name) for name in INVOICE_FIELDS}
+        values['status'] = values['status'] or 'Unpaid'
+        values['tax_rate'] = tax_rate
+        # A missing number is allocated when the batch is written
+        invoice_number = (values['invoice_number'] or '').strip() or None
+        values['invoice_number'] = invoice_number or NUMBER_PLACEHOLDER
+        form = self.invoice_form
+        form.process(_formdata(values))
+        if not form.validate():
+            return None, _form_errors(form)
+
+        rows = []
+        item_form = self.item_form
+        for index, item in enumerate(items):
+            # The amount is computed, only a given one has to be a valid number
+            given = {name: value for name, value in item.items() if name != 'amount' or value not in (None, '')}
+            item_form.process(_formdata(given))
+            item_form.amount.data = Decimal(1)
+            if not item_form.validate():
+                return None, _form_errors(item_form, f"items-{index}-")
+            quantity = to_decimal(item_form.quantity.data, QUANTITY_SCALE)
+            unit_price = to_decimal(item_form.unit_price.data)
+            rows.append({
+                'description': item_form.description.data,
+                'quantity': quantity,
+                'unit_price': unit_price,
+                'amount': line_amount(quantity, unit_price),
+            })
+
+        customer, error = self.customer({
+            'name': invoice.get('customer_name'),
+            'email': invoice.get('customer_email'),
+        })
+        if error:
+            return None, f"customer {error}"
+
+        # Paid invoices without a payment date count as paid on their due date
+        paid_at = None
+        if form.status.data == 'Paid':
+            try:
+                paid_at = _parse_paid_at(invoice.get('paid_at'), form.date_due.data)
+            except ValueError:
+                return None, 'paid_at: Not a valid date'
+
+        subtotal, tax_amount, total = invoice_totals((row['amount'] for row in rows), tax_rate)
+        return {
+            'invoice': {
+                'invoice_number': invoice_number,
+                'date_issued': form.date_issued.data,
+                'date_due': form.date_due.data,
+                'status': form.status.data,
+                'paid_at': paid_at,
+                'tax_rate': tax_rate,
+                'notes': form.notes.data or None,
+                'subtotal': subtotal,
+                'tax_amount': tax_amount,
+                'total': total,
+            },
+            'items': rows,
+            'customer': customer,
+        }, None
+
+def _parse_paid_at(value, date_due):
+    """Reads an ISO date or date and time, falling back to the due date when empty"""
+    value = (value or '').strip() if isinstance(value, str) else value
+    if not value:
+        return datetime.combine(date_due, datetime.min.time())
+    return datetime.fromisoformat(str(value))
+
+def _group_key(record):
+    """Returns the key of the invoice an item row belongs to, or None for a row of its own"""
+    for name in ('invoice_ref', 'invoice_number'):
+        value = record.get(name)
+        value = value.strip() if isinstance(value, str) else value
+        if value not in (None, ''):
+            return name, value
+    return None
+
+def _group_invoices(records, result):
+    """
+    Turns records into invoices with their items
+
+    A JSON record may carry its items in an "items" list. Otherwise every
+    record is one item row with item_* columns, and consecutive rows with
+    the same invoice_ref, or without one the same invoice_number, belong
+    to the same invoice. A row with neither is an invoice of its own.
+
+    Yields:
+        tuple: (line number of the first row, invoice dict)
+    """
+    current, current_line, current_key = None, None, None
+    for line, record, error in records:
+        if error:
+            result.add_error(line, error)
+            continue
+
+        if isinstance(record.get('items'), list):
+            if current:
+                yield current_line, current
+                current = None
+            yield line, record
+            continue
+
+        item = {name: record.get(f'item_{name}') for name in ITEM_FIELDS}
+        key = _group_key(record)
+        if current is None or key is None or key != current_key:
+            if current:
+                yield current_line, current
+            current = {name: value for name, value in record.items() if not name.startswith('item_')}
+            current['items'] = []
+            current_line, current_key = line, key
+        current['items'].append(item)
+
+    if current:
+        yield current_line, current
+
+def _write_customer_batch(user_id, batch, result):
+    names = [customer['name'] for _, customer in batch]
+    existing = set(db.session.scalars(
+        select(Customer.name).where(Customer.user_id == user_id, Customer.name.in_(names))
+    ))
+
+    rows = []
+    for line, customer in batch:
+        if customer['name'] in existing:
+            result.skipped += 1
+            continue
+        existing.add(customer['name'])
+        rows.append(dict(customer, user_id=user_id))
+
+    try:
+        if rows:
+            customer_ids = db.session.scalars(insert(Customer).returning(Customer.id), rows).all()
+            search.index_customers(customer_ids)
+            page_cache.bump_data_version(db.session.connection(), [user_id])
+        db.session.commit()
+        result.created += len(rows)
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        for line, _ in batch:
+            result.add_error(line, f"Database error: {e.__class__.__name__}")
+
+def _resolve_customers(user_id, customers):
+    """Maps customer names to ids, creating the missing customers"""
+    names = list({customer['name']: None for customer in customers})
+    ids = {}
+    for customer_id, name in db.session.execute(
+        select(Customer.id, Customer.name)
+        .where(Customer.user_id == user_id, Customer.name.in_(names))
+        .order_by(Customer.id.desc())
+    ):
+        ids[name] = customer_id
+
+    missing = {}
+    for customer in customers:
+        if customer['name'] not in ids:
+            missing.setdefault(customer['name'], dict(customer, user_id=user_id))
+    if missing:
+        created = db.session.execute(
+            insert(Customer).returning(Customer.id, Customer.name, sort_by_parameter_order=True),
+            list(missing.values())
+        )
+        created_ids = {name: customer_id for customer_id, name in created}
+        ids.update(created_ids)
+        search.index_customers(created_ids.values())
+    return ids, len(missing)
+
+def _write_invoice_batch(user_id, batch, result):
+    numbers = [invoice['invoice']['invoice_number'] for _, invoice in batch if invoice['invoice']['invoice_number']]
+    taken = set(db.session.scalars(
+        select(Invoice.invoice_number).where(Invoice.user_id == user_id, Invoice.invoice_number.in_(numbers))
+    ))
+
+    accepted = []
+    for line, invoice in batch:
+        number = invoice['invoice']['invoice_number']
+        if number is not None:
+            if number in taken:
+                result.add_error(line, f"Invoice number {number} already exists")
+                continue
+            taken.add(number)
+        accepted.append((line, invoice))
+    if not accepted:
+        return
+
+    try:
+        # Numbered invoices move the sequences past their numbers, the others
+        # take one block per period of their issue date, like generated
+        # recurring invoices; a rollback of the batch returns the blocks
+        invoices = [invoice['invoice'] for _, invoice in accepted]
+        numbering.note_used_numbers(user_id, [row['invoice_number'] for row in invoices if row['invoice_number']])
+        by_period = {}
+        for row in invoices:
+            if row['invoice_number'] is None:
+                by_period.setdefault(numbering.current_period(row['date_issued']), []).append(row)
+        for period, rows in sorted(by_period.items()):
+            for row, number in zip(rows, numbering.reserve_block(user_id, len(rows), period)):
+                row['invoice_number'] = number
+
+        customer_ids, customers_created = _resolve_customers(
+            user_id, [invoice['customer'] for _, invoice in accepted]
+        )
+        invoice_ids = db.session.scalars(
+            insert(Invoice).returning(Invoice.id, sort_by_parameter_order=True),
+            [
+                dict(invoice['invoice'], user_id=user_id, customer_id=customer_ids[invoice['customer']['name']])
+                for _, invoice in accepted
+            ]
+        ).all()
+
+        items = [
+            dict(item, invoice_id=invoice_id)
+            for invoice_id, (_, invoice) in zip(invoice_ids, accepted)
+            for item in invoice['items']
+        ]
+        db.session.execute(insert(InvoiceItem), items)
+        search.index_invoices(invoice_ids)
+
+        # Bulk inserts bypass the flush listeners, keep the summary and rollup tables in step
+        deltas = {}
+        rollup_deltas = {}
+        for _, invoice in accepted:
+            delta = deltas.setdefault((user_id, invoice['invoice']['status']), [0, ZERO])
+            delta[0] += 1
+            delta[1] += invoice['invoice']['total']
+            analytics.add_invoice(rollup_deltas, 1, dict(
+                invoice['invoice'], user_id=user_id, customer_id=customer_ids[invoice['customer']['name']]
+            ))
+        apply_stats_deltas(db.session.connection(), deltas)
+        analytics.apply_rollup_deltas(db.session.connection(), rollup_deltas)
+        page_cache.bump_data_version(db.session.connection(), [user_id])
+
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        for line, _ in accepted:
+            result.add_error(line, f"Database error: {e.__class__.__name__}")
+        return
+
+    result.created += len(accepted)
+    result.items_created += len(items)
+    result.customers_created += customers_created
+
+def import_customers(user_id, stream, fmt, batch_size=1000):
+    """
+    Imports customers from a CSV or JSON Lines stream
+
+    Columns: name, email, address, phone. Rows are validated with
+    CustomerForm and inserted in executemany batches, one transaction per
+    batch. A customer whose name already exists is skipped.
+
+    Args:
+        user_id: ID of the owning user
+        stream: Text stream of the file
+        fmt: 'csv' or 'jsonl'
+        batch_size: Rows per insert batch
+
+    Returns:
+        ImportResult: Counts and per row errors
+    """
+    result = ImportResult('customers')
+    validator = RowValidator()
+    batch = []
+    for line, record, error in read_records(stream, fmt):
+        if error is None:
+            customer, error = validator.customer(record)
+        if error:
+            result.add_error(line, error)
+            continue
+        batch.append((line, customer))
+        if len(batch) >= batch_size:
+            _write_customer_batch(user_id, batch, result)
+            batch = []
+    if batch:
+        _write_customer_batch(user_id, batch, result)
+    return result
+
+def import_invoices(user_id, stream, fmt, batch_size=500):
+    """
+    Imports invoices with their items from a CSV or JSON Lines stream
+
+    Each record is either one item row (invoice columns plus item_description,
+    item_quantity, item_unit_price and item_amount, consecutive rows sharing
+    an invoice_ref or, without one, an invoice_number) or, in JSON Lines, a
+    whole invoice with an "items" list. A row without either is a one item
+    invoice. Customers are matched by customer_name and created when
+    missing. Invoices without an invoice_number get the next numbers of the
+    sequence of their issue date's period, reserved as one block per period
+    and batch. Paid invoices may give the
+    payment date in paid_at, their due date is used otherwise.
+
+    Invoices are validated with the InvoiceForm rules, line amounts and
+    totals recomputed from quantities and prices (a given item_amount only
+    has to be a number), and written in batches: one executemany
+    INSERT ... RETURNING for the invoices and one executemany INSERT for
+    their items per transaction. Invalid rows are reported and skipped
+    without affecting the rest of their batch. Memory use is bounded by
+    the batch size, not the file size.
+
+    Args:
+        user_id: ID of the owning user
+        stream: Text stream of the file
+        fmt: 'csv' or 'jsonl'
+        batch_size: Invoices per insert batch
+
+    Returns:
+        ImportResult: Counts and per row errors
+    """
+    result = ImportResult('invoices')
+    validator = RowValidator()
+    batch = []
+    for line, invoice in _group_invoices(read_records(stream, fmt), result):
+        values, error = validator.invoice(invoice)
+        if error:
+            result.add_error(line, error)
+            continue
+        batch.append((line, values))
+        if len(batch) >= batch_size:
+            _write_invoice_batch(user_id, batch, result)
+            batch = []
+    if batch:
+        _write_invoice_batch(user_id, batch, result)
+    return result
+
+IMPORTERS = {
+    'customers': import_customers,
+    'invoices': import_invoices,
+}
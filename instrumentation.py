@@ -0,0 +1,353 @@
+import hmac
+import ipaddress
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from flask import Response, abort, g, has_app_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds in seconds of the request duration histogram
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Timed sections of a request besides SQL, reported as <name>_seconds_total
+SECTIONS = ('template', 'pdf')
+
+# Frames kept per sampled stack, the innermost ones are dropped beyond this
+MAX_STACK_DEPTH = 64
+
+@dataclass
+class RequestTimings:
+    """Time spent by one request, kept on flask.g while it runs"""
+    started: float = field(default_factory=time.perf_counter)
+    sql_count: int = 0
+    sql_seconds: float = 0.0
+    sections: dict = field(default_factory=lambda: dict.fromkeys(SECTIONS, 0.0))
+    section_starts: list = field(default_factory=list)
+    recorded: bool = False
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+def _current_timings():
+    if not has_app_context():
+        return None
+    return g.get('_request_timings')
+
+@contextmanager
+def timed(section):
+    """
+    Adds the time spent in the block to a section of the current request
+
+    Does nothing outside an instrumented request, so it can wrap code
+    that also runs in workers and CLI commands.
+    """
+    timings = _current_timings()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.sections[section] += time.perf_counter() - start
+
+# SQL timing, for every engine of the process
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_query_starts', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('_query_starts')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    timings = _current_timings()
+    if timings is not None:
+        timings.sql_count += 1
+        timings.sql_seconds += elapsed
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute, drop its start time
+    starts = context.connection.info.get('_query_starts') if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+# Template timing through Flask's render signals
+
+def _before_render(sender, template, context, **extra):
+    timings = _current_timings()
+    if timings is not None:
+        timings.section_starts.append(time.perf_counter())
+
+def _after_render(sender, template, context, **extra):
+    timings = _current_timings()
+    if timings is not None and timings.section_starts:
+        timings.sections['template'] += time.perf_counter() - timings.section_starts.pop()
+
+class RouteMetrics:
+    """
+    Per-route totals and a request duration histogram of this process
+
+    Each worker process keeps its own figures; Prometheus adds them up
+    when every worker is scraped, or sees one worker's share otherwise.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def record(self, endpoint, method, status, timings, duration):
+        with self.lock:
+            route = self.routes.get((endpoint, method))
+            if route is None:
+                route = self.routes[(endpoint, method)] = {
+                    'statuses': Counter(),
+                    'buckets': [0] * len(self.buckets),
+                    'seconds': 0.0,
+                    'sql_count': 0,
+                    'sql_seconds': 0.0,
+                    'sections': dict.fromkeys(SECTIONS, 0.0),
+                }
+            route['statuses'][status] += 1
+            for index, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    route['buckets'][index] += 1
+            route['seconds'] += duration
+            route['sql_count'] += timings.sql_count
+            route['sql_seconds'] += timings.sql_seconds
+            for name, seconds in timings.sections.items():
+                route['sections'][name] += seconds
+
+    def render(self, prefix='invoice'):
+        """Returns the figures in the Prometheus text exposition format"""
+        with self.lock:
+            routes = sorted(self.routes.items())
+            lines = []
+
+            def family(name, kind, help_text):
+                lines.append(f"# HELP {prefix}_{name} {help_text}")
+                lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+            family('http_requests_total', 'counter', 'Requests handled, by route and status code.')
+            for (endpoint, method), route in routes:
+                for status, count in sorted(route['statuses'].items()):
+                    lines.append(
+                        f'{prefix}_http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}'
+                    )
+
+            family('http_request_duration_seconds', 'histogram', 'Wall time of requests, by route.')
+            for (endpoint, method), route in routes:
+                labels = f'endpoint="{endpoint}",method="{method}"'
+                for bound, count in zip(self.buckets, route['buckets']):
+                    lines.append(f'{prefix}_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                total = sum(route['statuses'].values())
+                lines.append(f'{prefix}_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {total}')
+                lines.append(f"{prefix}_http_request_duration_seconds_sum{{{labels}}} {route['seconds']:.6f}")
+                lines.append(f"{prefix}_http_request_duration_seconds_count{{{labels}}} {total}")
+
+            family('sql_queries_total', 'counter', 'SQL statements executed by requests, by route.')
+            for (endpoint, method), route in routes:
+                lines.append(f'{prefix}_sql_queries_total{{endpoint="{endpoint}",method="{method}"}} {route["sql_count"]}')
+
+            family('sql_seconds_total', 'counter', 'Time spent executing SQL during requests, by route.')
+            for (endpoint, method), route in routes:
+                lines.append(f'{prefix}_sql_seconds_total{{endpoint="{endpoint}",method="{method}"}} {route["sql_seconds"]:.6f}')
+
+            for name in SECTIONS:
+                family(f'{name}_seconds_total', 'counter', f'Time spent in {name} rendering during requests, by route.')
+                for (endpoint, method), route in routes:
+                    lines.append(
+                        f'{prefix}_{name}_seconds_total{{endpoint="{endpoint}",method="{method}"}} {route["sections"][name]:.6f}'
+                    )
+            return '\n'.join(lines) + '\n'
+
+class SamplingProfiler:
+    """
+    Samples the stacks of threads serving requests from one background thread
+
+    A request thread registers itself, the sampler records its stack every
+    `interval` seconds, and the request collects the counts when it ends.
+    Threads that are not registered cost nothing.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}
+        self.thread = None
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[_collapse(frame)] += 1
+
+    def start(self):
+        """Registers the calling thread, returns the Counter its samples go to"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+                self.thread.start()
+            samples = self.active[threading.get_ident()] = Counter()
+        return samples
+
+    def stop(self):
+        with self.lock:
+            return self.active.pop(threading.get_ident(), Counter())
+
+def _collapse(frame):
+    """Formats a stack as root;...;leaf, the collapsed format read by flame graph tools"""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def write_profile(directory, endpoint, duration, samples):
+    """
+    Writes collapsed stack samples of a slow request
+
+    Returns:
+        str: Path of the written file
+    """
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    path = os.path.join(directory, f"{stamp}-{endpoint}-{int(duration * 1000)}ms.folded")
+    with open(path, 'w') as profile_file:
+        for stack, count in samples.most_common():
+            profile_file.write(f"{stack} {count}\n")
+    return path
+
+def server_timing(timings, duration):
+    """Formats the Server-Timing header value of a request"""
+    entries = [
+        f"app;dur={duration * 1000:.1f}",
+        f'sql;dur={timings.sql_seconds * 1000:.1f};desc="{timings.sql_count} queries"',
+    ]
+    for name in SECTIONS:
+        if timings.sections[name]:
+            entries.append(f"{name};dur={timings.sections[name] * 1000:.1f}")
+    return ', '.join(entries)
+
+def parse_networks(value):
+    """
+    Reads a comma separated list of addresses and networks
+
+    Raises:
+        ValueError: If an entry is not an IP address or network
+    """
+    return [ipaddress.ip_network(entry.strip(), strict=False) for entry in value.split(',') if entry.strip()]
+
+def metrics_allowed(token, networks):
+    """
+    Tells whether the current request may read the metrics
+
+    The request needs the bearer token or a remote address inside one of
+    the networks. Only the address of the direct peer counts, not the one
+    ProxyFix took from X-Forwarded-For, so behind a reverse proxy the
+    allowlist admits everything the proxy forwards; use the token there.
+    """
+    if token:
+        scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(given.encode(), token.encode()):
+            return True
+    peer = request.environ.get('werkzeug.proxy_fix.orig', {}).get('REMOTE_ADDR', request.remote_addr)
+    try:
+        address = ipaddress.ip_address(peer or '')
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+def init_app(app):
+    """
+    Instruments every request of an app
+
+    Records wall time, SQL statement count and time, template rendering
+    time and PDF rendering time per route. They are exposed in the
+    Prometheus text format at INSTRUMENTATION_METRICS_PATH, to requests
+    with INSTRUMENTATION_METRICS_TOKEN or from INSTRUMENTATION_METRICS_ALLOW
+    (403 for others), and, with
+    INSTRUMENTATION_SERVER_TIMING, as a Server-Timing header on each
+    response. With PROFILE_SLOW_REQUEST_MS above 0, request threads are
+    sampled every PROFILE_SAMPLE_INTERVAL_MS and requests slower than
+    the threshold write their collapsed stacks to PROFILE_DIR.
+
+    Returns:
+        RouteMetrics: The figures collected for the app
+    """
+    metrics = RouteMetrics()
+    profile_threshold = app.config['PROFILE_SLOW_REQUEST_MS'] / 1000
+    profiler = SamplingProfiler(app.config['PROFILE_SAMPLE_INTERVAL_MS'] / 1000) if profile_threshold > 0 else None
+    metrics_path = app.config['INSTRUMENTATION_METRICS_PATH']
+    metrics_token = app.config['INSTRUMENTATION_METRICS_TOKEN']
+    metrics_networks = parse_networks(app.config['INSTRUMENTATION_METRICS_ALLOW'])
+    if not metrics_token and not metrics_networks:
+        logging.warning(f"Neither INSTRUMENTATION_METRICS_TOKEN nor INSTRUMENTATION_METRICS_ALLOW is set, {metrics_path} refuses every request")
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    def finish(status):
+        """Records the request once, returns (timings, duration) or None"""
+        timings = g.pop('_request_timings', None)
+        if timings is None:
+            return None
+        duration = timings.elapsed()
+        endpoint = request.endpoint or 'unmatched'
+        metrics.record(endpoint, request.method, status, timings, duration)
+
+        if profiler is not None:
+            samples = profiler.stop()
+            if duration >= profile_threshold and samples:
+                path = write_profile(app.config['PROFILE_DIR'], endpoint, duration, samples)
+                logging.warning(f"Slow request {request.method} {request.path} took {duration * 1000:.0f} ms, profile in {path}")
+        return timings, duration
+
+    @app.before_request
+    def start_request_timing():
+        if request.path == metrics_path:
+            return
+        g._request_timings = RequestTimings()
+        if profiler is not None:
+            profiler.start()
+
+    @app.after_request
+    def add_server_timing(response):
+        finished = finish(response.status_code)
+        if finished is not None and app.config['INSTRUMENTATION_SERVER_TIMING']:
+            response.headers['Server-Timing'] = server_timing(*finished)
+        return response
+
+    @app.teardown_request
+    def finish_failed_request(exc):
+        # after_request does not run when a view raises
+        finish(500)
+        if profiler is not None:
+            profiler.stop()
+
+    @app.route(metrics_path, endpoint='metrics')
+    def metrics_endpoint():
+        if not metrics_allowed(metrics_token, metrics_networks):
+            abort(403)
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    return metrics
@@ -0,0 +1,112 @@
+from sqlalchemy import delete, insert, select, update
+from app import db
+from app import InvoiceItem
+from money import QUANTITY_SCALE, line_amount, to_decimal
+import search
+
+ITEM_FIELDS = ('description', 'quantity', 'unit_price', 'amount')
+
+def parse_item_rows(form):
+    """
+    Reads the items-{index}-{field} rows of a submitted invoice form
+
+    Rows keep the order of their index. Rows with an empty description are
+    skipped, and items-{index}-id carries the id of an existing item. The
+    amount of each row is computed from its quantity and unit price, the
+    posted amount is ignored.
+
+    Args:
+        form: Submitted form data (request.form)
+
+    Returns:
+        list: Dicts with id (None for new rows), description, quantity, unit_price and amount
+    """
+    indices = set()
+    for key in form.keys():
+        # Format: items-{index}-description
+        parts = key.split('-')
+        if len(parts) == 3 and parts[0] == 'items' and parts[2] == 'description':
+            indices.add(parts[1])
+
+    rows = []
+    for idx in sorted(indices, key=lambda value: int(value) if value.isdigit() else value):
+        description = form.get(f'items-{idx}-description', '')
+        if not description.strip():
+            continue
+
+        item_id = form.get(f'items-{idx}-id', '')
+        quantity = to_decimal(form.get(f'items-{idx}-quantity') or '0', QUANTITY_SCALE)
+        unit_price = to_decimal(form.get(f'items-{idx}-unit_price') or '0')
+        rows.append({
+            'id': int(item_id) if item_id.strip() else None,
+            'description': description,
+            'quantity': quantity,
+            'unit_price': unit_price,
+            'amount': line_amount(quantity, unit_price),
+        })
+    return rows
+
+def _insert_rows(invoice_id, rows):
+    if rows:
+        db.session.execute(
+            insert(InvoiceItem),
+            [dict({field: row[field] for field in ITEM_FIELDS}, invoice_id=invoice_id) for row in rows]
+        )
+
+def insert_items(invoice_id, rows):
+    """Inserts item rows for an invoice with one executemany statement"""
+    if rows:
+        _insert_rows(invoice_id, rows)
+        # Core inserts bypass the flush listener of the search index
+        search.index_invoices([invoice_id])
+
+def sync_invoice_items(invoice_id, rows):
+    """
+    Brings the stored items of an invoice in line with the submitted rows
+
+    Submitted rows are matched to stored items by id. Only the differences
+    are written: changed items in one executemany UPDATE, new rows in one
+    executemany INSERT and removed items in one DELETE. Unchanged items keep
+    their row untouched, including id and created_at. An id that does not
+    belong to this invoice is treated as a new row.
+
+    Args:
+        invoice_id: ID of the invoice
+        rows: Rows from parse_item_rows()
+
+    Returns:
+        tuple: (inserted, updated, deleted) counts
+    """
+    stored = {
+        row.id: row
+        for row in db.session.execute(
+            select(InvoiceItem.id, *(getattr(InvoiceItem, field) for field in ITEM_FIELDS))
+            .where(InvoiceItem.invoice_id == invoice_id)
+        )
+    }
+
+    inserts, updates, kept = [], [], set()
+    for row in rows:
+        current = stored.get(row['id'])
+        if current is None or row['id'] in kept:
+            inserts.append(row)
+            continue
+        kept.add(row['id'])
+        if any(getattr(current, field) != row[field] for field in ITEM_FIELDS):
+            updates.append({'id': row['id'], **{field: row[field] for field in ITEM_FIELDS}})
+
+    removed = [item_id for item_id in stored if item_id not in kept]
+
+    if updates:
+        # ORM bulk UPDATE by primary key, sent as one executemany
+        db.session.execute(update(InvoiceItem), updates)
+    _insert_rows(invoice_id, inserts)
+    if removed:
+        db.session.execute(
+            delete(InvoiceItem)
+            .where(InvoiceItem.invoice_id == invoice_id, InvoiceItem.id.in_(removed))
+            .execution_options(synchronize_session=False)
+        )
+    if inserts or updates or removed:
+        search.index_invoices([invoice_id])
+    return len(inserts), len(updates), len(removed)
@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from sqlalchemy import select
+from app import app, db
+from app import Customer, Invoice
+import numbering
+import scratch
+
+def _seed_user():
+    """Creates a throwaway user with one customer"""
+    user = scratch.create_scratch_user(scratch.scratch_username('numbering-load-test'))
+    customer = Customer(name='Load Test Customer', email='customer@example.invalid', user_id=user.id)
+    db.session.add(customer)
+    db.session.commit()
+    return user.id, customer.id
+
+def _create_invoices(user_id, customer_id, count):
+    """Posts `count` invoices, each with the number the form would suggest"""
+    client = scratch.logged_in_client(user_id)
+
+    today = date.today()
+    for _ in range(count):
+        with app.app_context():
+            client.get('/create_invoice')
+        with client.session_transaction() as session:
+            suggested = session['invoice_number_previews'][-1]
+        with app.app_context():
+            client.post('/create_invoice', data={
+                'invoice_number': suggested,
+                'date_issued': today.isoformat(),
+                'date_due': (today + timedelta(days=30)).isoformat(),
+                'customer_id': str(customer_id),
+                'status': 'Unpaid',
+                'tax_rate': '0',
+                'items-0-description': 'Load test',
+                'items-0-quantity': '1',
+                'items-0-unit_price': '10.00',
+            })
+
+def _reserve_blocks(user_id, count, block_size):
+    """Reserves blocks of numbers, giving every other block back with a rollback"""
+    reserved = []
+    for index in range(count):
+        with app.app_context():
+            numbers = numbering.reserve_block(user_id, block_size)
+            if index % 2:
+                db.session.rollback()
+            else:
+                db.session.commit()
+                reserved.extend(numbers)
+    return reserved
+
+def check_number_allocation(workers=8, invoices_per_worker=10, blocks_per_worker=5, block_size=3):
+    """
+    Allocates invoice numbers from parallel threads and checks the result
+
+    Half of the workers post invoices through /create_invoice, all of them
+    with the number the form suggests at that moment, the other half
+    reserve blocks of numbers directly and roll every other block back.
+    The numbers that ended up on invoices or in committed blocks must be
+    exactly 1..N of the period: no duplicates and no gaps. The data is
+    created for a throwaway user and deleted afterwards, the check refuses
+    to run outside a scratch database.
+
+    Args:
+        workers: Number of parallel threads
+        invoices_per_worker: Invoices posted by each invoice thread
+        blocks_per_worker: Blocks reserved by each block thread
+        block_size: Numbers per reserved block
+
+    Returns:
+        list: Failure messages, empty when the allocation was consistent
+
+    Raises:
+        scratch.ScratchDatabaseError: If the database has real users
+    """
+    scratch.require_scratch_database()
+    user_id, customer_id = _seed_user()
+    period = numbering.current_period()
+
+    try:
+        with scratch.harness_config(), ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_create_invoices, user_id, customer_id, invoices_per_worker) if index % 2 == 0
+                else executor.submit(_reserve_blocks, user_id, blocks_per_worker, block_size)
+                for index in range(workers)
+            ]
+            reserved = [number for future in futures for number in (future.result() or [])]
+
+        invoiced = list(db.session.scalars(select(Invoice.invoice_number).where(Invoice.user_id == user_id)))
+        expected_invoices = sum(invoices_per_worker for index in range(workers) if index % 2 == 0)
+        numbers = invoiced + reserved
+
+        failures = []
+        if len(invoiced) != expected_invoices:
+            failures.append(f"{expected_invoices - len(invoiced)} of {expected_invoices} invoices were not created")
+        duplicates = sorted({number for number in numbers if numbers.count(number) > 1})
+        if duplicates:
+            failures.append(f"Duplicate numbers: {', '.join(duplicates)}")
+        expected = {numbering.format_number(period, value) for value in range(1, len(numbers) + 1)}
+        missing = sorted(expected - set(numbers))
+        if missing:
+            failures.append(f"Gaps in the sequence: {', '.join(missing)}")
+        unexpected = sorted(set(numbers) - expected)
+        if unexpected:
+            failures.append(f"Numbers outside the sequence: {', '.join(unexpected)}")
+        return failures
+    finally:
+        db.session.rollback()
+        scratch.delete_user_data(user_id)
@@ -0,0 +1,290 @@
+import logging
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+from flask_mail import Message
+from sqlalchemy import select, update
+from app import app, db, mail
+from app import Invoice, OutboundEmail
+from pdf_cache import cached_pdf
+
+# Message states stored in OutboundEmail.status
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+def invoice_email_body(invoice, sender_name):
+    """Returns the plain text body of the email that carries an invoice"""
+    return f"""
+Dear {invoice.customer.name},
+
+Please find attached your invoice {invoice.invoice_number} for the amount of ${invoice.total:.2f}.
+
+Due date: {invoice.date_due.strftime('%B %d, %Y')}
+
+Thank you for your business.
+
+Best regards,
+{sender_name}
+"""
+
+def enqueue_invoice_email(invoice, sender_name, commit=True):
+    """
+    Queues the email that sends an invoice PDF to its customer
+
+    Args:
+        invoice: The Invoice object, its customer must have an email address
+        sender_name: Business or user name shown in the subject and signature
+        commit: Commit the session after queueing
+
+    Returns:
+        OutboundEmail: The queued message
+    """
+    email = OutboundEmail(
+        status=QUEUED,
+        subject=f"Invoice {invoice.invoice_number} from {sender_name}",
+        sender=app.config.get('MAIL_DEFAULT_SENDER'),
+        recipients=invoice.customer.email,
+        body=invoice_email_body(invoice, sender_name),
+        attach_invoice_pdf=True,
+        next_attempt_at=datetime.utcnow(),
+        user_id=invoice.user_id,
+        invoice_id=invoice.id
+    )
+    db.session.add(email)
+    invoice.email_status = QUEUED
+    if commit:
+        db.session.commit()
+    return email
+
+def build_message(email, pdf=None):
+    """
+    Turns a queued row into a Flask-Mail message
+
+    Args:
+        email: The OutboundEmail object
+        pdf: Already rendered PDF bytes, rendered from the cache when None
+
+    Returns:
+        Message: Message ready to be sent
+    """
+    message = Message(
+        subject=email.subject,
+        sender=email.sender,
+        recipients=[address.strip() for address in email.recipients.split(',') if address.strip()],
+        body=email.body
+    )
+    if email.attach_invoice_pdf and email.invoice is not None:
+        if pdf is None:
+            pdf = cached_pdf(email.invoice)
+        message.attach(f"Invoice-{email.invoice.invoice_number}.pdf", "application/pdf", pdf)
+    return message
+
+def claim_emails(limit, campaign_id=None):
+    """
+    Marks up to `limit` due messages as sending for this worker
+
+    While a message is sending, next_attempt_at holds the time it was
+    claimed so that requeue_stale_emails can spot abandoned messages.
+
+    Args:
+        limit: Maximum number of messages to claim
+        campaign_id: Claim messages of this campaign; without one only
+            messages outside campaigns are claimed, campaigns are sent by
+            campaigns.run_campaign with pipelined rendering
+
+    Returns:
+        list: IDs of the claimed messages, oldest first
+    """
+    now = datetime.utcnow()
+    query = select(OutboundEmail.id).where(
+        OutboundEmail.status == QUEUED, OutboundEmail.next_attempt_at <= now,
+        OutboundEmail.campaign_id == campaign_id if campaign_id is not None else OutboundEmail.campaign_id.is_(None)
+    )
+    candidates = db.session.scalars(
+        query.order_by(OutboundEmail.next_attempt_at, OutboundEmail.id).limit(limit)
+    ).all()
+
+    claimed = []
+    for email_id in candidates:
+        result = db.session.execute(
+            update(OutboundEmail)
+            .where(OutboundEmail.id == email_id, OutboundEmail.status == QUEUED)
+            .values(status=SENDING, attempts=OutboundEmail.attempts + 1, next_attempt_at=now)
+        )
+        if result.rowcount == 1:
+            claimed.append(email_id)
+    db.session.commit()
+    return claimed
+
+def requeue_stale_emails(campaign_id=None):
+    """
+    Puts messages back in the queue when the worker sending them died
+
+    A message counts as abandoned once it was claimed more than
+    MAIL_QUEUE_SEND_TIMEOUT seconds ago, so messages a live worker is still
+    sending stay where they are.
+
+    Args:
+        campaign_id: Only requeue messages of this campaign
+
+    Returns:
+        int: Number of requeued messages
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['MAIL_QUEUE_SEND_TIMEOUT'])
+    query = update(OutboundEmail).where(OutboundEmail.status == SENDING, OutboundEmail.next_attempt_at < cutoff)
+    if campaign_id is not None:
+        query = query.where(OutboundEmail.campaign_id == campaign_id)
+    requeued = db.session.execute(query.values(status=QUEUED)).rowcount
+    db.session.commit()
+    return requeued
+
+def _mark_invoice(email, status, when=None):
+    if email.invoice_id is None:
+        return
+    values = {'email_status': status}
+    if when is not None:
+        values['emailed_at'] = when
+    db.session.execute(update(Invoice).where(Invoice.id == email.invoice_id).values(**values))
+
+def record_success(email):
+    """Marks a message and its invoice as sent"""
+    now = datetime.utcnow()
+    email.status = SENT
+    email.sent_at = now
+    email.last_error = None
+    _mark_invoice(email, SENT, now)
+
+def record_failure(email, error):
+    """
+    Schedules a retry with exponential backoff, or gives up after
+    MAIL_QUEUE_MAX_ATTEMPTS attempts
+    """
+    email.last_error = str(error)
+    if email.attempts >= app.config['MAIL_QUEUE_MAX_ATTEMPTS']:
+        email.status = FAILED
+        _mark_invoice(email, FAILED)
+        return
+    delay = app.config['MAIL_QUEUE_RETRY_DELAY'] * 2 ** (email.attempts - 1)
+    email.status = QUEUED
+    email.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+
+class PooledConnection:
+    """
+    Long-lived SMTP connection shared by consecutive batches
+
+    The connection is opened on first use, reopened when the server drops
+    it and closed after MAIL_CONNECTION_IDLE_TIMEOUT seconds without mail.
+    Flask-Mail itself reconnects after MAIL_MAX_EMAILS messages.
+    """
+
+    def __init__(self):
+        self._connection = None
+        self._last_used = 0.0
+
+    def send(self, message):
+        if self._connection is None:
+            self._connection = mail.connect().__enter__()
+        try:
+            self._connection.send(message)
+        except smtplib.SMTPServerDisconnected:
+            # The server closed an idle connection, retry once on a fresh one
+            self._connection = mail.connect().__enter__()
+            self._connection.send(message)
+        self._last_used = time.monotonic()
+
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.__exit__(None, None, None)
+            except smtplib.SMTPException:
+                pass
+            self._connection = None
+
+    def close_if_idle(self):
+        if time.monotonic() - self._last_used > app.config['MAIL_CONNECTION_IDLE_TIMEOUT']:
+            self.close()
+
+def deliver(connection, email_ids, attachments=None):
+    """
+    Sends claimed messages over one SMTP connection and records the outcome
+
+    Args:
+        connection: PooledConnection to send with
+        email_ids: IDs returned by claim_emails
+        attachments: Optional dict of email ID -> pre-rendered PDF bytes
+
+    Returns:
+        tuple: (sent count, failed count)
+    """
+    sent = failed = 0
+    for email_id in email_ids:
+        email = db.session.get(OutboundEmail, email_id)
+        try:
+            message = build_message(email, (attachments or {}).get(email_id))
+            connection.send(message)
+        except Exception as e:
+            logging.warning(f"Email {email_id} failed: {e}")
+            record_failure(email, e)
+            failed += 1
+        else:
+            record_success(email)
+            sent += 1
+        # Commit per message so a crash never resends delivered mail
+        db.session.commit()
+    return sent, failed
+
+def run_worker(batch_size=None, poll_interval=2.0, once=False, stop_event=None):
+    """
+    Delivers queued messages until stopped
+
+    Messages outside campaigns are sent first, over one pooled connection.
+    When none is due, the due messages of running campaigns are sent
+    through campaigns.run_due_campaigns.
+
+    Args:
+        batch_size: Messages claimed per round (MAIL_QUEUE_BATCH_SIZE by default)
+        poll_interval: Seconds to sleep when nothing is due
+        once: Return as soon as no message is due
+        stop_event: threading.Event that ends the loop when set
+
+    Returns:
+        int: Number of messages sent
+    """
+    # campaigns imports this module
+    import campaigns
+
+    batch_size = batch_size or app.config['MAIL_QUEUE_BATCH_SIZE']
+    connection = PooledConnection()
+    total_sent = 0
+    try:
+        while stop_event is None or not stop_event.is_set():
+            with app.app_context():
+                requeue_stale_emails()
+                email_ids = claim_emails(batch_size)
+                if email_ids:
+                    sent, _ = deliver(connection, email_ids)
+                    total_sent += sent
+                    continue
+
+            campaign_sent = campaigns.run_due_campaigns()
+            total_sent += campaign_sent
+            if campaign_sent:
+                continue
+
+            connection.close_if_idle()
+            if once:
+                break
+            time.sleep(poll_interval)
+    finally:
+        with app.app_context():
+            connection.close()
+    return total_sent
+
+def start_worker_thread():
+    """Runs the mail worker in a daemon thread of the current process"""
+    thread = threading.Thread(target=run_worker, name='mail-queue-worker', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,231 @@
+import logging
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Float, Integer, MetaData, String, Table, func, inspect, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+from app import db
+
+# Bookkeeping table recording which schema versions have been applied
+migrations_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations',
+    migrations_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(256), nullable=False),
+    Column('applied_at', DateTime, nullable=False)
+)
+
+# Ordered list of (version, description, function) registered with @migration
+MIGRATIONS = []
+
+class MigrationError(RuntimeError):
+    """Raised when a migration cannot be applied to the existing data"""
+
+def migration(version, description):
+    """
+    Registers a schema migration
+
+    The decorated function receives a connection whose transaction also
+    records the version, so a migration is applied completely or not at all.
+    Migrations must be safe to run on a database that db.create_all() has
+    just created, e.g. by checking for existing columns and indexes first.
+    """
+    def decorator(apply):
+        if any(existing == version for existing, _, _ in MIGRATIONS):
+            raise ValueError(f"Duplicate migration version {version}")
+        MIGRATIONS.append((version, description, apply))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return apply
+    return decorator
+
+def create_index(connection, table, name):
+    """Creates a model declared index unless the database already has it"""
+    for index in db.metadata.tables[table].indexes:
+        if index.name == name:
+            # IF NOT EXISTS instead of checkfirst, reflection skips expression indexes
+            connection.execute(CreateIndex(index, if_not_exists=True))
+            return
+    raise MigrationError(f"Index {name} is not declared on {table}")
+
+def add_column(connection, table, name):
+    """Adds a model declared column to an existing table unless it is already there"""
+    existing = {column['name'] for column in inspect(connection).get_columns(table)}
+    if name in existing:
+        return
+    column = db.metadata.tables[table].c[name]
+    column_type = column.type.compile(dialect=connection.dialect)
+    connection.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+
+def applied_versions(connection):
+    """Returns the set of migration versions recorded in the database"""
+    return set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+def pending_migrations(connection):
+    """Returns the registered migrations that have not been applied yet"""
+    applied = applied_versions(connection)
+    return [entry for entry in MIGRATIONS if entry[0] not in applied]
+
+def upgrade():
+    """
+    Creates missing tables and applies every pending migration in order
+
+    Returns:
+        list: Versions applied by this call
+    """
+    engine = db.engine
+    migrations_metadata.create_all(engine)
+    db.create_all()
+
+    applied = []
+    with engine.connect() as connection:
+        pending = pending_migrations(connection)
+
+    for version, description, apply in pending:
+        with engine.connect() as connection:
+            transaction = connection.begin()
+            try:
+                # Claim the version first so concurrent workers skip it
+                connection.execute(schema_migrations.insert().values(
+                    version=version,
+                    description=description,
+                    applied_at=datetime.utcnow()
+                ))
+            except IntegrityError:
+                transaction.rollback()
+                logging.info(f"Migration {version} was applied by another process")
+                continue
+
+            try:
+                apply(connection)
+            except Exception:
+                transaction.rollback()
+                raise
+            transaction.commit()
+
+        logging.info(f"Applied migration {version}: {description}")
+        applied.append(version)
+
+    return applied
+
+@migration(1, 'Composite indexes for the hot invoice, customer and item queries')
+def _add_composite_indexes(connection):
+    invoices = db.metadata.tables['invoices']
+    duplicates = connection.execute(
+        select(invoices.c.user_id, invoices.c.invoice_number, func.count())
+        .group_by(invoices.c.user_id, invoices.c.invoice_number)
+        .having(func.count() > 1)
+        .limit(20)
+    ).all()
+    if duplicates:
+        listing = ', '.join(f"user {user_id}: {number} (x{count})" for user_id, number, count in duplicates)
+        raise MigrationError(f"Duplicate invoice numbers must be renamed before upgrading: {listing}")
+
+    create_index(connection, 'customers', 'ix_customers_user_name')
+    create_index(connection, 'invoices', 'uq_invoices_user_number')
+    create_index(connection, 'invoices', 'ix_invoices_user_created')
+    create_index(connection, 'invoices', 'ix_invoices_user_status_created')
+    create_index(connection, 'invoices', 'ix_invoices_user_date_issued')
+    create_index(connection, 'invoices', 'ix_invoices_user_date_due')
+    create_index(connection, 'invoices', 'ix_invoices_customer_id')
+    create_index(connection, 'invoice_items', 'ix_invoice_items_invoice_id')
+
+@migration(2, 'Seed user_invoice_stats from existing invoices')
+def _seed_invoice_stats(connection):
+    import stats
+    stats.rebuild_invoice_stats(connection=connection)
+
+@migration(3, 'Email delivery status on invoices')
+def _add_invoice_email_status(connection):
+    add_column(connection, 'invoices', 'email_status')
+    add_column(connection, 'invoices', 'emailed_at')
+
+@migration(4, 'Link outbound emails to reminder campaigns')
+def _add_email_campaigns(connection):
+    add_column(connection, 'outbound_emails', 'campaign_id')
+    create_index(connection, 'outbound_emails', 'uq_outbound_emails_campaign_invoice')
+
+@migration(5, 'Index invoices by (status, date_due) for the overdue sweeper')
+def _add_status_due_index(connection):
+    create_index(connection, 'invoices', 'ix_invoices_status_date_due')
+
+# Columns converted from floats to integer minor units by migration 6
+FIXED_POINT_COLUMNS = (
+    ('invoices', 'tax_rate'),
+    ('invoices', 'subtotal'),
+    ('invoices', 'tax_amount'),
+    ('invoices', 'total'),
+    ('invoice_items', 'quantity'),
+    ('invoice_items', 'unit_price'),
+    ('invoice_items', 'amount'),
+    ('user_invoice_stats', 'amount_total'),
+    ('invoice_status_changes', 'amount'),
+)
+
+@migration(6, 'Store money, quantities and tax rates as integer minor units')
+def _convert_to_fixed_point(connection):
+    inspector = inspect(connection)
+    for table, name in FIXED_POINT_COLUMNS:
+        reflected = {column['name']: column['type'] for column in inspector.get_columns(table)}
+        # Tables created by db.create_all() already have integer columns
+        if not isinstance(reflected[name], Float):
+            continue
+
+        factor = 10 ** db.metadata.tables[table].c[name].type.scale
+        if connection.dialect.name == 'postgresql':
+            connection.exec_driver_sql(
+                f'ALTER TABLE {table} ALTER COLUMN {name} TYPE BIGINT '
+                f'USING ROUND({name}::numeric * {factor})::bigint'
+            )
+        else:
+            # SQLite cannot change a column type, the column keeps REAL affinity
+            # but only holds integral values, which it sums exactly
+            connection.exec_driver_sql(
+                f'UPDATE {table} SET {name} = CAST(ROUND({name} * {factor}) AS INTEGER) '
+                f'WHERE {name} IS NOT NULL'
+            )
+
+    # Migration 2 may have summed the float totals as minor units, recount them
+    import stats
+    stats.rebuild_invoice_stats(connection=connection)
+
+@migration(7, 'Full-text search index over customers, invoices and invoice items')
+def _create_search_index(connection):
+    import search
+    search.create_index(connection)
+    search.rebuild_index(connection=connection)
+
+@migration(8, 'Expression index on (user_id, lower(name)) for the customer autocomplete')
+def _add_customer_name_prefix_index(connection):
+    create_index(connection, 'customers', 'ix_customers_user_lower_name')
+
+@migration(9, 'Payment dates on invoices and daily rollups for the analytics reports')
+def _add_invoice_rollups(connection):
+    add_column(connection, 'invoices', 'paid_at')
+    # The last change of a paid invoice is the best guess for when it was paid
+    invoices = db.metadata.tables['invoices']
+    connection.execute(
+        invoices.update()
+        .where(invoices.c.status == 'Paid', invoices.c.paid_at.is_(None))
+        .values(paid_at=func.coalesce(invoices.c.updated_at, invoices.c.created_at))
+    )
+    import analytics
+    analytics.rebuild_rollups(connection=connection)
+
+@migration(10, 'Recurring invoice templates and the link from generated invoices')
+def _add_recurring_invoices(connection):
+    add_column(connection, 'invoices', 'recurring_invoice_id')
+    add_column(connection, 'invoices', 'recurring_date')
+    create_index(connection, 'invoices', 'uq_invoices_recurring_run')
+
+@migration(11, 'Unicode case folded customer name index for the autocomplete on SQLite')
+def _add_customer_casefold_index(connection):
+    if connection.dialect.name != 'sqlite':
+        return
+    create_index(connection, 'customers', 'ix_customers_user_casefold_name')
+    connection.exec_driver_sql('DROP INDEX IF EXISTS ix_customers_user_lower_name')
+
+@migration(12, 'Drop the PDF copies stored on pdf_jobs, downloads are served from the PDF cache')
+def _drop_pdf_job_blobs(connection):
+    existing = {column['name'] for column in inspect(connection).get_columns('pdf_jobs')}
+    if 'pdf' in existing:
+        connection.exec_driver_sql('ALTER TABLE pdf_jobs DROP COLUMN pdf')
@@ -1,6 +1,7 @@
 from datetime import datetime
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from money import FixedPoint, MONEY_SCALE, QUANTITY_SCALE, RATE_SCALE
 
 # Global database reference
 db = None
@@ -42,6 +43,11 @@ class Invoice:
     customer_id = None
     created_at = None
     updated_at = None
+    email_status = None
+    emailed_at = None
+    paid_at = None
+    recurring_invoice_id = None
+    recurring_date = None
 
 class InvoiceItem:
     id = None
@@ -52,6 +58,124 @@ class InvoiceItem:
     invoice_id = None
     created_at = None
 
+class UserInvoiceStats:
+    user_id = None
+    status = None
+    invoice_count = None
+    amount_total = None
+    updated_at = None
+
+class PdfJob:
+    id = None
+    status = None
+    error = None
+    attempts = None
+    user_id = None
+    invoice_id = None
+    created_at = None
+    started_at = None
+    finished_at = None
+
+class OutboundEmail:
+    id = None
+    status = None
+    subject = None
+    sender = None
+    recipients = None
+    body = None
+    attach_invoice_pdf = None
+    attempts = None
+    next_attempt_at = None
+    last_error = None
+    user_id = None
+    invoice_id = None
+    campaign_id = None
+    created_at = None
+    sent_at = None
+
+class EmailCampaign:
+    id = None
+    kind = None
+    statuses = None
+    due_before = None
+    status = None
+    total = None
+    user_id = None
+    created_at = None
+    finished_at = None
+
+class StatusSweep:
+    id = None
+    cutoff_date = None
+    changed_count = None
+    ran_at = None
+
+class InvoiceStatusChange:
+    id = None
+    sweep_id = None
+    invoice_id = None
+    user_id = None
+    old_status = None
+    new_status = None
+    amount = None
+    changed_at = None
+
+class InvoiceSequence:
+    user_id = None
+    period = None
+    next_value = None
+    updated_at = None
+
+class InvoiceDailyRollup:
+    user_id = None
+    customer_id = None
+    day = None
+    issued_count = None
+    issued_amount = None
+    paid_count = None
+    paid_amount = None
+    days_to_pay_total = None
+    open_count = None
+    open_amount = None
+
+class UserDataVersion:
+    user_id = None
+    version = None
+    updated_at = None
+
+class RecurringInvoice:
+    id = None
+    frequency = None
+    interval = None
+    start_date = None
+    end_date = None
+    next_run_date = None
+    runs = None
+    due_days = None
+    tax_rate = None
+    notes = None
+    status = None
+    user_id = None
+    customer_id = None
+    created_at = None
+    updated_at = None
+
+class RecurringInvoiceItem:
+    id = None
+    description = None
+    quantity = None
+    unit_price = None
+    recurring_invoice_id = None
+
+class SearchDocument:
+    id = None
+    user_id = None
+    kind = None
+    object_id = None
+    invoice_id = None
+    title = None
+    body = None
+
 def init_models(database):
     global db
     db = database
@@ -80,6 +204,9 @@ def init_models(database):
     
     class RealCustomer(db.Model):
         __tablename__ = 'customers'
+        __table_args__ = (
+            db.Index('ix_customers_user_name', 'user_id', 'name', 'id'),
+        )
         id = db.Column(db.Integer, primary_key=True)
         name = db.Column(db.String(120), nullable=False)
         email = db.Column(db.String(120))
@@ -91,47 +218,289 @@ def init_models(database):
         # Relationships
         invoices = db.relationship('RealInvoice', backref='customer', lazy=True)
     
+    # Case-insensitive name prefix lookups for the customer autocomplete; text_pattern_ops
+    # lets PostgreSQL use it for LIKE 'prefix%' whatever the database collation
+    db.Index(
+        'ix_customers_user_lower_name',
+        RealCustomer.user_id,
+        db.func.lower(RealCustomer.name).label('lower_name'),
+        postgresql_ops={'lower_name': 'text_pattern_ops'}
+    ).ddl_if(dialect='postgresql')
+    # SQLite's lower() only folds ASCII, its index uses the casefold() function
+    # customer_lookup registers on every connection
+    db.Index(
+        'ix_customers_user_casefold_name',
+        RealCustomer.user_id,
+        db.func.casefold(RealCustomer.name)
+    ).ddl_if(dialect='sqlite')
+    
     class RealInvoice(db.Model):
         __tablename__ = 'invoices'
+        __table_args__ = (
+            db.Index('uq_invoices_user_number', 'user_id', 'invoice_number', unique=True),
+            db.Index('ix_invoices_user_created', 'user_id', 'created_at', 'id'),
+            db.Index('ix_invoices_user_status_created', 'user_id', 'status', 'created_at', 'id'),
+            db.Index('ix_invoices_user_date_issued', 'user_id', 'date_issued'),
+            db.Index('ix_invoices_user_date_due', 'user_id', 'date_due'),
+            db.Index('ix_invoices_customer_id', 'customer_id'),
+            db.Index('ix_invoices_status_date_due', 'status', 'date_due'),
+            db.Index('uq_invoices_recurring_run', 'recurring_invoice_id', 'recurring_date', unique=True),
+        )
         id = db.Column(db.Integer, primary_key=True)
         invoice_number = db.Column(db.String(20), nullable=False)
         date_issued = db.Column(db.Date, nullable=False, default=datetime.utcnow().date)
         date_due = db.Column(db.Date, nullable=False)
         status = db.Column(db.String(20), default='Unpaid')  # Paid, Unpaid, Overdue, Cancelled
         notes = db.Column(db.Text)
-        tax_rate = db.Column(db.Float, default=0.0)
-        subtotal = db.Column(db.Float, default=0.0)
-        tax_amount = db.Column(db.Float, default=0.0)
-        total = db.Column(db.Float, default=0.0)
+        # Fixed point values stored as integer minor units, see money.FixedPoint
+        tax_rate = db.Column(FixedPoint(RATE_SCALE), default=0)
+        subtotal = db.Column(FixedPoint(MONEY_SCALE), default=0)
+        tax_amount = db.Column(FixedPoint(MONEY_SCALE), default=0)
+        total = db.Column(FixedPoint(MONEY_SCALE), default=0)
         user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
         customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
         created_at = db.Column(db.DateTime, default=datetime.utcnow)
         updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+        email_status = db.Column(db.String(20))  # queued, sent, failed
+        emailed_at = db.Column(db.DateTime)
+        paid_at = db.Column(db.DateTime)  # set when the status becomes Paid, see analytics.py
+        # Template and scheduled date of invoices made by the recurring invoice generator
+        recurring_invoice_id = db.Column(db.Integer, db.ForeignKey('recurring_invoices.id'))
+        recurring_date = db.Column(db.Date)
         
         # Relationships
         items = db.relationship('RealInvoiceItem', backref='invoice', lazy=True, cascade="all, delete-orphan")
+        pdf_jobs = db.relationship('RealPdfJob', backref='invoice', lazy=True, cascade="all, delete-orphan")
+        outbound_emails = db.relationship('RealOutboundEmail', backref='invoice', lazy=True, cascade="all, delete-orphan")
     
     class RealInvoiceItem(db.Model):
         __tablename__ = 'invoice_items'
+        __table_args__ = (
+            db.Index('ix_invoice_items_invoice_id', 'invoice_id', 'id'),
+        )
         id = db.Column(db.Integer, primary_key=True)
         description = db.Column(db.String(256), nullable=False)
-        quantity = db.Column(db.Float, nullable=False, default=1.0)
-        unit_price = db.Column(db.Float, nullable=False, default=0.0)
-        amount = db.Column(db.Float, nullable=False, default=0.0)
+        quantity = db.Column(FixedPoint(QUANTITY_SCALE), nullable=False, default=1)
+        unit_price = db.Column(FixedPoint(MONEY_SCALE), nullable=False, default=0)
+        amount = db.Column(FixedPoint(MONEY_SCALE), nullable=False, default=0)
+        invoice_id = db.Column(db.Integer, db.ForeignKey('invoices.id'), nullable=False)
+        created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    class RealUserInvoiceStats(db.Model):
+        # Per-user, per-status invoice summary kept in sync with the invoices table
+        __tablename__ = 'user_invoice_stats'
+        user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+        status = db.Column(db.String(20), primary_key=True)
+        invoice_count = db.Column(db.Integer, nullable=False, default=0)
+        amount_total = db.Column(FixedPoint(MONEY_SCALE), nullable=False, default=0)
+        updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    class RealPdfJob(db.Model):
+        # Queued PDF render, processed by the pdf-jobs worker pool
+        __tablename__ = 'pdf_jobs'
+        __table_args__ = (
+            db.Index('ix_pdf_jobs_status_created', 'status', 'created_at'),
+            db.Index('ix_pdf_jobs_invoice_status', 'invoice_id', 'status'),
+        )
+        id = db.Column(db.String(32), primary_key=True)
+        status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+        error = db.Column(db.Text)
+        attempts = db.Column(db.Integer, nullable=False, default=0)
+        user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
         invoice_id = db.Column(db.Integer, db.ForeignKey('invoices.id'), nullable=False)
         created_at = db.Column(db.DateTime, default=datetime.utcnow)
+        started_at = db.Column(db.DateTime)
+        finished_at = db.Column(db.DateTime)
+    
+    class RealOutboundEmail(db.Model):
+        # Persistent outbound mail queue, delivered by the mail worker
+        __tablename__ = 'outbound_emails'
+        __table_args__ = (
+            db.Index('ix_outbound_emails_status_next_attempt', 'status', 'next_attempt_at'),
+            db.Index('ix_outbound_emails_invoice_id', 'invoice_id'),
+            db.Index('uq_outbound_emails_campaign_invoice', 'campaign_id', 'invoice_id', unique=True),
+        )
+        id = db.Column(db.Integer, primary_key=True)
+        status = db.Column(db.String(20), nullable=False, default='queued')  # queued, sending, sent, failed
+        subject = db.Column(db.String(256), nullable=False)
+        sender = db.Column(db.String(256))
+        recipients = db.Column(db.Text, nullable=False)  # comma separated addresses
+        body = db.Column(db.Text)
+        attach_invoice_pdf = db.Column(db.Boolean, nullable=False, default=False)
+        attempts = db.Column(db.Integer, nullable=False, default=0)
+        next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+        last_error = db.Column(db.Text)
+        user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+        invoice_id = db.Column(db.Integer, db.ForeignKey('invoices.id'))
+        campaign_id = db.Column(db.Integer, db.ForeignKey('email_campaigns.id'))
+        created_at = db.Column(db.DateTime, default=datetime.utcnow)
+        sent_at = db.Column(db.DateTime)
+    
+    class RealEmailCampaign(db.Model):
+        # Batch of reminder emails for invoices selected by status and due date
+        __tablename__ = 'email_campaigns'
+        id = db.Column(db.Integer, primary_key=True)
+        kind = db.Column(db.String(20), nullable=False, default='reminder')
+        statuses = db.Column(db.String(120), nullable=False)  # comma separated invoice statuses
+        due_before = db.Column(db.Date)
+        status = db.Column(db.String(20), nullable=False, default='running')  # running, done
+        total = db.Column(db.Integer, nullable=False, default=0)
+        user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+        created_at = db.Column(db.DateTime, default=datetime.utcnow)
+        finished_at = db.Column(db.DateTime)
+        
+        # Relationships
+        emails = db.relationship('RealOutboundEmail', backref='campaign', lazy=True)
+    
+    class RealStatusSweep(db.Model):
+        # One run of the overdue sweeper
+        __tablename__ = 'status_sweeps'
+        id = db.Column(db.Integer, primary_key=True)
+        cutoff_date = db.Column(db.Date, nullable=False)
+        changed_count = db.Column(db.Integer, nullable=False, default=0)
+        ran_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    class RealInvoiceStatusChange(db.Model):
+        # Audit trail of status changes made by the sweeper
+        __tablename__ = 'invoice_status_changes'
+        __table_args__ = (
+            db.Index('ix_invoice_status_changes_sweep_user', 'sweep_id', 'user_id'),
+            db.Index('ix_invoice_status_changes_invoice_id', 'invoice_id'),
+        )
+        id = db.Column(db.Integer, primary_key=True)
+        sweep_id = db.Column(db.Integer, db.ForeignKey('status_sweeps.id'), nullable=False)
+        invoice_id = db.Column(db.Integer, nullable=False)
+        user_id = db.Column(db.Integer, nullable=False)
+        old_status = db.Column(db.String(20))
+        new_status = db.Column(db.String(20), nullable=False)
+        amount = db.Column(FixedPoint(MONEY_SCALE))
+        changed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    class RealInvoiceSequence(db.Model):
+        # Next invoice number of a user for one numbering period, see numbering.py
+        __tablename__ = 'invoice_sequences'
+        user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+        period = db.Column(db.String(16), primary_key=True)
+        next_value = db.Column(db.Integer, nullable=False, default=1)
+        updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    class RealInvoiceDailyRollup(db.Model):
+        # Per-user, per-customer, per-day invoice figures kept in step with the invoices table,
+        # see analytics.py. An invoice counts as issued on date_issued, as paid on paid_at and,
+        # while Unpaid or Overdue, as open on date_due.
+        __tablename__ = 'invoice_daily_rollups'
+        __table_args__ = (
+            db.Index('ix_invoice_daily_rollups_user_day', 'user_id', 'day'),
+        )
+        user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+        customer_id = db.Column(db.Integer, primary_key=True)
+        day = db.Column(db.Date, primary_key=True)
+        issued_count = db.Column(db.Integer, nullable=False, default=0)
+        issued_amount = db.Column(FixedPoint(MONEY_SCALE), nullable=False, default=0)
+        paid_count = db.Column(db.Integer, nullable=False, default=0)
+        paid_amount = db.Column(FixedPoint(MONEY_SCALE), nullable=False, default=0)
+        days_to_pay_total = db.Column(db.Integer, nullable=False, default=0)
+        open_count = db.Column(db.Integer, nullable=False, default=0)
+        open_amount = db.Column(FixedPoint(MONEY_SCALE), nullable=False, default=0)
+    
+    class RealUserDataVersion(db.Model):
+        # Counter bumped by every write to a user's data, part of the page cache keys, see page_cache.py
+        __tablename__ = 'user_data_versions'
+        user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+        version = db.Column(db.Integer, nullable=False, default=0)
+        updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    class RealRecurringInvoice(db.Model):
+        # Invoice issued on a schedule by the recurring invoice generator, see recurring.py.
+        # next_run_date is always the occurrence number `runs` of the schedule.
+        __tablename__ = 'recurring_invoices'
+        __table_args__ = (
+            db.Index('ix_recurring_invoices_status_next_run', 'status', 'next_run_date'),
+            db.Index('ix_recurring_invoices_user_id', 'user_id'),
+            db.Index('ix_recurring_invoices_customer_id', 'customer_id'),
+        )
+        id = db.Column(db.Integer, primary_key=True)
+        frequency = db.Column(db.String(20), nullable=False)  # weekly, monthly, quarterly, yearly
+        interval = db.Column(db.Integer, nullable=False, default=1)
+        start_date = db.Column(db.Date, nullable=False)
+        end_date = db.Column(db.Date)
+        next_run_date = db.Column(db.Date, nullable=False)
+        runs = db.Column(db.Integer, nullable=False, default=0)
+        due_days = db.Column(db.Integer, nullable=False, default=30)
+        tax_rate = db.Column(FixedPoint(RATE_SCALE), nullable=False, default=0)
+        notes = db.Column(db.Text)
+        status = db.Column(db.String(20), nullable=False, default='active')  # active, ended
+        user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+        customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
+        created_at = db.Column(db.DateTime, default=datetime.utcnow)
+        updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+        
+        # Relationships
+        items = db.relationship('RealRecurringInvoiceItem', backref='recurring_invoice', lazy=True,
+                                cascade="all, delete-orphan", order_by='RealRecurringInvoiceItem.id')
+    
+    class RealRecurringInvoiceItem(db.Model):
+        __tablename__ = 'recurring_invoice_items'
+        __table_args__ = (
+            db.Index('ix_recurring_invoice_items_recurring_invoice_id', 'recurring_invoice_id', 'id'),
+        )
+        id = db.Column(db.Integer, primary_key=True)
+        description = db.Column(db.String(256), nullable=False)
+        quantity = db.Column(FixedPoint(QUANTITY_SCALE), nullable=False, default=1)
+        unit_price = db.Column(FixedPoint(MONEY_SCALE), nullable=False, default=0)
+        recurring_invoice_id = db.Column(db.Integer, db.ForeignKey('recurring_invoices.id'), nullable=False)
+    
+    class RealSearchDocument(db.Model):
+        # Searchable text of a customer, invoice or item, indexed by FTS5 or tsvector, see search.py
+        __tablename__ = 'search_documents'
+        __table_args__ = (
+            db.Index('ix_search_documents_invoice', 'invoice_id'),
+        )
+        id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, autoincrement=False)
+        user_id = db.Column(db.Integer, nullable=False)
+        kind = db.Column(db.String(16), nullable=False)
+        object_id = db.Column(db.Integer, nullable=False)
+        invoice_id = db.Column(db.Integer)
+        title = db.Column(db.String(256), nullable=False)
+        body = db.Column(db.Text)
     
     # Update global references
-    global User, Customer, Invoice, InvoiceItem
+    global User, Customer, Invoice, InvoiceItem, UserInvoiceStats, PdfJob, OutboundEmail, EmailCampaign
+    global StatusSweep, InvoiceStatusChange, InvoiceSequence, InvoiceDailyRollup, UserDataVersion, SearchDocument
+    global RecurringInvoice, RecurringInvoiceItem
     User = RealUser
     Customer = RealCustomer
     Invoice = RealInvoice
     InvoiceItem = RealInvoiceItem
+    UserInvoiceStats = RealUserInvoiceStats
+    PdfJob = RealPdfJob
+    OutboundEmail = RealOutboundEmail
+    EmailCampaign = RealEmailCampaign
+    StatusSweep = RealStatusSweep
+    InvoiceStatusChange = RealInvoiceStatusChange
+    InvoiceSequence = RealInvoiceSequence
+    InvoiceDailyRollup = RealInvoiceDailyRollup
+    UserDataVersion = RealUserDataVersion
+    SearchDocument = RealSearchDocument
+    RecurringInvoice = RealRecurringInvoice
+    RecurringInvoiceItem = RealRecurringInvoiceItem
     
     # Return model dictionary
     return {
         'User': RealUser,
         'Customer': RealCustomer,
         'Invoice': RealInvoice,
-        'InvoiceItem': RealInvoiceItem
+        'InvoiceItem': RealInvoiceItem,
+        'UserInvoiceStats': RealUserInvoiceStats,
+        'PdfJob': RealPdfJob,
+        'OutboundEmail': RealOutboundEmail,
+        'EmailCampaign': RealEmailCampaign,
+        'StatusSweep': RealStatusSweep,
+        'InvoiceStatusChange': RealInvoiceStatusChange,
+        'InvoiceSequence': RealInvoiceSequence,
+        'InvoiceDailyRollup': RealInvoiceDailyRollup,
+        'UserDataVersion': RealUserDataVersion,
+        'SearchDocument': RealSearchDocument,
+        'RecurringInvoice': RealRecurringInvoice,
+        'RecurringInvoiceItem': RealRecurringInvoiceItem
     }
\ No newline at end of file
@@ -0,0 +1,101 @@
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from sqlalchemy import BigInteger, case, cast
+from sqlalchemy.types import TypeDecorator
+
+# Decimal places of each kind of fixed point value
+MONEY_SCALE = 2
+QUANTITY_SCALE = 3
+RATE_SCALE = 2
+
+ZERO = Decimal('0.00')
+
+class FixedPoint(TypeDecorator):
+    """
+    Decimal value stored as an integer count of its smallest unit
+
+    A money column with scale 2 stores 12.34 as 1234, so sums and
+    comparisons in SQL are exact integer arithmetic on every database.
+    Python sees Decimal values quantized to the scale.
+    """
+    impl = BigInteger
+    cache_ok = True
+
+    def __init__(self, scale=MONEY_SCALE):
+        super().__init__()
+        self.scale = scale
+
+    @property
+    def python_type(self):
+        return Decimal
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(to_decimal(value, self.scale).scaleb(self.scale))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        # Legacy SQLite columns keep REAL affinity and hand back integral floats
+        return Decimal(int(round(value))).scaleb(-self.scale)
+
+    def process_literal_param(self, value, dialect):
+        return str(self.process_bind_param(value, dialect))
+
+def to_decimal(value, scale=MONEY_SCALE):
+    """
+    Converts a number or numeric string to a Decimal rounded half up to `scale` places
+
+    Raises:
+        ValueError: If the value is not a number
+    """
+    if isinstance(value, float):
+        value = repr(value)
+    try:
+        number = Decimal(value.strip() if isinstance(value, str) else value)
+    except (InvalidOperation, TypeError):
+        raise ValueError(f"Invalid number: {value!r}")
+    if not number.is_finite():
+        raise ValueError(f"Invalid number: {value!r}")
+    return number.quantize(Decimal(1).scaleb(-scale), rounding=ROUND_HALF_UP)
+
+def line_amount(quantity, unit_price):
+    """Returns quantity * unit_price rounded half up to cents"""
+    return to_decimal(quantity * unit_price)
+
+def invoice_totals(amounts, tax_rate):
+    """
+    Computes the totals of an invoice from its line amounts
+
+    Args:
+        amounts: Iterable of line amounts (Decimal)
+        tax_rate: Tax rate in percent (Decimal)
+
+    Returns:
+        tuple: (subtotal, tax_amount, total) as Decimal
+    """
+    subtotal = sum(amounts, ZERO)
+    tax_amount = to_decimal(subtotal * tax_rate / 100)
+    return subtotal, tax_amount, subtotal + tax_amount
+
+# SQL counterparts working on the stored integers, used to check totals in bulk
+
+def minor_units(column):
+    """Returns the raw stored integer of a FixedPoint column"""
+    return cast(column, BigInteger)
+
+def round_div(numerator, divisor):
+    """Integer division rounding half away from zero, like ROUND_HALF_UP"""
+    half = divisor // 2
+    return case(
+        (numerator >= 0, (numerator + half) // divisor),
+        else_=-((half - numerator) // divisor)
+    )
+
+def sql_line_amount(quantity, unit_price):
+    """Expected amount in cents of an item from its quantity and unit price columns"""
+    return round_div(minor_units(quantity) * minor_units(unit_price), 10 ** QUANTITY_SCALE)
+
+def sql_tax_amount(subtotal_cents, tax_rate):
+    """Expected tax in cents from a subtotal in cents and a tax rate column"""
+    return round_div(subtotal_cents * minor_units(tax_rate), 100 * 10 ** RATE_SCALE)
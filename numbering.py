@@ -0,0 +1,154 @@
+import re
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import case, select, update
+from app import db
+from app import Invoice, InvoiceSequence
+from stats import upsert_insert
+
+def current_period(today=None):
+    """Returns the numbering period of a date, e.g. '202610' for the default '%Y%m'"""
+    today = today or datetime.now().date()
+    return today.strftime(current_app.config['INVOICE_NUMBER_PERIOD'])
+
+def format_number(period, value):
+    """Formats a sequence value with INVOICE_NUMBER_FORMAT, e.g. INV-202610-007"""
+    width = current_app.config['INVOICE_NUMBER_WIDTH']
+    return current_app.config['INVOICE_NUMBER_FORMAT'].format(period=period, number=f"{value:0{width}d}")
+
+def _number_pattern(period=None):
+    """
+    Regex matching numbers produced by format_number
+
+    Width is a minimum, so the sequence keeps working past 999. Without a
+    period the pattern matches any period and captures it.
+    """
+    fmt = current_app.config['INVOICE_NUMBER_FORMAT']
+    period_pattern = re.escape(period) if period is not None else '(?P<period>.+?)'
+    parts = re.split(r'(\{period\}|\{number\})', fmt)
+    pattern = ''.join(
+        period_pattern if part == '{period}' else
+        r'(?P<number>\d+)' if part == '{number}' else
+        re.escape(part)
+        for part in parts
+    )
+    return re.compile(pattern + '$')
+
+def _seed_value(connection, user_id, period):
+    """First free value of a period, after the numbers already used by existing invoices"""
+    prefix = format_number(period, 0).partition(f"{0:0{current_app.config['INVOICE_NUMBER_WIDTH']}d}")[0]
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    pattern = _number_pattern(period)
+
+    highest = 0
+    for number in connection.execute(
+        select(Invoice.invoice_number)
+        .where(Invoice.user_id == user_id, Invoice.invoice_number.like(escaped + '%', escape='\\'))
+    ).scalars():
+        match = pattern.match(number)
+        if match:
+            highest = max(highest, int(match.group('number')))
+    return highest + 1
+
+def _lock_for_write(connection):
+    """
+    Takes the database write lock before the sequence is read on SQLite
+
+    SQLite starts transactions lazily and would only ask for the write lock
+    at the UPDATE, where two readers can deadlock. BEGIN IMMEDIATE makes the
+    second writer wait for the first to commit instead. PostgreSQL needs
+    nothing here: the UPDATE locks the sequence row until commit.
+    """
+    if connection.dialect.name != 'sqlite':
+        return
+    if not connection.connection.driver_connection.in_transaction:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+def reserve_block(user_id, count, period=None):
+    """
+    Allocates `count` consecutive invoice numbers of a user
+
+    The sequence row is advanced with one UPDATE ... RETURNING in the
+    session's transaction, so concurrent callers never get the same number
+    and a rolled back transaction gives its numbers back, leaving no gaps.
+    A period's row is created on first use, continuing after the highest
+    number already present in the invoices table.
+
+    Args:
+        user_id: ID of the user
+        count: How many numbers to allocate
+        period: Numbering period (current_period() by default)
+
+    Returns:
+        list: The formatted invoice numbers, in order
+    """
+    if count < 1:
+        return []
+    period = period or current_period()
+    connection = db.session.connection()
+    _lock_for_write(connection)
+
+    table = InvoiceSequence.__table__
+    now = datetime.utcnow()
+    advance = (
+        update(table)
+        .where(table.c.user_id == user_id, table.c.period == period)
+        .values(next_value=table.c.next_value + count, updated_at=now)
+        .returning(table.c.next_value)
+    )
+
+    end = connection.execute(advance).scalar()
+    if end is None:
+        insert = upsert_insert(connection)
+        connection.execute(
+            insert(table)
+            .values(user_id=user_id, period=period, next_value=_seed_value(connection, user_id, period), updated_at=now)
+            .on_conflict_do_nothing(index_elements=[table.c.user_id, table.c.period])
+        )
+        end = connection.execute(advance).scalar()
+
+    return [format_number(period, value) for value in range(end - count, end)]
+
+def allocate_number(user_id, period=None):
+    """Allocates the next invoice number of a user, see reserve_block"""
+    return reserve_block(user_id, 1, period)[0]
+
+def preview_number(user_id, period=None):
+    """Returns the number allocate_number would give now, without allocating it"""
+    period = period or current_period()
+    next_value = db.session.scalar(
+        select(InvoiceSequence.next_value)
+        .where(InvoiceSequence.user_id == user_id, InvoiceSequence.period == period)
+    )
+    if next_value is None:
+        next_value = _seed_value(db.session.connection(), user_id, period)
+    return format_number(period, next_value)
+
+def number_in_use(user_id, number):
+    """Tells whether one of the user's invoices already has this number"""
+    return db.session.scalar(
+        select(Invoice.id).where(Invoice.user_id == user_id, Invoice.invoice_number == number).limit(1)
+    ) is not None
+
+def note_used_numbers(user_id, numbers):
+    """
+    Moves sequences past invoice numbers that were chosen by hand or imported
+
+    Numbers following the sequence format would otherwise be handed out
+    again later and clash with the unique constraint.
+    """
+    highest = {}
+    pattern = _number_pattern()
+    for number in numbers:
+        match = pattern.match(number or '')
+        if match:
+            period, value = match.group('period'), int(match.group('number'))
+            highest[period] = max(highest.get(period, 0), value)
+
+    table = InvoiceSequence.__table__
+    for period, value in highest.items():
+        db.session.execute(
+            update(table)
+            .where(table.c.user_id == user_id, table.c.period == period)
+            .values(next_value=case((table.c.next_value <= value, value + 1), else_=table.c.next_value))
+        )
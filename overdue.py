@@ -0,0 +1,100 @@
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import insert, text, update
+from app import app, db
+from app import Invoice, InvoiceStatusChange, StatusSweep
+from money import ZERO
+from stats import apply_stats_deltas
+from page_cache import bump_data_version
+
+# Arbitrary key serializing concurrent sweeps on PostgreSQL
+SWEEP_LOCK_KEY = 720310
+
+def sweep_overdue(today=None):
+    """
+    Marks every Unpaid invoice due before `today` as Overdue
+
+    One set-based UPDATE ... RETURNING changes the invoices and reports
+    the rows it actually changed; the status log and the summary deltas are
+    built from those rows, so an invoice paid by a concurrent request is
+    neither logged nor counted. A run costs the same handful of statements
+    whatever the table size and relies on the (status, date_due) index.
+    Running it again the same day changes nothing, and only runs that
+    changed invoices are recorded, so a frequent scheduler does not grow
+    the sweep table.
+
+    Args:
+        today: Cutoff date, invoices due strictly before it are overdue
+            (the local date by default, the one the invoice pages use)
+
+    Returns:
+        StatusSweep: The run, only stored when it changed invoices
+    """
+    today = today or datetime.now().date()
+    now = datetime.utcnow()
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': SWEEP_LOCK_KEY})
+
+    # Change the invoices and read back exactly the rows this statement changed
+    changed = db.session.execute(
+        update(Invoice)
+        .where(Invoice.status == 'Unpaid', Invoice.date_due < today)
+        .values(status='Overdue', updated_at=now)
+        .returning(Invoice.id, Invoice.user_id, Invoice.total)
+        .execution_options(synchronize_session=False)
+    ).all()
+    sweep = StatusSweep(cutoff_date=today, changed_count=len(changed), ran_at=now)
+    if not changed:
+        db.session.commit()
+        return sweep
+    db.session.add(sweep)
+    db.session.flush()
+
+    # Log them and move them between the summary rows, one upsert per user
+    deltas = {}
+    for invoice_id, user_id, total in changed:
+        for status, sign in (('Unpaid', -1), ('Overdue', 1)):
+            delta = deltas.setdefault((user_id, status), [0, ZERO])
+            delta[0] += sign
+            delta[1] += sign * (total or ZERO)
+    db.session.execute(insert(InvoiceStatusChange), [
+        {
+            'sweep_id': sweep.id,
+            'invoice_id': invoice_id,
+            'user_id': user_id,
+            'old_status': 'Unpaid',
+            'new_status': 'Overdue',
+            'amount': total,
+            'changed_at': now,
+        }
+        for invoice_id, user_id, total in changed
+    ])
+    apply_stats_deltas(db.session.connection(), deltas)
+    bump_data_version(db.session.connection(), {user_id for user_id, _ in deltas})
+
+    db.session.commit()
+    logging.info(f"Overdue sweep {sweep.id} marked {len(changed)} invoices as Overdue")
+    return sweep
+
+def start_scheduler(interval):
+    """
+    Runs sweep_overdue every `interval` seconds in a daemon thread
+
+    Returns:
+        threading.Event: Set it to stop the scheduler
+    """
+    stop_event = threading.Event()
+
+    def loop():
+        while not stop_event.wait(interval):
+            with app.app_context():
+                try:
+                    sweep_overdue()
+                except Exception:
+                    db.session.rollback()
+                    logging.exception('Overdue sweep failed')
+
+    threading.Thread(target=loop, name='overdue-sweeper', daemon=True).start()
+    return stop_event
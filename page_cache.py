@@ -0,0 +1,133 @@
+import hashlib
+from datetime import datetime
+from functools import wraps
+from flask import current_app, request, session
+from flask_login import current_user
+from sqlalchemy import event, select
+from app import db
+from app import Customer, EmailCampaign, Invoice, InvoiceItem, OutboundEmail, User, UserDataVersion
+from cache import create_cache
+from stats import upsert_insert
+
+# Models with a user_id whose changes can show on a cached page
+TRACKED_MODELS = (Customer, Invoice, OutboundEmail, EmailCampaign)
+
+_caches = {}
+
+def get_page_cache():
+    """Returns the page cache configured for the current app"""
+    config = current_app.config
+    key = (config['PAGE_CACHE_BACKEND'], config['PAGE_CACHE_PATH'])
+    if key not in _caches:
+        _caches[key] = create_cache(
+            config['PAGE_CACHE_BACKEND'],
+            config['PAGE_CACHE_TTL'],
+            max_entries=config['PAGE_CACHE_SIZE'],
+            path=config['PAGE_CACHE_PATH']
+        )
+    return _caches[key]
+
+# Data versions
+
+def bump_data_version(connection, user_ids):
+    """
+    Moves the data version of users forward in the current transaction
+
+    Called by the flush listener for ORM writes; Core writes to customers,
+    invoices or items have to call it themselves. A rolled back transaction
+    takes the bump back with it.
+    """
+    table = UserDataVersion.__table__
+    insert = upsert_insert(connection)
+    now = datetime.utcnow()
+    for user_id in sorted(set(user_ids) - {None}):
+        statement = insert(table).values(user_id=user_id, version=1, updated_at=now)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.user_id],
+            set_={'version': table.c.version + 1, 'updated_at': statement.excluded.updated_at}
+        ))
+
+def data_version(user_id):
+    """
+    Returns:
+        tuple: (version, time of the last write or None)
+    """
+    row = db.session.execute(
+        select(UserDataVersion.version, UserDataVersion.updated_at).where(UserDataVersion.user_id == user_id)
+    ).first()
+    return (row.version, row.updated_at) if row else (0, None)
+
+@event.listens_for(db.session, 'after_flush')
+def _track_data_changes(session, flush_context):
+    """Bumps the data version of every user whose customers, invoices, items or profile changed"""
+    user_ids, item_invoice_ids = set(), set()
+    deleted_users = {obj.id for obj in session.deleted if isinstance(obj, User)}
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, User):
+            user_ids.add(obj.id)
+        elif isinstance(obj, TRACKED_MODELS):
+            user_ids.add(obj.user_id)
+        elif isinstance(obj, InvoiceItem):
+            item_invoice_ids.add(obj.invoice_id)
+
+    connection = session.connection()
+    if item_invoice_ids:
+        user_ids.update(connection.execute(
+            select(Invoice.user_id).where(Invoice.id.in_(item_invoice_ids))
+        ).scalars())
+    user_ids -= deleted_users | {None}
+    if user_ids:
+        bump_data_version(connection, user_ids)
+
+# Page cache
+
+def _page_key(user_id, version, last_modified):
+    query = '&'.join(sorted(f"{name}={value}" for name, values in request.args.lists() for value in values))
+    # Pages embed the session's CSRF token, another session of the user needs its own copy
+    token = hashlib.sha1(str(session.get('csrf_token', '')).encode()).hexdigest()[:16]
+    # The write time tells apart the versions of a user id that was deleted and reused
+    stamp = last_modified.isoformat() if last_modified else ''
+    return f"page:{user_id}:{version}:{stamp}:{request.endpoint}:{token}:{query}"
+
+def _conditional(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Let browsers keep the page, but make them revalidate it on every visit
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+def cached_page(view):
+    """
+    Serves a logged in GET page from the page cache
+
+    The key holds the user, the endpoint, the query string, the session's
+    CSRF token and the user's data version and write time, so any write to the user's
+    data makes earlier copies unreachable. Responses carry an ETag and,
+    once the user has written something, a Last-Modified header, and a
+    matching If-None-Match or If-Modified-Since gets a 304. Requests with
+    flashed messages waiting are rendered normally and not stored, the
+    messages belong to that one response.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET' or not current_user.is_authenticated or session.get('_flashes'):
+            return view(*args, **kwargs)
+
+        user_id = current_user.id
+        version, last_modified = data_version(user_id)
+        cache = get_page_cache()
+        entry = cache.get(_page_key(user_id, version, last_modified))
+        if entry is not None:
+            response = current_app.response_class(entry['body'], mimetype=entry['mimetype'])
+            return _conditional(response, entry['etag'], last_modified)
+
+        response = current_app.make_response(view(*args, **kwargs))
+        if response.status_code != 200 or response.is_streamed or session.get('_flashes'):
+            return response
+        body = response.get_data(as_text=True)
+        etag = hashlib.sha1(f"{version}:{last_modified}:{body}".encode()).hexdigest()
+        # Rendering may have created the CSRF token, key the entry by the token it holds
+        cache.set(_page_key(user_id, version, last_modified), {'body': body, 'mimetype': response.mimetype, 'etag': etag})
+        return _conditional(response, etag, last_modified)
+    return wrapper
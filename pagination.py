@@ -0,0 +1,252 @@
+import base64
+import json
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Optional
+from flask import current_app
+from sqlalchemy import and_, or_, select
+from app import db
+from app import Customer, Invoice
+from money import to_decimal
+from query_profiles import invoice_list_options
+
+# Columns each list may be sorted by, first entry is the default
+INVOICE_SORT_COLUMNS = {
+    'created_at': Invoice.created_at,
+    'date_issued': Invoice.date_issued,
+    'date_due': Invoice.date_due,
+    'total': Invoice.total,
+    'invoice_number': Invoice.invoice_number,
+}
+CUSTOMER_SORT_COLUMNS = {
+    'name': Customer.name,
+    'created_at': Customer.created_at,
+}
+
+INVOICE_STATUSES = ('Unpaid', 'Paid', 'Overdue', 'Cancelled')
+
+class PaginationError(ValueError):
+    """Raised when list parameters or a cursor cannot be used"""
+
+@dataclass
+class Page:
+    """One page of a keyset paginated list"""
+    items: list
+    per_page: int
+    sort: str
+    direction: str
+    next_cursor: Optional[str] = None
+
+    @property
+    def has_more(self):
+        return self.next_cursor is not None
+
+@dataclass
+class InvoiceFilters:
+    """Filters accepted by the invoice list, exports and bulk operations"""
+    statuses: list = field(default_factory=list)
+    customer_id: Optional[int] = None
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+    min_amount: Optional[Decimal] = None
+    max_amount: Optional[Decimal] = None
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Builds the filters from request arguments
+
+        Args:
+            args: Mapping of query string arguments (request.args)
+
+        Returns:
+            InvoiceFilters: The parsed filters
+        """
+        status_arg = args.get('status', '')
+        statuses = []
+        if status_arg and status_arg != 'All':
+            statuses = [status.strip() for status in status_arg.split(',') if status.strip()]
+            for status in statuses:
+                if status not in INVOICE_STATUSES:
+                    raise PaginationError(f"Unknown status: {status}")
+
+        return cls(
+            statuses=statuses,
+            customer_id=_parse_value(args.get('customer_id'), int, 'customer_id'),
+            date_from=_parse_value(args.get('date_from'), _parse_date, 'date_from'),
+            date_to=_parse_value(args.get('date_to'), _parse_date, 'date_to'),
+            min_amount=_parse_value(args.get('min_amount'), to_decimal, 'min_amount'),
+            max_amount=_parse_value(args.get('max_amount'), to_decimal, 'max_amount')
+        )
+
+    def apply(self, query):
+        """Adds the filter conditions to a select() of invoices"""
+        if self.statuses:
+            query = query.where(Invoice.status.in_(self.statuses))
+        if self.customer_id is not None:
+            query = query.where(Invoice.customer_id == self.customer_id)
+        if self.date_from is not None:
+            query = query.where(Invoice.date_issued >= self.date_from)
+        if self.date_to is not None:
+            query = query.where(Invoice.date_issued <= self.date_to)
+        if self.min_amount is not None:
+            query = query.where(Invoice.total >= self.min_amount)
+        if self.max_amount is not None:
+            query = query.where(Invoice.total <= self.max_amount)
+        return query
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+def _parse_value(value, parser, name):
+    if value is None or value == '':
+        return None
+    try:
+        return parser(value)
+    except ValueError:
+        raise PaginationError(f"Invalid value for {name}: {value}")
+
+def _per_page(args):
+    default = current_app.config.get('ITEMS_PER_PAGE', 25)
+    maximum = current_app.config.get('MAX_ITEMS_PER_PAGE', 100)
+    per_page = _parse_value(args.get('per_page'), int, 'per_page') or default
+    return max(1, min(per_page, maximum))
+
+def _encode_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+def _decode_value(value, column):
+    if value is None:
+        return None
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if python_type is date:
+        return date.fromisoformat(value)
+    return python_type(value)
+
+def encode_cursor(sort, direction, value, row_id):
+    """Encodes the position after a row as an opaque URL safe string"""
+    payload = json.dumps([sort, direction, _encode_value(value), row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, sort, direction, column):
+    """
+    Decodes a cursor produced by encode_cursor
+
+    Returns:
+        tuple: (sort value, row id) of the last row of the previous page
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, cursor_direction, value, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        if cursor_sort != sort or cursor_direction != direction:
+            raise PaginationError('Cursor does not match the requested sort order')
+        return _decode_value(value, column), int(row_id)
+    except (ValueError, TypeError) as e:
+        if isinstance(e, PaginationError):
+            raise
+        raise PaginationError('Invalid cursor')
+
+def keyset_paginate(query, model, sort_columns, args, default_direction):
+    """
+    Applies sorting and keyset pagination on (sort column, id) to a select()
+
+    Args:
+        query: select() of the model, already filtered
+        model: Model class whose id breaks ties between equal sort values
+        sort_columns: Dict of allowed sort names to columns
+        args: Mapping of query string arguments (sort, direction, per_page, cursor)
+        default_direction: 'asc' or 'desc' when no direction is given
+
+    Returns:
+        Page: The rows of the requested page and the cursor of the next one
+    """
+    sort = args.get('sort') or next(iter(sort_columns))
+    if sort not in sort_columns:
+        raise PaginationError(f"Cannot sort by {sort}")
+    direction = args.get('direction') or default_direction
+    if direction not in ('asc', 'desc'):
+        raise PaginationError(f"Invalid direction: {direction}")
+
+    column = sort_columns[sort]
+    per_page = _per_page(args)
+    descending = direction == 'desc'
+
+    # NULLs go where the database puts them anyway, so the sort indexes still
+    # apply: first in ascending order on SQLite, last on PostgreSQL
+    nullable = column.expression.nullable
+    nulls_first = descending if db.session.get_bind().dialect.name == 'postgresql' else not descending
+
+    cursor = args.get('cursor')
+    if cursor:
+        value, row_id = decode_cursor(cursor, sort, direction, column)
+        id_after = model.id < row_id if descending else model.id > row_id
+        if value is None:
+            # The previous page ended among the NULLs
+            after = and_(column.is_(None), id_after)
+            if nulls_first:
+                after = or_(after, column.is_not(None))
+        else:
+            after = or_(column < value if descending else column > value, and_(column == value, id_after))
+            if nullable and not nulls_first:
+                after = or_(after, column.is_(None))
+        query = query.where(after)
+
+    order = column.desc() if descending else column.asc()
+    if nullable:
+        order = order.nulls_first() if nulls_first else order.nulls_last()
+    query = query.order_by(order, model.id.desc() if descending else model.id.asc())
+
+    # Fetch one extra row to know whether another page exists
+    rows = db.session.scalars(query.limit(per_page + 1)).all()
+    items = rows[:per_page]
+
+    next_cursor = None
+    if len(rows) > per_page:
+        last = items[-1]
+        next_cursor = encode_cursor(sort, direction, getattr(last, column.key), last.id)
+
+    return Page(items=items, per_page=per_page, sort=sort, direction=direction, next_cursor=next_cursor)
+
+def invoice_query(user_id, filters):
+    """Returns a select() of the user's invoices matching the filters"""
+    return filters.apply(select(Invoice).where(Invoice.user_id == user_id))
+
+def paginate_invoices(user_id, args):
+    """
+    Returns one page of the user's invoices
+
+    Args:
+        user_id: ID of the user
+        args: Mapping of query string arguments with filters and paging options
+
+    Returns:
+        tuple: (Page, InvoiceFilters)
+    """
+    filters = InvoiceFilters.from_args(args)
+    query = invoice_query(user_id, filters).options(*invoice_list_options())
+    page = keyset_paginate(query, Invoice, INVOICE_SORT_COLUMNS, args, 'desc')
+    return page, filters
+
+def paginate_customers(user_id, args):
+    """
+    Returns one page of the user's customers, optionally filtered by name prefix
+
+    Args:
+        user_id: ID of the user
+        args: Mapping of query string arguments (q, sort, direction, per_page, cursor)
+
+    Returns:
+        Page: The customers of the requested page
+    """
+    query = select(Customer).where(Customer.user_id == user_id)
+    name_prefix = args.get('q', '').strip()
+    if name_prefix:
+        query = query.where(Customer.name.startswith(name_prefix, autoescape=True))
+    return keyset_paginate(query, Customer, CUSTOMER_SORT_COLUMNS, args, 'asc')
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from flask import current_app
+from pdf_renderer import get_logo_store
+from utils import generate_pdf
+
+TEMPLATE_NAME = 'invoice_pdf_template.html'
+
+# Fields that change the rendered document
+INVOICE_FIELDS = ('id', 'invoice_number', 'date_issued', 'date_due', 'status', 'notes',
+                  'tax_rate', 'subtotal', 'tax_amount', 'total')
+ITEM_FIELDS = ('id', 'description', 'quantity', 'unit_price', 'amount')
+CUSTOMER_FIELDS = ('id', 'name', 'email', 'address', 'phone')
+ISSUER_FIELDS = ('id', 'username', 'email', 'business_name', 'business_address',
+                 'business_phone', 'business_logo_url')
+
+_template_versions = {}
+
+def template_version():
+    """Returns the configured template version combined with a hash of the template source"""
+    configured = current_app.config.get('PDF_TEMPLATE_VERSION', '1')
+    if configured not in _template_versions:
+        try:
+            source = current_app.jinja_env.loader.get_source(current_app.jinja_env, TEMPLATE_NAME)[0]
+        except Exception:
+            source = ''
+        digest = hashlib.sha256(source.encode()).hexdigest()[:16]
+        _template_versions[configured] = f"{configured}:{digest}"
+    return _template_versions[configured]
+
+def _fields(obj, names):
+    return [getattr(obj, name) for name in names] if obj is not None else None
+
+def _logo_digest(issuer):
+    """Hash of the logo copy the renders would embed, None while the store lacks it"""
+    url = issuer.business_logo_url if issuer is not None else None
+    if not url or url.startswith('data:') or not current_app.config['PDF_LOGO_DIR']:
+        return None
+    return get_logo_store(current_app.config['PDF_LOGO_DIR']).digest(url)
+
+def invoice_fingerprint(invoice):
+    """
+    Hashes everything the PDF of an invoice depends on
+
+    That includes the stored copy of the issuer's logo, so PDFs rendered
+    while the logo was missing are not served once it is synced.
+
+    Args:
+        invoice: The Invoice object
+
+    Returns:
+        str: Hex digest used as cache key and ETag
+    """
+    payload = [
+        template_version(),
+        _fields(invoice, INVOICE_FIELDS),
+        [_fields(item, ITEM_FIELDS) for item in sorted(invoice.items, key=lambda item: item.id)],
+        _fields(invoice.customer, CUSTOMER_FIELDS),
+        _fields(invoice.user, ISSUER_FIELDS),
+        _logo_digest(invoice.user),
+    ]
+    encoded = json.dumps(payload, default=str, separators=(',', ':')).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+class PdfCache:
+    """
+    Content addressed PDF store on the local filesystem
+
+    Files live at <directory>/<user_id>/<invoice_id>-<fingerprint>.pdf so a
+    user's or an invoice's entries can be dropped without an index. The
+    modification time is refreshed on every hit and the oldest files are
+    evicted once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _user_dir(self, user_id):
+        return os.path.join(self.directory, str(user_id))
+
+    def path(self, user_id, invoice_id, key):
+        return os.path.join(self._user_dir(user_id), f"{invoice_id}-{key}.pdf")
+
+    def get(self, user_id, invoice_id, key):
+        """Returns the path of a cached PDF, or None on a miss"""
+        path = self.path(user_id, invoice_id, key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, user_id, invoice_id, key, data):
+        """Stores a PDF atomically and returns its path"""
+        user_dir = self._user_dir(user_id)
+        os.makedirs(user_dir, exist_ok=True)
+
+        # Older revisions of this invoice can never be requested again
+        self.invalidate_invoice(user_id, invoice_id)
+
+        path = self.path(user_id, invoice_id, key)
+        fd, tmp_path = tempfile.mkstemp(dir=user_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data)
+            if self._size is None or self._size > self.max_bytes:
+                self.evict()
+        return path
+
+    def invalidate_invoice(self, user_id, invoice_id):
+        """Removes every cached revision of an invoice"""
+        user_dir = self._user_dir(user_id)
+        prefix = f"{invoice_id}-"
+        try:
+            names = os.listdir(user_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.startswith(prefix) and name.endswith('.pdf'):
+                try:
+                    os.remove(os.path.join(user_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def invalidate_user(self, user_id):
+        """Removes every cached PDF of a user"""
+        shutil.rmtree(self._user_dir(user_id), ignore_errors=True)
+
+    def evict(self):
+        """Deletes least recently used files until the cache fits in max_bytes"""
+        entries = []
+        total = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        if total > self.max_bytes:
+            # Trim to 90% so that the next few writes do not trigger another walk
+            target = self.max_bytes * 0.9
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        self._size = total
+
+_caches = {}
+
+def get_pdf_cache():
+    """Returns the PdfCache configured for the current app"""
+    directory = current_app.config['PDF_CACHE_DIR']
+    if directory not in _caches:
+        _caches[directory] = PdfCache(directory, current_app.config['PDF_CACHE_MAX_BYTES'])
+    return _caches[directory]
+
+def cached_pdf_file(invoice, key):
+    """Returns the path of the cached PDF of an invoice revision, or None on a miss"""
+    return get_pdf_cache().get(invoice.user_id, invoice.id, key)
+
+def cached_pdf_path(invoice):
+    """
+    Returns the cached PDF of an invoice, rendering it on a miss
+
+    Args:
+        invoice: The Invoice object
+
+    Returns:
+        tuple: (file path, fingerprint)
+    """
+    cache = get_pdf_cache()
+    key = invoice_fingerprint(invoice)
+    path = cache.get(invoice.user_id, invoice.id, key)
+    if path is None:
+        path = cache.put(invoice.user_id, invoice.id, key, generate_pdf(invoice))
+    return path, key
+
+def cached_pdf(invoice):
+    """
+    Returns the PDF of an invoice as bytes, rendering it on a cache miss
+
+    Args:
+        invoice: The Invoice object
+
+    Returns:
+        bytes: PDF file as bytes
+    """
+    path, _ = cached_pdf_path(invoice)
+    try:
+        with open(path, 'rb') as pdf_file:
+            return pdf_file.read()
+    except FileNotFoundError:
+        # Evicted by another process in the meantime
+        return generate_pdf(invoice)
+
+def invalidate_invoice(user_id, invoice_id):
+    """Drops the cached PDF of an invoice after it changed"""
+    get_pdf_cache().invalidate_invoice(user_id, invoice_id)
+
+def invalidate_user(user_id):
+    """Drops all cached PDFs of a user after issuer or customer details changed"""
+    get_pdf_cache().invalidate_user(user_id)
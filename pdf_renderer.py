@@ -0,0 +1,260 @@
+import hashlib
+import ipaddress
+import logging
+import mimetypes
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+from urllib.parse import urlsplit
+from flask import current_app
+from sqlalchemy import select
+import weasyprint
+from weasyprint.text.fonts import FontConfiguration
+from app import db
+from app import User
+
+# Largest logo `sync_logos` stores, bigger downloads are refused
+MAX_LOGO_BYTES = 2 * 1024 * 1024
+LOGO_FETCH_TIMEOUT = 10
+
+# Seconds a logo missing from the store is taken as still missing
+LOGO_MISS_TTL = 300
+
+class LogoStore:
+    """
+    Local copies of the users' logo images, one file per URL
+
+    Files are named after the SHA-256 of the URL with an extension giving
+    the image type. Renders only read the directory; `sync_logos` fills it.
+    A process keeps the copies it has read, so workers pick up logos
+    replaced by `sync_logos(refresh=True)` when they restart, and remembers
+    misses for LOGO_MISS_TTL seconds.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.loaded = {}
+        self.digests = {}
+        self.missing = {}
+
+    def _stem(self, url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _find(self, url):
+        stem = self._stem(url)
+        try:
+            names = [name for name in os.listdir(self.directory) if name.split('.', 1)[0] == stem]
+        except FileNotFoundError:
+            return None
+        return os.path.join(self.directory, names[0]) if names else None
+
+    def path(self, url):
+        """Returns the path of the stored copy of a URL, or None"""
+        with self.lock:
+            missed = self.missing.get(url)
+        if missed is not None and time.monotonic() - missed < LOGO_MISS_TTL:
+            return None
+        path = self._find(url)
+        with self.lock:
+            if path is None:
+                self.missing[url] = time.monotonic()
+            else:
+                self.missing.pop(url, None)
+        return path
+
+    def get(self, url):
+        """
+        Returns:
+            tuple: (image bytes, MIME type) of the stored copy, or None
+        """
+        with self.lock:
+            if url in self.loaded:
+                return self.loaded[url]
+        path = self.path(url)
+        if path is None:
+            return None
+        with open(path, 'rb') as logo_file:
+            logo = (logo_file.read(), mimetypes.guess_type(path)[0])
+        with self.lock:
+            self.loaded[url] = logo
+        return logo
+
+    def digest(self, url):
+        """Returns the SHA-256 of the stored copy of a URL, or None when the renders lack it"""
+        with self.lock:
+            if url in self.digests:
+                return self.digests[url]
+        logo = self.get(url)
+        if logo is None:
+            return None
+        digest = hashlib.sha256(logo[0]).hexdigest()
+        with self.lock:
+            self.digests[url] = digest
+        return digest
+
+    def put(self, url, data, mime_type):
+        """Stores an image for a URL, replacing an earlier copy"""
+        os.makedirs(self.directory, exist_ok=True)
+        extension = mimetypes.guess_extension(mime_type or '') or '.img'
+        old_path = self._find(url)
+        target = os.path.join(self.directory, self._stem(url) + extension)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.logo-')
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, target)
+        if old_path and old_path != target:
+            os.remove(old_path)
+        with self.lock:
+            self.loaded.pop(url, None)
+            self.digests.pop(url, None)
+            self.missing.pop(url, None)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_logo_store(directory):
+    """Returns the LogoStore of a directory shared by the renderers and cache keys of this process"""
+    with _stores_lock:
+        if directory not in _stores:
+            _stores[directory] = LogoStore(directory)
+        return _stores[directory]
+
+class PdfRenderer:
+    """
+    WeasyPrint state kept between the renders of one thread
+
+    Holds one FontConfiguration, the compiled PDF stylesheet and the image
+    cache WeasyPrint fills while rendering, so only the first invoice pays
+    for font discovery, stylesheet parsing and logo decoding. Resources are
+    resolved by `url_fetcher`: data: URLs are decoded in place, any other
+    URL is served from the LogoStore and never fetched over the network.
+    """
+
+    def __init__(self, stylesheet_path=None, logo_dir=None):
+        self.font_config = FontConfiguration()
+        self.stylesheets = []
+        if stylesheet_path and os.path.exists(stylesheet_path):
+            self.stylesheets.append(weasyprint.CSS(filename=stylesheet_path, font_config=self.font_config))
+        self.logos = get_logo_store(logo_dir) if logo_dir else None
+        self.image_cache = {}
+
+    def url_fetcher(self, url):
+        if url.startswith('data:'):
+            return weasyprint.default_url_fetcher(url)
+        logo = self.logos.get(url) if self.logos else None
+        if logo is None:
+            # WeasyPrint logs the error and renders the document without the image
+            raise ValueError(f"{url} is not in the local logo store, run `flask pdf-logos sync`")
+        data, mime_type = logo
+        return {'string': data, 'mime_type': mime_type, 'redirected_url': url}
+
+    def render(self, html):
+        """
+        Renders an HTML document
+
+        Returns:
+            bytes: The PDF document
+        """
+        document = weasyprint.HTML(string=html, url_fetcher=self.url_fetcher)
+        return document.write_pdf(
+            stylesheets=self.stylesheets,
+            font_config=self.font_config,
+            cache=self.image_cache
+        )
+
+_local = threading.local()
+
+def get_renderer():
+    """
+    Returns the renderer of the calling thread for the current app's configuration
+
+    WeasyPrint objects are not safe to share between threads, so each
+    thread (and each process of the render pools) warms up its own.
+    """
+    config = current_app.config
+    key = (config['PDF_STYLESHEET'], config['PDF_LOGO_DIR'])
+    renderers = getattr(_local, 'renderers', None)
+    if renderers is None:
+        renderers = _local.renderers = {}
+    if key not in renderers:
+        renderers[key] = PdfRenderer(*key)
+    return renderers[key]
+
+def _require_public_url(url):
+    """
+    Refuses URLs that would make the server fetch from itself or its network
+
+    Logo URLs are typed by users, so only http and https URLs whose host
+    resolves to global addresses are fetched.
+
+    Raises:
+        ValueError: If the URL is not http(s) or its host has a loopback, private, link-local or reserved address
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError(f"{url} is not an http or https URL")
+    for *_, sockaddr in socket.getaddrinfo(parts.hostname, parts.port or parts.scheme, proto=socket.IPPROTO_TCP):
+        address = ipaddress.ip_address(sockaddr[0].split('%', 1)[0])
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"{url} resolves to the internal address {address}")
+
+class _PublicRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Checks every redirect target like the URL itself"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        _require_public_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+def _download(url):
+    _require_public_url(url)
+    request = urllib.request.Request(url, headers={'User-Agent': 'invoice-pdf-logos'})
+    opener = urllib.request.build_opener(_PublicRedirectHandler)
+    with opener.open(request, timeout=LOGO_FETCH_TIMEOUT) as response:
+        mime_type = response.headers.get_content_type()
+        if not mime_type.startswith('image/'):
+            raise ValueError(f"{url} is not an image ({mime_type})")
+        data = response.read(MAX_LOGO_BYTES + 1)
+    if len(data) > MAX_LOGO_BYTES:
+        raise ValueError(f"{url} is larger than {MAX_LOGO_BYTES} bytes")
+    return data, mime_type
+
+def sync_logos(refresh=False):
+    """
+    Downloads the logos of all users into PDF_LOGO_DIR
+
+    Only http and https URLs of public hosts are fetched. The PDFs cached
+    for the returned users were rendered without their logo or with an
+    older copy, the caller invalidates them.
+
+    Args:
+        refresh: Download logos that are already stored again
+
+    Returns:
+        tuple: (IDs of users whose logo was stored, list of (url, error) for failed ones)
+    """
+    store = get_logo_store(current_app.config['PDF_LOGO_DIR'])
+    rows = db.session.execute(
+        select(User.id, User.business_logo_url).where(User.business_logo_url.is_not(None), User.business_logo_url != '')
+    ).all()
+    users_by_url = {}
+    for user_id, url in rows:
+        users_by_url.setdefault(url, []).append(user_id)
+
+    updated_user_ids, failures = [], []
+    for url, user_ids in sorted(users_by_url.items()):
+        if urlsplit(url).scheme not in ('http', 'https'):
+            continue
+        if not refresh and store.path(url) is not None:
+            continue
+        try:
+            store.put(url, *_download(url))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not fetch logo {url}: {e}")
+            failures.append((url, str(e)))
+            continue
+        updated_user_ids.extend(user_ids)
+    return updated_user_ids, failures
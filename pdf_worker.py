@@ -0,0 +1,200 @@
+import logging
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+from sqlalchemy import select, update
+from app import app, db
+from app import Invoice, PdfJob
+from pdf_cache import cached_pdf
+from query_profiles import invoice_detail_options
+
+# Job states stored in PdfJob.status
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+def enqueue_pdf_job(invoice):
+    """
+    Queues a PDF render of an invoice, reusing a job that is already waiting
+
+    Args:
+        invoice: The Invoice object
+
+    Returns:
+        PdfJob: The queued or running job
+    """
+    job = db.session.scalars(
+        select(PdfJob)
+        .where(PdfJob.invoice_id == invoice.id, PdfJob.status.in_((QUEUED, RUNNING)))
+        .order_by(PdfJob.created_at.desc())
+        .limit(1)
+    ).first()
+    if job is not None:
+        return job
+
+    job = PdfJob(id=uuid.uuid4().hex, status=QUEUED, user_id=invoice.user_id, invoice_id=invoice.id)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def claim_jobs(limit):
+    """
+    Marks up to `limit` queued jobs as running for this worker
+
+    A job is only claimed when the conditional UPDATE still finds it queued,
+    so several workers can poll the same table safely.
+
+    Returns:
+        list: IDs of the claimed jobs
+    """
+    candidates = db.session.scalars(
+        select(PdfJob.id)
+        .where(PdfJob.status == QUEUED)
+        .order_by(PdfJob.created_at)
+        .limit(limit)
+    ).all()
+
+    claimed = []
+    for job_id in candidates:
+        result = db.session.execute(
+            update(PdfJob)
+            .where(PdfJob.id == job_id, PdfJob.status == QUEUED)
+            .values(status=RUNNING, started_at=datetime.utcnow(), attempts=PdfJob.attempts + 1)
+        )
+        if result.rowcount == 1:
+            claimed.append(job_id)
+    db.session.commit()
+    return claimed
+
+def requeue_stale_jobs():
+    """
+    Recovers jobs left running by a worker that died
+
+    Jobs older than PDF_JOB_TIMEOUT are queued again, or failed once they
+    reached PDF_JOB_MAX_ATTEMPTS.
+
+    Returns:
+        int: Number of recovered jobs
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['PDF_JOB_TIMEOUT'])
+    max_attempts = app.config['PDF_JOB_MAX_ATTEMPTS']
+    stale = (PdfJob.status == RUNNING, PdfJob.started_at < cutoff)
+
+    requeued = db.session.execute(
+        update(PdfJob).where(*stale, PdfJob.attempts < max_attempts).values(status=QUEUED)
+    ).rowcount
+    failed = db.session.execute(
+        update(PdfJob).where(*stale, PdfJob.attempts >= max_attempts)
+        .values(status=FAILED, error='Render timed out', finished_at=datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+    return requeued + failed
+
+def purge_jobs(older_than_days):
+    """Deletes finished jobs older than the given age"""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    deleted = db.session.execute(
+        PdfJob.__table__.delete()
+        .where(PdfJob.status.in_((DONE, FAILED)), PdfJob.finished_at < cutoff)
+    ).rowcount
+    db.session.commit()
+    return deleted
+
+def init_render_process():
+    """Process pool initializer: drop database connections inherited from the parent"""
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+def _render(invoice_id):
+    invoice = db.session.get(Invoice, invoice_id, options=invoice_detail_options())
+    if invoice is None:
+        raise LookupError(f"Invoice {invoice_id} no longer exists")
+    return cached_pdf(invoice)
+
+def render_invoice_pdf(invoice_id):
+    """
+    Renders the PDF of an invoice inside a pool process
+
+    Args:
+        invoice_id: ID of the invoice
+
+    Returns:
+        bytes: The PDF document
+    """
+    with app.test_request_context():
+        return _render(invoice_id)
+
+def run_job(job_id):
+    """
+    Renders one claimed job into the PDF cache and records its outcome
+
+    Runs inside a pool process. Errors are recorded on the job instead of
+    being raised so that one broken invoice does not stop the worker.
+
+    Returns:
+        tuple: (job ID, final status)
+    """
+    with app.test_request_context():
+        job = db.session.get(PdfJob, job_id)
+        if job is None:
+            return job_id, FAILED
+        try:
+            _render(job.invoice_id)
+            job.status = DONE
+            job.error = None
+        except Exception as e:
+            db.session.rollback()
+            job = db.session.get(PdfJob, job_id)
+            job.status = FAILED
+            job.error = str(e)
+            logging.exception(f"PDF job {job_id} failed")
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        return job_id, job.status
+
+def create_render_pool(processes=None):
+    """Returns a process pool whose workers can render invoice PDFs"""
+    return ProcessPoolExecutor(
+        max_workers=processes or app.config['PDF_WORKER_PROCESSES'],
+        initializer=init_render_process
+    )
+
+def run_worker(processes=None, poll_interval=1.0, once=False):
+    """
+    Processes queued jobs with a pool of render processes
+
+    Args:
+        processes: Number of render processes (PDF_WORKER_PROCESSES by default)
+        poll_interval: Seconds to sleep when the queue is empty
+        once: Return as soon as the queue is drained instead of polling forever
+
+    Returns:
+        int: Number of jobs processed
+    """
+    processes = processes or app.config['PDF_WORKER_PROCESSES']
+    processed = 0
+    in_flight = set()
+
+    with create_render_pool(processes) as pool:
+        while True:
+            with app.app_context():
+                requeue_stale_jobs()
+                free = processes - len(in_flight)
+                claimed = claim_jobs(free) if free > 0 else []
+
+            for job_id in claimed:
+                in_flight.add(pool.submit(run_job, job_id))
+
+            if not in_flight:
+                if once:
+                    return processed
+                time.sleep(poll_interval)
+                continue
+
+            done, in_flight = wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                job_id, status = future.result()
+                processed += 1
+                logging.info(f"PDF job {job_id} {status}")
@@ -0,0 +1,237 @@
+import re
+from datetime import date, timedelta
+from flask import url_for
+from sqlalchemy import event, func, select
+from app import app, db
+from app import Customer, Invoice, InvoiceDailyRollup, InvoiceItem, RecurringInvoice, UserInvoiceStats
+from customer_lookup import AUTOCOMPLETE_LIMIT, autocomplete_query
+import scratch
+
+# Most SQL statements each route may issue, whatever the amount of data. Cached
+# pages are measured with the page cache off, which adds the data version lookup
+QUERY_BUDGETS = {
+    'dashboard': 5,
+    'invoices': 3,
+    'view_invoice': 3,
+    # A miss queues a render job and returns its status document
+    'download_invoice_pdf': 5,
+    'send_invoice_email': 6,
+}
+
+# SQLite reports "SCAN <table>" when it walks a whole table or index
+SQLITE_FULL_SCAN = re.compile(r'\bSCAN (?!CONSTANT ROW)(\w+)')
+POSTGRES_FULL_SCAN = re.compile(r'Seq Scan on (\w+)')
+
+def hot_queries(user_id=1, invoice_id=1, customer_id=1):
+    """
+    Returns the statements issued by the busiest routes
+
+    Returns:
+        list: (name, select statement) tuples
+    """
+    return [
+        ('dashboard recent invoices',
+         select(Invoice).where(Invoice.user_id == user_id)
+         .order_by(Invoice.created_at.desc()).limit(10)),
+        ('dashboard statistics',
+         select(UserInvoiceStats).where(UserInvoiceStats.user_id == user_id)),
+        ('dashboard customer count',
+         select(func.count(Customer.id)).where(Customer.user_id == user_id)),
+        ('invoice list',
+         select(Invoice).where(Invoice.user_id == user_id)
+         .order_by(Invoice.created_at.desc(), Invoice.id.desc()).limit(26)),
+        ('invoice list by status',
+         select(Invoice).where(Invoice.user_id == user_id, Invoice.status == 'Unpaid')
+         .order_by(Invoice.created_at.desc(), Invoice.id.desc()).limit(26)),
+        ('invoice list by due date',
+         select(Invoice).where(Invoice.user_id == user_id)
+         .order_by(Invoice.date_due.desc(), Invoice.id.desc()).limit(26)),
+        ('invoice by number',
+         select(Invoice).where(Invoice.user_id == user_id, Invoice.invoice_number == 'INV-000000-001')),
+        ('customer list',
+         select(Customer).where(Customer.user_id == user_id)
+         .order_by(Customer.name.asc(), Customer.id.asc()).limit(26)),
+        ('customer autocomplete',
+         autocomplete_query(user_id, 'ac', AUTOCOMPLETE_LIMIT, db.engine.dialect.name)),
+        ('customer invoices',
+         select(Invoice.id).where(Invoice.customer_id == customer_id).limit(1)),
+        ('invoice items',
+         select(InvoiceItem).where(InvoiceItem.invoice_id == invoice_id)),
+        ('report rollups',
+         select(InvoiceDailyRollup).where(
+             InvoiceDailyRollup.user_id == user_id,
+             InvoiceDailyRollup.day >= date(2000, 1, 1), InvoiceDailyRollup.day <= date(2000, 12, 31)
+         )),
+        ('recurring invoices due',
+         select(RecurringInvoice.user_id).where(
+             RecurringInvoice.status == 'active', RecurringInvoice.next_run_date <= date(2000, 1, 1)
+         ).distinct()),
+        ('overdue sweep',
+         select(Invoice.id).where(Invoice.status == 'Unpaid', Invoice.date_due < date(2000, 1, 1))),
+    ]
+
+def explain(connection, statement):
+    """
+    Returns the query plan of a statement as a list of lines
+
+    Args:
+        connection: Connection to a SQLite or PostgreSQL database
+        statement: select() statement to explain
+    """
+    compiled = statement.compile(dialect=connection.dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+
+    if connection.dialect.name == 'postgresql':
+        # Only report sequential scans the planner cannot avoid
+        connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        rows = connection.exec_driver_sql('EXPLAIN ' + str(compiled), params)
+        return [row[0] for row in rows]
+
+    rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), params)
+    return [row[-1] for row in rows]
+
+def full_table_scans(connection, plan):
+    """Returns the table names a query plan reads in full"""
+    pattern = POSTGRES_FULL_SCAN if connection.dialect.name == 'postgresql' else SQLITE_FULL_SCAN
+    return [match.group(1) for line in plan for match in pattern.finditer(line)]
+
+def check_query_plans():
+    """
+    Explains every hot query and collects those that scan a whole table
+
+    Returns:
+        list: (name, scanned tables, plan lines) for each failing query
+    """
+    failures = []
+    with db.engine.connect() as connection:
+        for name, statement in hot_queries():
+            with connection.begin():
+                plan = explain(connection, statement)
+                scanned = full_table_scans(connection, plan)
+            if scanned:
+                failures.append((name, scanned, plan))
+    return failures
+
+class QueryCounter:
+    """
+    Context manager recording every SQL statement sent through the engine
+
+    Example:
+        with QueryCounter() as counter:
+            client.get('/invoices')
+        assert counter.count <= 2
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        self.engine = self.engine or db.engine
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+        return False
+
+def _seed_budget_user(invoice_count, item_count):
+    """Creates a throwaway user owning `invoice_count` invoices of `item_count` items"""
+    user = scratch.create_scratch_user(scratch.scratch_username('query-budget'))
+
+    customers = [
+        Customer(name=f"Customer {number}", email=f"customer{number}@example.invalid", user_id=user.id)
+        for number in range(max(1, invoice_count // 5))
+    ]
+    db.session.add_all(customers)
+    db.session.flush()
+
+    today = date.today()
+    for number in range(invoice_count):
+        invoice = Invoice(
+            invoice_number=f"QB-{number:06d}",
+            date_issued=today,
+            date_due=today + timedelta(days=30),
+            status='Unpaid',
+            subtotal=10.0 * item_count,
+            tax_rate=0.0,
+            tax_amount=0.0,
+            total=10.0 * item_count,
+            user_id=user.id,
+            customer_id=customers[number % len(customers)].id
+        )
+        invoice.items = [
+            InvoiceItem(description=f"Item {line}", quantity=1, unit_price=10.0, amount=10.0)
+            for line in range(item_count)
+        ]
+        db.session.add(invoice)
+    db.session.commit()
+    return user.id
+
+def _budget_requests(invoice_id):
+    return [
+        ('dashboard', 'GET', url_for('dashboard')),
+        ('invoices', 'GET', url_for('invoices')),
+        ('view_invoice', 'GET', url_for('view_invoice', invoice_id=invoice_id)),
+        ('download_invoice_pdf', 'GET', url_for('download_invoice_pdf', invoice_id=invoice_id)),
+        ('send_invoice_email', 'POST', url_for('send_invoice_email', invoice_id=invoice_id)),
+    ]
+
+def check_query_budgets(sizes=((1, 1), (50, 20))):
+    """
+    Drives the invoice pages through the test client and counts their SQL
+
+    Each data set is created for a throwaway user and deleted afterwards,
+    the check refuses to run outside a scratch database. A route fails when it issues
+    more statements than its QUERY_BUDGETS entry or when its count grows
+    with the number of invoices or items, the signature of an N+1 query.
+
+    Args:
+        sizes: (invoices, items per invoice) data sets to compare
+
+    Returns:
+        list: (route, counts per data set, statements of the largest set) for each failing route
+
+    Raises:
+        scratch.ScratchDatabaseError: If the database has real users
+    """
+    scratch.require_scratch_database()
+    counts = {name: [] for name in QUERY_BUDGETS}
+    statements = {}
+
+    with scratch.harness_config():
+        for invoice_count, item_count in sizes:
+            user_id = _seed_budget_user(invoice_count, item_count)
+            try:
+                invoice_id = db.session.scalar(
+                    select(Invoice.id).where(Invoice.user_id == user_id).order_by(Invoice.id).limit(1)
+                )
+                # A new client per data set, so no flashed message of the last one shows up
+                client = scratch.logged_in_client(user_id)
+
+                with app.test_request_context():
+                    requests = _budget_requests(invoice_id)
+                for name, method, url in requests:
+                    # A fresh app context gives the request its own session and g, as in production
+                    with app.app_context(), QueryCounter() as counter:
+                        client.open(url, method=method)
+                    counts[name].append(counter.count)
+                    statements[name] = counter.statements
+            finally:
+                db.session.rollback()
+                scratch.delete_user_data(user_id)
+
+    failures = []
+    for name, budget in QUERY_BUDGETS.items():
+        if max(counts[name]) > budget or len(set(counts[name])) > 1:
+            failures.append((name, counts[name], statements[name]))
+    return failures
@@ -0,0 +1,25 @@
+from sqlalchemy.orm import configure_mappers, joinedload, selectinload
+from app import Invoice
+
+# Backrefs such as Invoice.customer only exist once the mappers are configured
+configure_mappers()
+
+def invoice_detail_options():
+    """
+    Loader options for pages that show a single invoice in full
+
+    The customer and issuer are joined into the invoice row and the items
+    arrive in one extra SELECT, so the view, the PDF template and the email
+    body never trigger lazy loads.
+    """
+    return (
+        joinedload(Invoice.customer),
+        joinedload(Invoice.user),
+        selectinload(Invoice.items),
+    )
+
+def invoice_list_options():
+    """Loader options for invoice lists, which show the customer of every row"""
+    return (
+        joinedload(Invoice.customer),
+    )
@@ -0,0 +1,85 @@
+from dataclasses import dataclass
+from decimal import Decimal
+from sqlalchemy import func, or_, select
+from app import db
+from app import Invoice, InvoiceItem
+from money import MONEY_SCALE, minor_units, sql_line_amount, sql_tax_amount
+
+@dataclass(frozen=True)
+class TotalMismatch:
+    """A stored amount that differs from the one computed from the items"""
+    invoice_id: int
+    user_id: int
+    invoice_number: str
+    field: str
+    stored: Decimal
+    expected: Decimal
+    item_id: int = None
+
+def _money(cents):
+    return Decimal(int(cents or 0)).scaleb(-MONEY_SCALE)
+
+def _item_mismatches(user_id, batch_size):
+    expected = sql_line_amount(InvoiceItem.quantity, InvoiceItem.unit_price)
+    query = (
+        select(
+            InvoiceItem.id, InvoiceItem.invoice_id, Invoice.user_id, Invoice.invoice_number,
+            minor_units(InvoiceItem.amount), expected
+        )
+        .join(Invoice, Invoice.id == InvoiceItem.invoice_id)
+        .where(minor_units(InvoiceItem.amount) != expected)
+        .order_by(InvoiceItem.invoice_id, InvoiceItem.id)
+    )
+    if user_id is not None:
+        query = query.where(Invoice.user_id == user_id)
+
+    for item_id, invoice_id, owner_id, number, stored, computed in db.session.execute(
+        query.execution_options(yield_per=batch_size)
+    ):
+        yield TotalMismatch(invoice_id, owner_id, number, 'item amount', _money(stored), _money(computed), item_id)
+
+def _invoice_mismatches(user_id, batch_size):
+    item_sums = (
+        select(InvoiceItem.invoice_id, func.sum(minor_units(InvoiceItem.amount)).label('subtotal'))
+        .group_by(InvoiceItem.invoice_id)
+        .subquery()
+    )
+    subtotal = func.coalesce(item_sums.c.subtotal, 0)
+    tax_amount = sql_tax_amount(subtotal, Invoice.tax_rate)
+    total = subtotal + tax_amount
+
+    stored = (minor_units(Invoice.subtotal), minor_units(Invoice.tax_amount), minor_units(Invoice.total))
+    expected = (subtotal, tax_amount, total)
+    query = (
+        select(Invoice.id, Invoice.user_id, Invoice.invoice_number, *stored, *expected)
+        .outerjoin(item_sums, item_sums.c.invoice_id == Invoice.id)
+        .where(or_(*(func.coalesce(column, 0) != value for column, value in zip(stored, expected))))
+        .order_by(Invoice.id)
+    )
+    if user_id is not None:
+        query = query.where(Invoice.user_id == user_id)
+
+    for row in db.session.execute(query.execution_options(yield_per=batch_size)):
+        invoice_id, owner_id, number = row[:3]
+        for field, stored_cents, expected_cents in zip(('subtotal', 'tax_amount', 'total'), row[3:6], row[6:9]):
+            if (stored_cents or 0) != expected_cents:
+                yield TotalMismatch(invoice_id, owner_id, number, field, _money(stored_cents), _money(expected_cents))
+
+def find_total_mismatches(user_id=None, batch_size=1000):
+    """
+    Recomputes every line amount and invoice total in SQL and yields the differences
+
+    The whole check is two statements working on the stored integers: one
+    over all items comparing amount with quantity * unit_price, and one over
+    all invoices comparing subtotal, tax and total with the sums of their
+    items. Rounding is half up to the cent, as in money.invoice_totals.
+
+    Args:
+        user_id: Restrict the check to one user (all users when None)
+        batch_size: Rows fetched per round trip
+
+    Yields:
+        TotalMismatch: One entry per differing value
+    """
+    yield from _item_mismatches(user_id, batch_size)
+    yield from _invoice_mismatches(user_id, batch_size)
@@ -0,0 +1,325 @@
+import calendar
+import logging
+import threading
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from sqlalchemy import bindparam, insert, select, text, update
+from sqlalchemy.exc import SQLAlchemyError
+from app import app, db
+from app import Invoice, InvoiceItem, RecurringInvoice, RecurringInvoiceItem
+from money import ZERO, invoice_totals, line_amount
+from page_cache import bump_data_version
+from stats import apply_stats_deltas
+import analytics
+import numbering
+import search
+
+# Months between two occurrences of each frequency, weekly schedules step by days
+FREQUENCY_MONTHS = {'monthly': 1, 'quarterly': 3, 'yearly': 12}
+FREQUENCIES = ('weekly',) + tuple(FREQUENCY_MONTHS)
+
+ACTIVE = 'active'
+ENDED = 'ended'
+
+# Arbitrary key serializing the runs of one user on PostgreSQL
+GENERATE_LOCK_KEY = 720311
+
+class RecurringInvoiceError(ValueError):
+    """Raised for an invalid recurring invoice schedule"""
+
+@dataclass
+class GenerationResult:
+    """Outcome of one generator run"""
+    today: date
+    created: int = 0
+    users: int = 0
+    failures: list = field(default_factory=list)
+
+    def to_dict(self):
+        return {
+            'today': self.today.isoformat(),
+            'created': self.created,
+            'users': self.users,
+            'failures': [{'user_id': user_id, 'error': error} for user_id, error in self.failures],
+        }
+
+def occurrence(start_date, frequency, interval, index):
+    """
+    Returns the date of occurrence number `index` (0 based) of a schedule
+
+    Monthly steps keep the day of the start date, clamped to the length of
+    the month, so a schedule starting on the 31st runs on the last day of
+    shorter months and goes back to the 31st afterwards.
+    """
+    if frequency == 'weekly':
+        return start_date + timedelta(weeks=interval * index)
+    months = start_date.month - 1 + FREQUENCY_MONTHS[frequency] * interval * index
+    year, month = start_date.year + months // 12, months % 12 + 1
+    return date(year, month, min(start_date.day, calendar.monthrange(year, month)[1]))
+
+def validate_schedule(frequency, interval, start_date, end_date=None):
+    """
+    Raises:
+        RecurringInvoiceError: If the schedule cannot produce invoices
+    """
+    if frequency not in FREQUENCIES:
+        raise RecurringInvoiceError(f"Unknown frequency: {frequency}")
+    if interval < 1:
+        raise RecurringInvoiceError('The interval must be at least 1')
+    if end_date is not None and end_date < start_date:
+        raise RecurringInvoiceError('The end date is before the start date')
+
+def create_from_invoice(invoice, frequency, start_date, interval=1, end_date=None):
+    """
+    Makes a recurring invoice that copies the customer, items, tax rate and notes of an invoice
+
+    Generated invoices are due as many days after issue as this one.
+
+    Args:
+        invoice: Invoice to copy, with its items
+        frequency: One of FREQUENCIES
+        start_date: Date of the first generated invoice
+        interval: Number of frequency periods between two invoices
+        end_date: Last date an invoice may be generated on (open ended when None)
+
+    Returns:
+        RecurringInvoice: The created recurring invoice
+
+    Raises:
+        RecurringInvoiceError: If the schedule is invalid or the invoice has no items
+    """
+    validate_schedule(frequency, interval, start_date, end_date)
+    if not invoice.items:
+        raise RecurringInvoiceError('An invoice without items cannot recur')
+
+    recurring = RecurringInvoice(
+        frequency=frequency,
+        interval=interval,
+        start_date=start_date,
+        end_date=end_date,
+        next_run_date=start_date,
+        runs=0,
+        due_days=max((invoice.date_due - invoice.date_issued).days, 0),
+        tax_rate=invoice.tax_rate,
+        notes=invoice.notes,
+        status=ACTIVE,
+        user_id=invoice.user_id,
+        customer_id=invoice.customer_id
+    )
+    recurring.items = [
+        RecurringInvoiceItem(description=item.description, quantity=item.quantity, unit_price=item.unit_price)
+        for item in sorted(invoice.items, key=lambda item: item.id)
+    ]
+    db.session.add(recurring)
+    db.session.commit()
+    return recurring
+
+def end_recurring(recurring):
+    """Stops a recurring invoice, the invoices it generated stay as they are"""
+    recurring.status = ENDED
+    db.session.commit()
+
+def _schedule_runs(recurring, today):
+    """
+    Lists the dates due by `today`, catching up on runs that were missed
+
+    Returns:
+        tuple: (run dates, runs after them, next run date, status)
+    """
+    dates = []
+    runs, run_date = recurring.runs, recurring.next_run_date
+    while run_date <= today and (recurring.end_date is None or run_date <= recurring.end_date):
+        dates.append(run_date)
+        runs += 1
+        run_date = occurrence(recurring.start_date, recurring.frequency, recurring.interval, runs)
+    ended = recurring.end_date is not None and run_date > recurring.end_date
+    return dates, runs, run_date, ENDED if ended else ACTIVE
+
+def _claim(connection, claims):
+    """
+    Moves the schedules past the runs about to be generated
+
+    Each row only moves from the run count it was read with, so a second
+    generator that read the same rows matches fewer of them.
+
+    Returns:
+        bool: Whether every schedule was still at the run count read
+    """
+    table = RecurringInvoice.__table__
+    statement = (
+        update(table)
+        .where(table.c.id == bindparam('b_id'), table.c.runs == bindparam('b_runs'))
+        .values(
+            runs=bindparam('b_new_runs'),
+            next_run_date=bindparam('b_next_run_date'),
+            status=bindparam('b_status'),
+            updated_at=bindparam('b_updated_at')
+        )
+    )
+    if connection.dialect.supports_sane_multi_rowcount:
+        return connection.execute(statement, claims).rowcount == len(claims)
+    return all(connection.execute(statement, claim).rowcount == 1 for claim in claims)
+
+def _generate_for_user(user_id, today):
+    """Issues the due invoices of one user in the session's transaction, returns how many"""
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key, :user_id)'), {'key': GENERATE_LOCK_KEY, 'user_id': user_id})
+
+    # Plain rows, loading thousands of templates as ORM objects would cost more than the inserts
+    due_now = (
+        RecurringInvoice.user_id == user_id, RecurringInvoice.status == ACTIVE,
+        RecurringInvoice.next_run_date <= today
+    )
+    templates = db.session.execute(
+        select(RecurringInvoice.__table__).where(*due_now).order_by(RecurringInvoice.id)
+    ).all()
+    items_by_template = {}
+    for item in db.session.execute(
+        select(RecurringInvoiceItem.recurring_invoice_id, RecurringInvoiceItem.description,
+               RecurringInvoiceItem.quantity, RecurringInvoiceItem.unit_price)
+        .join(RecurringInvoice, RecurringInvoice.id == RecurringInvoiceItem.recurring_invoice_id)
+        .where(*due_now)
+        .order_by(RecurringInvoiceItem.id)
+    ):
+        items_by_template.setdefault(item.recurring_invoice_id, []).append(item)
+
+    now = datetime.utcnow()
+    claims, due = [], []
+    for recurring in templates:
+        dates, new_runs, next_run_date, status = _schedule_runs(recurring, today)
+        claims.append({
+            'b_id': recurring.id, 'b_runs': recurring.runs, 'b_new_runs': new_runs,
+            'b_next_run_date': next_run_date, 'b_status': status, 'b_updated_at': now,
+        })
+        due.extend((recurring, run_date) for run_date in dates)
+    if not claims:
+        return 0
+    if not _claim(connection, claims):
+        raise RecurringInvoiceError('Another generator run changed these recurring invoices')
+    if not due:
+        return 0
+
+    invoices, item_lists = [], []
+    for recurring, run_date in due:
+        items = [
+            {
+                'description': item.description,
+                'quantity': item.quantity,
+                'unit_price': item.unit_price,
+                'amount': line_amount(item.quantity, item.unit_price),
+                'created_at': now,
+            }
+            for item in items_by_template.get(recurring.id, [])
+        ]
+        subtotal, tax_amount, total = invoice_totals((item['amount'] for item in items), recurring.tax_rate)
+        invoices.append({
+            'date_issued': run_date,
+            'date_due': run_date + timedelta(days=recurring.due_days),
+            'status': 'Unpaid',
+            'notes': recurring.notes,
+            'tax_rate': recurring.tax_rate,
+            'subtotal': subtotal,
+            'tax_amount': tax_amount,
+            'total': total,
+            'user_id': user_id,
+            'customer_id': recurring.customer_id,
+            'created_at': now,
+            'updated_at': now,
+            'recurring_invoice_id': recurring.id,
+            'recurring_date': run_date,
+        })
+        item_lists.append(items)
+
+    # Numbers follow the period of the issue date, one block per period
+    by_period = {}
+    for invoice in invoices:
+        by_period.setdefault(numbering.current_period(invoice['date_issued']), []).append(invoice)
+    for period, rows in sorted(by_period.items()):
+        for invoice, number in zip(rows, numbering.reserve_block(user_id, len(rows), period)):
+            invoice['invoice_number'] = number
+
+    invoice_ids = db.session.scalars(
+        insert(Invoice).returning(Invoice.id, sort_by_parameter_order=True), invoices
+    ).all()
+    db.session.execute(insert(InvoiceItem), [
+        dict(item, invoice_id=invoice_id)
+        for invoice_id, items in zip(invoice_ids, item_lists)
+        for item in items
+    ])
+    search.index_invoices(invoice_ids)
+
+    # Core inserts bypass the flush listeners, keep the summary and rollup tables in step
+    rollup_deltas = {}
+    for invoice in invoices:
+        analytics.add_invoice(rollup_deltas, 1, invoice)
+    apply_stats_deltas(connection, {(user_id, 'Unpaid'): [len(invoices), sum((row['total'] for row in invoices), ZERO)]})
+    analytics.apply_rollup_deltas(connection, rollup_deltas)
+    bump_data_version(connection, [user_id])
+    return len(invoices)
+
+def generate_due_invoices(today=None):
+    """
+    Issues every recurring invoice due on or before `today`
+
+    Each user's invoices are written in one transaction with batched
+    inserts: the schedules are moved forward first, then the invoices and
+    items are inserted with numbers from one reserve_block per numbering
+    period. Running it again the same day finds nothing due, and a
+    concurrent run either waits (PostgreSQL) or fails the user without
+    writing anything, leaving the invoices to the next run. Runs missed
+    while the generator was not running are caught up, each invoice dated
+    on its scheduled day.
+
+    Args:
+        today: Last issue date to generate (today by default)
+
+    Returns:
+        GenerationResult: Counts of the run and the users that failed
+    """
+    today = today or datetime.utcnow().date()
+    result = GenerationResult(today=today)
+    user_ids = db.session.scalars(
+        select(RecurringInvoice.user_id)
+        .where(RecurringInvoice.status == ACTIVE, RecurringInvoice.next_run_date <= today)
+        .distinct()
+        .order_by(RecurringInvoice.user_id)
+    ).all()
+    db.session.rollback()
+
+    for user_id in user_ids:
+        try:
+            created = _generate_for_user(user_id, today)
+            db.session.commit()
+        except (SQLAlchemyError, RecurringInvoiceError) as e:
+            db.session.rollback()
+            logging.warning(f"Recurring invoices of user {user_id} were not generated: {e}")
+            result.failures.append((user_id, str(e)))
+            continue
+        if created:
+            result.created += created
+            result.users += 1
+
+    logging.info(f"Recurring invoice run for {today} created {result.created} invoices for {result.users} users")
+    return result
+
+def start_scheduler(interval):
+    """
+    Runs generate_due_invoices every `interval` seconds in a daemon thread
+
+    Returns:
+        threading.Event: Set it to stop the scheduler
+    """
+    stop_event = threading.Event()
+
+    def loop():
+        while not stop_event.wait(interval):
+            with app.app_context():
+                try:
+                    generate_due_invoices()
+                except Exception:
+                    db.session.rollback()
+                    logging.exception('Recurring invoice run failed')
+
+    threading.Thread(target=loop, name='recurring-invoices', daemon=True).start()
+    return stop_event
@@ -1,14 +1,34 @@
-from flask import render_template, url_for, flash, redirect, request, jsonify, send_file
+from flask import render_template, url_for, flash, redirect, request, jsonify, send_file, Response, stream_with_context, abort, session
 from flask_login import login_user, current_user, logout_user, login_required
+from sqlalchemy.orm import selectinload
 from werkzeug.security import generate_password_hash
-from app import app, db, mail
-from app import User, Customer, Invoice, InvoiceItem
-from forms import RegistrationForm, LoginForm, CustomerForm, InvoiceForm, ProfileForm
+from app import app, db
+from app import User, Customer, Invoice, InvoiceItem, PdfJob, EmailCampaign, RecurringInvoice
+from forms import RegistrationForm, LoginForm, CustomerForm, InvoiceForm, ProfileForm, CsrfForm
 from datetime import datetime, timedelta
-import io
 import json
-from flask_mail import Message
-from utils import generate_pdf
+import pdf_cache
+import page_cache
+import mail_queue
+import campaigns
+import importer
+import numbering
+import search
+import analytics
+import recurring
+from stats import get_dashboard_stats
+from pagination import InvoiceFilters, PaginationError, paginate_invoices, paginate_customers
+from bulk_export import stream_invoice_zip
+from customer_lookup import AUTOCOMPLETE_LIMIT, autocomplete_customers, customer_exists
+import data_export
+from invoice_items import insert_items, parse_item_rows, sync_invoice_items
+from money import RATE_SCALE, invoice_totals, to_decimal
+from query_profiles import invoice_detail_options, invoice_list_options
+from serializers import (
+    customer_to_dict, invoice_to_dict, page_to_dict, pdf_job_to_dict, recurring_invoice_to_dict, report_to_dict,
+    search_hit_to_dict
+)
+import pdf_worker
 
 @app.route('/')
 def index():
@@ -64,55 +84,118 @@ def logout():
 
 @app.route('/dashboard')
 @login_required
+@page_cache.cached_page
 def dashboard():
     # Get recent invoices (last 10)
-    recent_invoices = Invoice.query.filter_by(user_id=current_user.id).order_by(Invoice.created_at.desc()).limit(10).all()
+    recent_invoices = Invoice.query.options(*invoice_list_options()).filter_by(user_id=current_user.id).order_by(Invoice.created_at.desc()).limit(10).all()
     
-    # Get statistics
-    total_invoices = Invoice.query.filter_by(user_id=current_user.id).count()
-    paid_invoices = Invoice.query.filter_by(user_id=current_user.id, status='Paid').count()
-    unpaid_invoices = Invoice.query.filter_by(user_id=current_user.id, status='Unpaid').count()
-    overdue_invoices = Invoice.query.filter_by(user_id=current_user.id, status='Overdue').count()
-    
-    # Calculate total revenue (sum of paid invoices)
-    revenue = 0
-    paid_invoice_list = Invoice.query.filter_by(user_id=current_user.id, status='Paid').all()
-    for invoice in paid_invoice_list:
-        revenue += invoice.total
-    
-    # Get customer count
-    customer_count = Customer.query.filter_by(user_id=current_user.id).count()
+    # Get statistics in a single grouped aggregate
+    stats = get_dashboard_stats(current_user.id)
     
     return render_template(
         'dashboard.html', 
         title='Dashboard',
         recent_invoices=recent_invoices,
-        total_invoices=total_invoices,
-        paid_invoices=paid_invoices,
-        unpaid_invoices=unpaid_invoices,
-        overdue_invoices=overdue_invoices,
-        revenue=revenue,
-        customer_count=customer_count
+        stats=stats,
+        total_invoices=stats.total_invoices,
+        paid_invoices=stats.paid_invoices,
+        unpaid_invoices=stats.unpaid_invoices,
+        overdue_invoices=stats.overdue_invoices,
+        revenue=stats.revenue,
+        customer_count=stats.customer_count
     )
 
 @app.route('/invoices')
 @login_required
+@page_cache.cached_page
 def invoices():
     status_filter = request.args.get('status', '')
     
-    if status_filter and status_filter != 'All':
-        invoices = Invoice.query.filter_by(user_id=current_user.id, status=status_filter).order_by(Invoice.created_at.desc()).all()
-    else:
-        invoices = Invoice.query.filter_by(user_id=current_user.id).order_by(Invoice.created_at.desc()).all()
+    try:
+        page, filters = paginate_invoices(current_user.id, request.args)
+    except PaginationError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('invoices'))
     
     return render_template('dashboard.html', 
                           title='Invoices', 
-                          invoices=invoices, 
+                          invoices=page.items, 
+                          page=page,
+                          filters=filters,
                           active_tab='invoices',
                           status_filter=status_filter)
 
+@app.route('/api/invoices')
+@login_required
+def api_invoices():
+    try:
+        page, filters = paginate_invoices(current_user.id, request.args)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify(page_to_dict(page, invoice_to_dict))
+
+@app.route('/api/search')
+@login_required
+def api_search():
+    query = request.args.get('q', '')
+    limit = min(request.args.get('limit', 20, type=int), app.config['MAX_ITEMS_PER_PAGE'])
+    hits = search.search(current_user.id, query, limit=max(limit, 1))
+    return jsonify({'query': query, 'results': [search_hit_to_dict(hit) for hit in hits]})
+
+@app.route('/api/reports/<name>')
+@login_required
+def api_report(name):
+    if name not in analytics.REPORTS:
+        abort(404)
+    try:
+        date_from, date_to = analytics.report_period(request.args)
+    except analytics.ReportError as e:
+        return jsonify({'error': str(e)}), 400
+    rows = analytics.run_report(name, current_user.id, date_from, date_to)
+    return jsonify(report_to_dict(name, rows, date_from, date_to))
+
+@app.route('/invoices/export.zip')
+@login_required
+def export_invoice_pdfs():
+    try:
+        filters = InvoiceFilters.from_args(request.args)
+    except PaginationError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('invoices'))
+    
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    return Response(
+        stream_with_context(stream_invoice_zip(current_user.id, filters)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="invoices-{stamp}.zip"'}
+    )
+
+@app.route('/export/<dataset>.<fmt>')
+@login_required
+def export_data(dataset, fmt):
+    if dataset not in data_export.DATASETS or fmt not in data_export.FORMATS:
+        abort(404)
+    
+    try:
+        filters = InvoiceFilters.from_args(request.args)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    return Response(
+        stream_with_context(data_export.stream_export(current_user.id, dataset, fmt, filters, request.args)),
+        mimetype=data_export.FORMATS[fmt],
+        headers={
+            'Content-Disposition': f'attachment; filename="{dataset}-{stamp}.{fmt}"',
+            # Let proxies pass chunks through as they are produced
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
 @app.route('/customers', methods=['GET', 'POST'])
 @login_required
+@page_cache.cached_page
 def customers():
     form = CustomerForm()
     
@@ -129,14 +212,36 @@ def customers():
         flash('Customer added successfully!', 'success')
         return redirect(url_for('customers'))
     
-    customers_list = Customer.query.filter_by(user_id=current_user.id).order_by(Customer.name).all()
+    try:
+        page = paginate_customers(current_user.id, request.args)
+    except PaginationError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('customers'))
     
     return render_template('dashboard.html', 
                           title='Customers', 
-                          customers=customers_list, 
+                          customers=page.items, 
+                          page=page,
                           form=form,
                           active_tab='customers')
 
+@app.route('/api/customers')
+@login_required
+def api_customers():
+    try:
+        page = paginate_customers(current_user.id, request.args)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify(page_to_dict(page, customer_to_dict))
+
+@app.route('/api/customers/autocomplete')
+@login_required
+def api_customer_autocomplete():
+    limit = request.args.get('limit', AUTOCOMPLETE_LIMIT, type=int)
+    rows = autocomplete_customers(current_user.id, request.args.get('q', ''), limit)
+    return jsonify({'items': [{'id': row.id, 'name': row.name, 'email': row.email} for row in rows]})
+
 @app.route('/customer/<int:customer_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_customer(customer_id):
@@ -155,6 +260,7 @@ def edit_customer(customer_id):
         customer.address = form.address.data
         customer.phone = form.phone.data
         db.session.commit()
+        pdf_cache.invalidate_user(current_user.id)
         flash('Customer updated successfully!', 'success')
         return redirect(url_for('customers'))
     
@@ -183,10 +289,14 @@ def delete_customer(customer_id):
         return redirect(url_for('customers'))
     
     # Check if the customer has invoices
-    if customer.invoices:
+    if Invoice.query.filter_by(customer_id=customer.id).first() is not None:
         flash('Cannot delete customer with associated invoices.', 'danger')
         return redirect(url_for('customers'))
     
+    if RecurringInvoice.query.filter_by(customer_id=customer.id).first() is not None:
+        flash('Cannot delete customer with recurring invoices.', 'danger')
+        return redirect(url_for('customers'))
+    
     db.session.delete(customer)
     db.session.commit()
     flash('Customer deleted successfully!', 'success')
@@ -197,20 +307,6 @@ def delete_customer(customer_id):
 def create_invoice():
     form = InvoiceForm()
     
-    # Get customer list for dropdown
-    customers = Customer.query.filter_by(user_id=current_user.id).all()
-    form.customer_id.choices = [(c.id, c.name) for c in customers]
-    
-    # Generate next invoice number
-    last_invoice = Invoice.query.filter_by(user_id=current_user.id).order_by(Invoice.id.desc()).first()
-    next_invoice_number = f"INV-{datetime.now().strftime('%Y%m')}-001"
-    if last_invoice:
-        # Extract the sequence number and increment
-        parts = last_invoice.invoice_number.split('-')
-        if len(parts) == 3 and parts[0] == 'INV' and parts[1] == datetime.now().strftime('%Y%m'):
-            next_seq = int(parts[2]) + 1
-            next_invoice_number = f"INV-{datetime.now().strftime('%Y%m')}-{next_seq:03d}"
-    
     if request.method == 'POST':
         try:
             # Extract form data manually
@@ -221,9 +317,6 @@ def create_invoice():
             tax_rate_str = request.form.get('tax_rate', '0')
             notes = request.form.get('notes', '')
             status = request.form.get('status', 'Unpaid')
-            subtotal_str = request.form.get('subtotal', '0')
-            tax_amount_str = request.form.get('tax_amount', '0')
-            total_str = request.form.get('total', '0')
             
             # Convert to proper types with validation
             if not date_issued_str:
@@ -237,11 +330,26 @@ def create_invoice():
             if not customer_id_str:
                 raise ValueError("Müşteri seçilmelidir")
             customer_id = int(customer_id_str)
+            if not customer_exists(current_user.id, customer_id):
+                raise ValueError("Müşteri bulunamadı")
+            
+            tax_rate = to_decimal(tax_rate_str or '0', RATE_SCALE)
             
-            tax_rate = float(tax_rate_str)
-            subtotal = float(subtotal_str)
-            tax_amount = float(tax_amount_str)
-            total = float(total_str)
+            # Totals are computed here, the values posted by the browser are ignored
+            item_rows = parse_item_rows(request.form)
+            subtotal, tax_amount, total = invoice_totals((row['amount'] for row in item_rows), tax_rate)
+            
+            # The suggested number is only a preview, the real one is allocated now,
+            # even when another invoice took the preview since the form was shown.
+            # A custom number is kept as typed, even one in the sequence format.
+            invoice_number = (invoice_number or '').strip()
+            previewed = session.get('invoice_number_previews', [])
+            if not invoice_number or invoice_number in previewed or invoice_number == numbering.preview_number(current_user.id):
+                invoice_number = numbering.allocate_number(current_user.id)
+            elif numbering.number_in_use(current_user.id, invoice_number):
+                raise ValueError(f"{invoice_number} fatura numarası zaten kullanılıyor")
+            else:
+                numbering.note_used_numbers(current_user.id, [invoice_number])
             
             # Create invoice
             invoice = Invoice(
@@ -260,46 +368,8 @@ def create_invoice():
             db.session.add(invoice)
             db.session.flush()  # Get the invoice ID
             
-            # Get all form keys to find item fields
-            keys = list(request.form.keys())
-            item_indices = set()
-            
-            # Extract item indices from form keys
-            for key in keys:
-                if key.startswith('items-') and '-description' in key:
-                    # Format: items-{index}-description
-                    parts = key.split('-')
-                    if len(parts) == 3:
-                        item_indices.add(parts[1])
-            
-            # Add invoice items
-            for idx in item_indices:
-                desc_key = f'items-{idx}-description'
-                qty_key = f'items-{idx}-quantity'
-                price_key = f'items-{idx}-unit_price'
-                amount_key = f'items-{idx}-amount'
-                
-                description = request.form.get(desc_key, '')
-                quantity_str = request.form.get(qty_key, '0')
-                unit_price_str = request.form.get(price_key, '0')
-                amount_str = request.form.get(amount_key, '0')
-                
-                # Skip empty rows
-                if not description.strip():
-                    continue
-                    
-                quantity = float(quantity_str)
-                unit_price = float(unit_price_str)
-                amount = float(amount_str)
-                
-                item = InvoiceItem(
-                    description=description,
-                    quantity=quantity,
-                    unit_price=unit_price,
-                    amount=amount,
-                    invoice_id=invoice.id
-                )
-                db.session.add(item)
+            # Add invoice items in one statement
+            insert_items(invoice.id, item_rows)
             
             db.session.commit()
             flash('Fatura başarıyla oluşturuldu!', 'success')
@@ -311,7 +381,9 @@ def create_invoice():
     
     # Pre-fill form data
     if request.method == 'GET':
-        form.invoice_number.data = next_invoice_number
+        form.invoice_number.data = numbering.preview_number(current_user.id)
+        # Remember the last few previews, so that a form left untouched in another tab is allocated too
+        session['invoice_number_previews'] = session.get('invoice_number_previews', [])[-4:] + [form.invoice_number.data]
         form.date_issued.data = datetime.now().date()
         form.date_due.data = (datetime.now() + timedelta(days=30)).date()
     
@@ -320,7 +392,7 @@ def create_invoice():
 @app.route('/invoice/<int:invoice_id>')
 @login_required
 def view_invoice(invoice_id):
-    invoice = Invoice.query.get_or_404(invoice_id)
+    invoice = Invoice.query.options(*invoice_detail_options()).get_or_404(invoice_id)
     
     # Make sure the invoice belongs to the current user
     if invoice.user_id != current_user.id:
@@ -341,10 +413,6 @@ def edit_invoice(invoice_id):
     
     form = InvoiceForm()
     
-    # Get customer list for dropdown
-    customers = Customer.query.filter_by(user_id=current_user.id).all()
-    form.customer_id.choices = [(c.id, c.name) for c in customers]
-    
     if request.method == 'POST':
         try:
             # Extract form data manually
@@ -355,9 +423,6 @@ def edit_invoice(invoice_id):
             tax_rate_str = request.form.get('tax_rate', '0')
             notes = request.form.get('notes', '')
             status = request.form.get('status', 'Unpaid')
-            subtotal_str = request.form.get('subtotal', '0')
-            tax_amount_str = request.form.get('tax_amount', '0')
-            total_str = request.form.get('total', '0')
             
             # Convert to proper types with validation
             if not date_issued_str:
@@ -371,11 +436,21 @@ def edit_invoice(invoice_id):
             if not customer_id_str:
                 raise ValueError("Customer must be selected")
             customer_id = int(customer_id_str)
+            if not customer_exists(current_user.id, customer_id):
+                raise ValueError("Customer not found")
+            
+            tax_rate = to_decimal(tax_rate_str or '0', RATE_SCALE)
+            
+            # Totals are computed here, the values posted by the browser are ignored
+            item_rows = parse_item_rows(request.form)
+            subtotal, tax_amount, total = invoice_totals((row['amount'] for row in item_rows), tax_rate)
             
-            tax_rate = float(tax_rate_str)
-            subtotal = float(subtotal_str)
-            tax_amount = float(tax_amount_str)
-            total = float(total_str)
+            # Write only the item rows that were added, changed or removed
+            if any(sync_invoice_items(invoice.id, item_rows)):
+                invoice.updated_at = datetime.utcnow()
+            
+            if invoice_number != invoice.invoice_number:
+                numbering.note_used_numbers(current_user.id, [invoice_number])
             
             # Update invoice
             invoice.invoice_number = invoice_number
@@ -389,54 +464,10 @@ def edit_invoice(invoice_id):
             invoice.tax_amount = tax_amount
             invoice.total = total
             
-            # Delete existing items
-            for item in invoice.items:
-                db.session.delete(item)
-            
-            # Get all form keys to find item fields
-            keys = list(request.form.keys())
-            item_indices = set()
-            
-            # Extract item indices from form keys
-            for key in keys:
-                if key.startswith('items-') and '-description' in key:
-                    # Format: items-{index}-description
-                    parts = key.split('-')
-                    if len(parts) == 3:
-                        item_indices.add(parts[1])
-            
-            # Add invoice items
-            for idx in item_indices:
-                desc_key = f'items-{idx}-description'
-                qty_key = f'items-{idx}-quantity'
-                price_key = f'items-{idx}-unit_price'
-                amount_key = f'items-{idx}-amount'
-                
-                description = request.form.get(desc_key, '')
-                quantity_str = request.form.get(qty_key, '0')
-                unit_price_str = request.form.get(price_key, '0')
-                amount_str = request.form.get(amount_key, '0')
-                
-                # Skip empty rows
-                if not description.strip():
-                    continue
-                    
-                quantity = float(quantity_str)
-                unit_price = float(unit_price_str)
-                amount = float(amount_str)
-                
-                item = InvoiceItem(
-                    description=description,
-                    quantity=quantity,
-                    unit_price=unit_price,
-                    amount=amount,
-                    invoice_id=invoice.id
-                )
-                db.session.add(item)
-            
             db.session.commit()
+            pdf_cache.invalidate_invoice(current_user.id, invoice_id)
             flash('Invoice updated successfully!', 'success')
-            return redirect(url_for('view_invoice', invoice_id=invoice.id))
+            return redirect(url_for('view_invoice', invoice_id=invoice_id))
         except Exception as e:
             db.session.rollback()
             flash(f'Error updating invoice: {str(e)}', 'danger')
@@ -470,34 +501,158 @@ def delete_invoice(invoice_id):
     
     db.session.delete(invoice)
     db.session.commit()
+    pdf_cache.invalidate_invoice(current_user.id, invoice_id)
     flash('Invoice deleted successfully!', 'success')
     return redirect(url_for('invoices'))
 
+def pdf_job_accepted(job):
+    """202 response with the status document of a queued PDF job and its URL in Location"""
+    response = jsonify(pdf_job_to_dict(job))
+    response.status_code = 202
+    response.headers['Location'] = url_for('pdf_job_status', job_id=job.id)
+    return response
+
 @app.route('/invoice/<int:invoice_id>/pdf')
 @login_required
 def download_invoice_pdf(invoice_id):
+    invoice = Invoice.query.options(*invoice_detail_options()).get_or_404(invoice_id)
+    
+    # Make sure the invoice belongs to the current user
+    if invoice.user_id != current_user.id:
+        flash('You do not have permission to download this invoice.', 'danger')
+        return redirect(url_for('invoices'))
+    
+    # Answer revalidation requests without touching the PDF
+    key = pdf_cache.invoice_fingerprint(invoice)
+    if key in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(key)
+        return response
+    
+    # Serve the cached PDF. On a miss, API clients asking for JSON get a job of
+    # the PDF worker pool to poll, while the browser's download link, which
+    # nothing polls, gets the PDF rendered here
+    path = pdf_cache.cached_pdf_file(invoice, key)
+    if path is None:
+        if request.accept_mimetypes.best_match(['application/pdf', 'application/json']) == 'application/json':
+            return pdf_job_accepted(pdf_worker.enqueue_pdf_job(invoice))
+        path, key = pdf_cache.cached_pdf_path(invoice)
+    
+    response = send_file(
+        path,
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=f"Invoice-{invoice.invoice_number}.pdf",
+        etag=key,
+        conditional=True
+    )
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/invoice/<int:invoice_id>/pdf/jobs', methods=['POST'])
+@login_required
+def queue_invoice_pdf(invoice_id):
     invoice = Invoice.query.get_or_404(invoice_id)
     
     # Make sure the invoice belongs to the current user
     if invoice.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to download this invoice.'}), 403
+    
+    return pdf_job_accepted(pdf_worker.enqueue_pdf_job(invoice))
+
+@app.route('/invoice/<int:invoice_id>/recurring', methods=['POST'])
+@login_required
+def make_invoice_recurring(invoice_id):
+    invoice = Invoice.query.options(*invoice_detail_options()).get_or_404(invoice_id)
+    
+    # Make sure the invoice belongs to the current user
+    if invoice.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to copy this invoice.'}), 403
+    
+    try:
+        start_date_str = request.form.get('start_date')
+        end_date_str = request.form.get('end_date')
+        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date() if start_date_str else datetime.now().date()
+        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date() if end_date_str else None
+        interval = int(request.form.get('interval') or 1)
+        template = recurring.create_from_invoice(
+            invoice, request.form.get('frequency', 'monthly'), start_date, interval, end_date
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify(recurring_invoice_to_dict(template)), 201
+
+@app.route('/api/recurring')
+@login_required
+def api_recurring_invoices():
+    templates = (
+        RecurringInvoice.query.filter_by(user_id=current_user.id)
+        .options(selectinload(RecurringInvoice.items))
+        .order_by(RecurringInvoice.id)
+        .all()
+    )
+    return jsonify({'results': [recurring_invoice_to_dict(template) for template in templates]})
+
+@app.route('/recurring/<int:recurring_id>/end', methods=['POST'])
+@login_required
+def end_recurring_invoice(recurring_id):
+    template = RecurringInvoice.query.get_or_404(recurring_id)
+    
+    # Make sure the recurring invoice belongs to the current user
+    if template.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to change this recurring invoice.'}), 403
+    
+    recurring.end_recurring(template)
+    return jsonify(recurring_invoice_to_dict(template))
+
+@app.route('/pdf-jobs/<job_id>')
+@login_required
+def pdf_job_status(job_id):
+    job = PdfJob.query.get_or_404(job_id)
+    
+    # Make sure the job belongs to the current user
+    if job.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to view this job.'}), 403
+    
+    return jsonify(pdf_job_to_dict(job))
+
+@app.route('/pdf-jobs/<job_id>/download')
+@login_required
+def download_pdf_job(job_id):
+    job = PdfJob.query.get_or_404(job_id)
+    
+    # Make sure the job belongs to the current user
+    if job.user_id != current_user.id:
         flash('You do not have permission to download this invoice.', 'danger')
         return redirect(url_for('invoices'))
     
-    # Generate PDF
-    pdf_file = generate_pdf(invoice)
+    if job.status != pdf_worker.DONE:
+        return jsonify(pdf_job_to_dict(job)), 409
+    
+    # The job rendered into the PDF cache. Look up the current revision of the
+    # invoice there, so a job that finished before an edit never serves the
+    # old PDF; an edited or evicted invoice is queued again
+    invoice = Invoice.query.options(*invoice_detail_options()).get_or_404(job.invoice_id)
+    key = pdf_cache.invoice_fingerprint(invoice)
+    path = pdf_cache.cached_pdf_file(invoice, key)
+    if path is None:
+        return pdf_job_accepted(pdf_worker.enqueue_pdf_job(invoice))
     
-    # Return PDF as a downloadable file
-    return send_file(
-        io.BytesIO(pdf_file),
+    response = send_file(
+        path,
         mimetype='application/pdf',
         as_attachment=True,
-        download_name=f"Invoice-{invoice.invoice_number}.pdf"
+        download_name=f"Invoice-{invoice.invoice_number}.pdf",
+        etag=key
     )
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @app.route('/invoice/<int:invoice_id>/send', methods=['POST'])
 @login_required
 def send_invoice_email(invoice_id):
-    invoice = Invoice.query.get_or_404(invoice_id)
+    invoice = Invoice.query.options(*invoice_detail_options()).get_or_404(invoice_id)
     
     # Make sure the invoice belongs to the current user
     if invoice.user_id != current_user.id:
@@ -509,46 +664,84 @@ def send_invoice_email(invoice_id):
         flash('Customer does not have an email address.', 'danger')
         return redirect(url_for('view_invoice', invoice_id=invoice.id))
     
-    # Generate PDF
-    pdf_file = generate_pdf(invoice)
-    
-    # Create email
-    msg = Message(
-        subject=f"Invoice {invoice.invoice_number} from {current_user.business_name or current_user.username}",
-        recipients=[invoice.customer.email]
-    )
+    # Queue the email, the mail worker renders the PDF and sends it
+    mail_queue.enqueue_invoice_email(invoice, current_user.business_name or current_user.username)
+    flash('Invoice queued for sending.', 'success')
     
-    msg.body = f"""
-Dear {invoice.customer.name},
+    # The commit expired the invoice, use the URL argument rather than reload it
+    return redirect(url_for('view_invoice', invoice_id=invoice_id))
 
-Please find attached your invoice {invoice.invoice_number} for the amount of ${invoice.total:.2f}.
-
-Due date: {invoice.date_due.strftime('%B %d, %Y')}
+@app.route('/invoices/send-reminders', methods=['POST'])
+@login_required
+def send_invoice_reminders():
+    if not CsrfForm().validate_on_submit():
+        flash('The form has expired, please try again.', 'danger')
+        return redirect(url_for('invoices'))
+    
+    statuses = request.form.getlist('status') or list(campaigns.DEFAULT_STATUSES)
+    due_before_str = request.form.get('due_before')
+    
+    # Reminders only make sense for invoices still waiting for payment
+    if not set(statuses) <= set(campaigns.DEFAULT_STATUSES):
+        flash(f"Reminders can only be sent for {' and '.join(campaigns.DEFAULT_STATUSES)} invoices.", 'danger')
+        return redirect(url_for('invoices'))
+    
+    try:
+        due_before = datetime.strptime(due_before_str, '%Y-%m-%d').date() if due_before_str else datetime.now().date()
+    except ValueError:
+        flash('Invalid due date.', 'danger')
+        return redirect(url_for('invoices'))
+    
+    campaign = campaigns.create_campaign(
+        current_user.id,
+        statuses,
+        due_before,
+        current_user.business_name or current_user.username
+    )
+    flash(f'{campaign.total} payment reminders queued for sending.', 'success')
+    return redirect(url_for('invoices'))
 
-Thank you for your business.
+@app.route('/campaigns/<int:campaign_id>')
+@login_required
+def campaign_status(campaign_id):
+    campaign = EmailCampaign.query.get_or_404(campaign_id)
+    
+    # Make sure the campaign belongs to the current user
+    if campaign.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to view this campaign.'}), 403
+    
+    return jsonify({
+        'id': campaign.id,
+        'status': campaign.status,
+        'total': campaign.total,
+        'progress': campaigns.campaign_progress(campaign.id)
+    })
 
-Best regards,
-{current_user.business_name or current_user.username}
-"""
+@app.route('/import', methods=['POST'])
+@login_required
+def import_data():
+    if not CsrfForm().validate_on_submit():
+        return jsonify({'error': 'Missing or invalid CSRF token.'}), 400
     
-    # Attach PDF
-    msg.attach(
-        f"Invoice-{invoice.invoice_number}.pdf",
-        "application/pdf",
-        pdf_file
-    )
+    kind = request.form.get('kind', 'invoices')
+    if kind not in importer.IMPORTERS:
+        return jsonify({'error': f'Unknown import kind: {kind}'}), 400
+    
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({'error': 'No file uploaded.'}), 400
     
-    # Send email
     try:
-        mail.send(msg)
-        flash('Invoice sent successfully!', 'success')
-    except Exception as e:
-        flash(f'Error sending email: {str(e)}', 'danger')
+        fmt = importer.detect_format(upload.filename, request.form.get('format'))
+        result = importer.IMPORTERS[kind](current_user.id, importer.text_stream(upload.stream), fmt)
+    except importer.ImportFormatError as e:
+        return jsonify({'error': str(e)}), 400
     
-    return redirect(url_for('view_invoice', invoice_id=invoice.id))
+    return jsonify(result.to_dict())
 
 @app.route('/profile', methods=['GET', 'POST'])
 @login_required
+@page_cache.cached_page
 def profile():
     form = ProfileForm()
     
@@ -569,6 +762,7 @@ def profile():
         current_user.business_address = form.business_address.data
         current_user.business_phone = form.business_phone.data
         db.session.commit()
+        pdf_cache.invalidate_user(current_user.id)
         flash('Your profile has been updated!', 'success')
         return redirect(url_for('profile'))
     
@@ -0,0 +1,101 @@
+"""
+Shared setup of the checks and benchmarks that write to the database
+
+query_plans, load_tests and the benchmarks create throwaway users, drive
+the routes as them through the test client and delete what they made.
+They refuse to run against a database holding users they did not create,
+point DATABASE_URL at a scratch database to run them.
+"""
+import uuid
+from contextlib import contextmanager
+from sqlalchemy import delete, func, select
+from app import app, db
+from app import User
+import pdf_cache
+import user_cache
+
+# Every user the harnesses create has an address in this reserved domain
+SCRATCH_EMAIL_DOMAIN = 'example.invalid'
+
+# Configuration the harnesses drive the routes with: forms are posted
+# without CSRF tokens, and the page cache is off so that repeated requests
+# measure the work of the view instead of cache hits
+HARNESS_CONFIG = {'WTF_CSRF_ENABLED': False, 'PAGE_CACHE_BACKEND': 'none'}
+
+class ScratchDatabaseError(ValueError):
+    """Raised when a harness would write to a database with real users"""
+
+def require_scratch_database():
+    """
+    Raises:
+        ScratchDatabaseError: If a user outside SCRATCH_EMAIL_DOMAIN exists
+    """
+    others = db.session.scalar(
+        select(func.count(User.id)).where(~User.email.endswith(f"@{SCRATCH_EMAIL_DOMAIN}"))
+    )
+    db.session.rollback()
+    if others:
+        raise ScratchDatabaseError(
+            f"{db.engine.url.render_as_string(hide_password=True)} has {others} users that were not "
+            f"created by a benchmark or check, point DATABASE_URL at a scratch database"
+        )
+
+def scratch_username(prefix):
+    """Returns a username no earlier run left behind, so a crashed run does not block the next one"""
+    return f"{prefix}-{uuid.uuid4().hex[:12]}"
+
+def create_scratch_user(username, **fields):
+    """Adds a user in SCRATCH_EMAIL_DOMAIN to the session and flushes it"""
+    user = User(username=username, email=f"{username}@{SCRATCH_EMAIL_DOMAIN}", **fields)
+    user.set_password(username)
+    db.session.add(user)
+    db.session.flush()
+    return user
+
+@contextmanager
+def harness_config(**overrides):
+    """Applies HARNESS_CONFIG and `overrides` to the app config, restoring the old values on exit"""
+    values = dict(HARNESS_CONFIG, **overrides)
+    saved = {name: app.config[name] for name in values if name in app.config}
+    app.config.update(values)
+    try:
+        yield
+    finally:
+        for name in values:
+            if name in saved:
+                app.config[name] = saved[name]
+            else:
+                app.config.pop(name, None)
+
+def logged_in_client(user_id):
+    """Returns a test client whose session is logged in as a user"""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    return client
+
+def delete_user_data(user_id):
+    """
+    Deletes a user and every row that belongs to them
+
+    Tables are emptied children first: rows with the user's user_id, and
+    rows of tables without one (invoice items) through their parent. The
+    statements bypass the ORM, the user's summary and rollup rows go with
+    the rest.
+    """
+    for table in reversed(db.metadata.sorted_tables):
+        if table.name == User.__tablename__:
+            continue
+        if 'user_id' in table.c:
+            db.session.execute(delete(table).where(table.c.user_id == user_id))
+            continue
+        for foreign_key in table.foreign_keys:
+            parent = foreign_key.column.table
+            if 'user_id' in parent.c:
+                owned = select(foreign_key.column).where(parent.c.user_id == user_id)
+                db.session.execute(delete(table).where(foreign_key.parent.in_(owned)))
+    db.session.execute(delete(User.__table__).where(User.__table__.c.id == user_id))
+    db.session.commit()
+    pdf_cache.invalidate_user(user_id)
+    user_cache.invalidate_user(user_id)
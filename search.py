@@ -0,0 +1,284 @@
+import re
+from dataclasses import dataclass
+from sqlalchemy import delete, event, func, inspect, insert, literal, null, select, text
+from app import db
+from app import Customer, Invoice, InvoiceItem, SearchDocument
+
+# Document ids are object_id * ID_STRIDE + code, so every object has exactly one
+KINDS = {'customer': 1, 'invoice': 2, 'item': 3}
+ID_STRIDE = 4
+
+# Query words beyond this are ignored
+MAX_TERMS = 8
+
+# Newest matches that are ranked; a broad query ranks these instead of every match
+CANDIDATE_LIMIT = 1000
+
+# Ids per DELETE / INSERT ... SELECT, below the SQLite bound parameter limit
+CHUNK_SIZE = 500
+
+# Attributes whose change makes a document stale
+INDEXED_FIELDS = {
+    'customer': ('user_id', 'name', 'email'),
+    'invoice': ('user_id', 'invoice_number', 'notes'),
+    'item': ('invoice_id', 'description'),
+}
+
+DOCUMENT_COLUMNS = ('id', 'user_id', 'kind', 'object_id', 'invoice_id', 'title', 'body')
+
+@dataclass(frozen=True)
+class SearchHit:
+    """One ranked search result"""
+    kind: str
+    object_id: int
+    invoice_id: int
+    title: str
+    body: str
+    rank: float
+
+def _document_id(column, kind):
+    return column * ID_STRIDE + KINDS[kind]
+
+def _sources():
+    """SELECTs producing the search_documents rows of each kind from the data tables"""
+    return {
+        'customer': select(
+            _document_id(Customer.id, 'customer'), Customer.user_id, literal('customer'), Customer.id,
+            null(), Customer.name, Customer.email
+        ),
+        'invoice': select(
+            _document_id(Invoice.id, 'invoice'), Invoice.user_id, literal('invoice'), Invoice.id,
+            Invoice.id, Invoice.invoice_number, Invoice.notes
+        ),
+        'item': select(
+            _document_id(InvoiceItem.id, 'item'), Invoice.user_id, literal('item'), InvoiceItem.id,
+            InvoiceItem.invoice_id, InvoiceItem.description, null()
+        ).join(Invoice, Invoice.id == InvoiceItem.invoice_id),
+    }
+
+def _chunks(ids):
+    ids = sorted(set(ids))
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+def _insert_from(connection, source):
+    table = SearchDocument.__table__
+    connection.execute(insert(table).from_select([table.c[name] for name in DOCUMENT_COLUMNS], source))
+
+def index_customers(customer_ids, connection=None):
+    """Rewrites the documents of the given customers, dropping those of deleted ones"""
+    connection = connection or db.session.connection()
+    table = SearchDocument.__table__
+    source = _sources()['customer']
+    for chunk in _chunks(customer_ids):
+        connection.execute(delete(table).where(table.c.id.in_([_document_id(object_id, 'customer') for object_id in chunk])))
+        _insert_from(connection, source.where(Customer.id.in_(chunk)))
+
+def index_items(item_ids, connection=None):
+    """Rewrites the documents of the given invoice items, dropping those of deleted ones"""
+    connection = connection or db.session.connection()
+    table = SearchDocument.__table__
+    source = _sources()['item']
+    for chunk in _chunks(item_ids):
+        connection.execute(delete(table).where(table.c.id.in_([_document_id(object_id, 'item') for object_id in chunk])))
+        _insert_from(connection, source.where(InvoiceItem.id.in_(chunk)))
+
+def index_invoices(invoice_ids, connection=None):
+    """Rewrites the documents of the given invoices and all of their items"""
+    connection = connection or db.session.connection()
+    table = SearchDocument.__table__
+    sources = _sources()
+    for chunk in _chunks(invoice_ids):
+        connection.execute(delete(table).where(table.c.invoice_id.in_(chunk)))
+        _insert_from(connection, sources['invoice'].where(Invoice.id.in_(chunk)))
+        _insert_from(connection, sources['item'].where(InvoiceItem.invoice_id.in_(chunk)))
+
+# SQLite: an external content FTS5 table over search_documents, kept in step by triggers
+
+SQLITE_INDEX_DDL = (
+    """CREATE VIRTUAL TABLE search_index USING fts5(
+        title, body,
+        content='search_documents', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    """CREATE TRIGGER search_documents_ai AFTER INSERT ON search_documents BEGIN
+        INSERT INTO search_index(rowid, title, body) VALUES (new.id, new.title, new.body);
+    END""",
+    """CREATE TRIGGER search_documents_ad AFTER DELETE ON search_documents BEGIN
+        INSERT INTO search_index(search_index, rowid, title, body) VALUES ('delete', old.id, old.title, old.body);
+    END""",
+    """CREATE TRIGGER search_documents_au AFTER UPDATE ON search_documents BEGIN
+        INSERT INTO search_index(search_index, rowid, title, body) VALUES ('delete', old.id, old.title, old.body);
+        INSERT INTO search_index(rowid, title, body) VALUES (new.id, new.title, new.body);
+    END""",
+    "INSERT INTO search_index(search_index) VALUES ('rebuild')",
+)
+
+SQLITE_DROP_DDL = (
+    'DROP TRIGGER IF EXISTS search_documents_ai',
+    'DROP TRIGGER IF EXISTS search_documents_ad',
+    'DROP TRIGGER IF EXISTS search_documents_au',
+    'DROP TABLE IF EXISTS search_index',
+)
+
+# PostgreSQL: a generated tsvector column with a GIN index
+
+POSTGRES_INDEX_DDL = (
+    """ALTER TABLE search_documents ADD COLUMN IF NOT EXISTS document tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(body, '')), 'B')
+        ) STORED""",
+    'CREATE INDEX IF NOT EXISTS ix_search_documents_document ON search_documents USING GIN (document)',
+    'CREATE INDEX IF NOT EXISTS ix_search_documents_user ON search_documents (user_id, id)',
+)
+
+def create_index(connection):
+    """Creates the dialect specific full-text index over search_documents"""
+    if connection.dialect.name == 'postgresql':
+        statements = POSTGRES_INDEX_DDL
+    else:
+        statements = SQLITE_DROP_DDL + SQLITE_INDEX_DDL
+    for statement in statements:
+        connection.exec_driver_sql(statement)
+
+def rebuild_index(user_id=None, connection=None):
+    """
+    Recomputes search_documents from the customers, invoices and items tables
+
+    A full rebuild on SQLite drops the FTS5 table and its triggers, reloads
+    the documents and indexes them in one pass, which is much faster than
+    going through the triggers row by row.
+
+    Args:
+        user_id: Restrict the rebuild to one user (all users when None)
+        connection: Connection whose transaction the caller commits; the
+            session is used and committed when None
+
+    Returns:
+        int: Number of documents indexed
+    """
+    executor = connection or db.session.connection()
+    table = SearchDocument.__table__
+    full_sqlite_rebuild = user_id is None and executor.dialect.name == 'sqlite'
+    if full_sqlite_rebuild:
+        for statement in SQLITE_DROP_DDL:
+            executor.exec_driver_sql(statement)
+
+    delete_query = delete(table)
+    if user_id is not None:
+        delete_query = delete_query.where(table.c.user_id == user_id)
+    executor.execute(delete_query)
+
+    for kind, source in _sources().items():
+        if user_id is not None:
+            source = source.where((Customer.user_id if kind == 'customer' else Invoice.user_id) == user_id)
+        _insert_from(executor, source)
+
+    if full_sqlite_rebuild:
+        create_index(executor)
+
+    count_query = select(func.count()).select_from(table)
+    if user_id is not None:
+        count_query = count_query.where(table.c.user_id == user_id)
+    count = executor.execute(count_query).scalar()
+
+    if connection is None:
+        db.session.commit()
+    return count
+
+def _terms(query):
+    return re.findall(r'\w+', (query or '').lower())[:MAX_TERMS]
+
+def search(user_id, query, limit=20):
+    """
+    Searches a user's customers, invoices and invoice items
+
+    Every word of the query has to appear in the same document; words of
+    two or more letters also match longer words (prefix matching). Customer
+    names, invoice numbers and item descriptions weigh more than emails and
+    notes. Only the CANDIDATE_LIMIT newest matches are ranked, which keeps
+    a one or two letter query as fast as a precise one.
+
+    Args:
+        user_id: ID of the user
+        query: Free text typed by the user
+        limit: Maximum number of results
+
+    Returns:
+        list: SearchHit objects, best match first
+    """
+    terms = _terms(query)
+    if not terms:
+        return []
+
+    connection = db.session.connection()
+    params = {'user_id': user_id, 'candidates': CANDIDATE_LIMIT, 'limit': limit}
+    if connection.dialect.name == 'postgresql':
+        params['query'] = ' & '.join(f"{term}:*" if len(term) > 1 else term for term in terms)
+        statement = text(
+            """SELECT kind, object_id, invoice_id, title, body, score FROM (
+                SELECT d.id, d.kind, d.object_id, d.invoice_id, d.title, d.body, ts_rank(d.document, q) AS score
+                FROM search_documents d, to_tsquery('simple', :query) q
+                WHERE d.user_id = :user_id AND d.document @@ q
+                ORDER BY d.id DESC
+                LIMIT :candidates
+            ) m
+            ORDER BY score DESC, id
+            LIMIT :limit"""
+        )
+    else:
+        params['query'] = ' AND '.join(f'"{term}"*' if len(term) > 1 else f'"{term}"' for term in terms)
+        statement = text(
+            """SELECT kind, object_id, invoice_id, title, body, score FROM (
+                SELECT d.id, d.kind, d.object_id, d.invoice_id, d.title, d.body,
+                    -bm25(search_index, 10.0, 1.0) AS score
+                FROM search_index JOIN search_documents d ON d.id = search_index.rowid
+                WHERE search_index MATCH :query AND d.user_id = :user_id
+                ORDER BY search_index.rowid DESC
+                LIMIT :candidates
+            ) m
+            ORDER BY score DESC, id
+            LIMIT :limit"""
+        )
+
+    return [SearchHit(*row) for row in connection.execute(statement, params)]
+
+def _kind_of(obj):
+    if isinstance(obj, Customer):
+        return 'customer'
+    if isinstance(obj, Invoice):
+        return 'invoice'
+    if isinstance(obj, InvoiceItem):
+        return 'item'
+    return None
+
+@event.listens_for(db.session, 'after_flush')
+def _track_search_changes(session, flush_context):
+    """Rewrites the documents of every flushed customer, invoice or item whose text changed"""
+    changed = {kind: set() for kind in KINDS}
+
+    for obj in session.new | session.deleted:
+        kind = _kind_of(obj)
+        if kind:
+            changed[kind].add(obj.id)
+
+    for obj in session.dirty:
+        kind = _kind_of(obj)
+        if kind is None or obj in session.deleted:
+            continue
+        state = inspect(obj)
+        if any(state.attrs[key].history.has_changes() for key in INDEXED_FIELDS[kind]):
+            changed[kind].add(obj.id)
+
+    if not any(changed.values()):
+        return
+    connection = session.connection()
+    index_customers(changed['customer'], connection)
+    index_invoices(changed['invoice'], connection)
+    # Items of re-indexed invoices are already rewritten
+    invoice_of = {
+        obj.id: obj.invoice_id for obj in session.new | session.dirty | session.deleted
+        if isinstance(obj, InvoiceItem)
+    }
+    index_items([item_id for item_id in changed['item'] if invoice_of.get(item_id) not in changed['invoice']], connection)
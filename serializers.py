@@ -0,0 +1,138 @@
+from flask import url_for
+
+def _iso(value):
+    return value.isoformat() if value is not None else None
+
+def customer_to_dict(customer):
+    """Converts a Customer into a JSON serializable dict"""
+    return {
+        'id': customer.id,
+        'name': customer.name,
+        'email': customer.email,
+        'address': customer.address,
+        'phone': customer.phone,
+        'created_at': _iso(customer.created_at),
+    }
+
+def invoice_to_dict(invoice):
+    """Converts an Invoice into a JSON serializable dict without its items"""
+    return {
+        'id': invoice.id,
+        'invoice_number': invoice.invoice_number,
+        'date_issued': _iso(invoice.date_issued),
+        'date_due': _iso(invoice.date_due),
+        'status': invoice.status,
+        'notes': invoice.notes,
+        'tax_rate': invoice.tax_rate,
+        'subtotal': invoice.subtotal,
+        'tax_amount': invoice.tax_amount,
+        'total': invoice.total,
+        'customer_id': invoice.customer_id,
+        'created_at': _iso(invoice.created_at),
+        'updated_at': _iso(invoice.updated_at),
+    }
+
+def pdf_job_to_dict(job):
+    """Converts a PdfJob into its JSON status document"""
+    data = {
+        'id': job.id,
+        'status': job.status,
+        'invoice_id': job.invoice_id,
+        'error': job.error,
+        'created_at': _iso(job.created_at),
+        'finished_at': _iso(job.finished_at),
+        'status_url': url_for('pdf_job_status', job_id=job.id),
+    }
+    if job.status == 'done':
+        data['download_url'] = url_for('download_pdf_job', job_id=job.id)
+    return data
+
+def recurring_invoice_to_dict(recurring):
+    """Converts a RecurringInvoice and its items into a JSON serializable dict"""
+    return {
+        'id': recurring.id,
+        'customer_id': recurring.customer_id,
+        'frequency': recurring.frequency,
+        'interval': recurring.interval,
+        'start_date': _iso(recurring.start_date),
+        'end_date': _iso(recurring.end_date),
+        'next_run_date': _iso(recurring.next_run_date),
+        'runs': recurring.runs,
+        'due_days': recurring.due_days,
+        'tax_rate': recurring.tax_rate,
+        'notes': recurring.notes,
+        'status': recurring.status,
+        'items': [
+            {'description': item.description, 'quantity': item.quantity, 'unit_price': item.unit_price}
+            for item in recurring.items
+        ],
+    }
+
+def search_hit_to_dict(hit):
+    """Converts a SearchHit into a JSON result with a link to the matching page"""
+    if hit.kind == 'customer':
+        url = url_for('edit_customer', customer_id=hit.object_id)
+    else:
+        url = url_for('view_invoice', invoice_id=hit.invoice_id)
+    return {
+        'kind': hit.kind,
+        'id': hit.object_id,
+        'invoice_id': hit.invoice_id,
+        'title': hit.title,
+        'body': hit.body,
+        'rank': hit.rank,
+        'url': url,
+    }
+
+def page_to_dict(page, serializer):
+    """Converts a pagination Page into the JSON list envelope"""
+    return {
+        'items': [serializer(item) for item in page.items],
+        'per_page': page.per_page,
+        'sort': page.sort,
+        'direction': page.direction,
+        'next_cursor': page.next_cursor,
+    }
+
+def _dataset(label, values):
+    return {'label': label, 'data': [float(value) for value in values]}
+
+def report_to_dict(name, rows, date_from, date_to):
+    """
+    Converts an analytics report into its rows and Chart.js style chart data
+
+    The rows keep exact amounts, the chart datasets hold plain numbers
+    ready to be handed to a chart as {labels, datasets}.
+    """
+    if name == 'days-to-pay':
+        table = [{'average_days': rows.average, 'paid_count': rows.paid_count}]
+        chart = {'labels': ['Average days to pay'], 'datasets': [_dataset('Days', [rows.average])]}
+    elif name == 'monthly-revenue':
+        table = [
+            {'month': row.month, 'invoiced': row.invoiced, 'revenue': row.revenue, 'paid_count': row.paid_count}
+            for row in rows
+        ]
+        chart = {
+            'labels': [row.month for row in rows],
+            'datasets': [
+                _dataset('Invoiced', [row.invoiced for row in rows]),
+                _dataset('Revenue', [row.revenue for row in rows]),
+            ],
+        }
+    elif name == 'revenue-by-customer':
+        table = [
+            {'customer_id': row.customer_id, 'name': row.name, 'revenue': row.revenue, 'paid_count': row.paid_count}
+            for row in rows
+        ]
+        chart = {'labels': [row.name for row in rows], 'datasets': [_dataset('Revenue', [row.revenue for row in rows])]}
+    else:
+        table = [{'bucket': row.label, 'count': row.count, 'amount': row.amount} for row in rows]
+        chart = {'labels': [row.label for row in rows], 'datasets': [_dataset('Outstanding', [row.amount for row in rows])]}
+
+    return {
+        'report': name,
+        'date_from': _iso(date_from),
+        'date_to': _iso(date_to),
+        'rows': table,
+        'chart': chart,
+    }
@@ -0,0 +1,273 @@
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from app import Customer, Invoice, UserInvoiceStats
+from money import ZERO, to_decimal
+
+# Statuses that still expect a payment from the customer
+OPEN_STATUSES = ('Unpaid', 'Overdue')
+
+@dataclass(frozen=True)
+class DashboardStats:
+    """Aggregated invoice figures shown on the dashboard"""
+    total_invoices: int = 0
+    paid_invoices: int = 0
+    unpaid_invoices: int = 0
+    overdue_invoices: int = 0
+    cancelled_invoices: int = 0
+    revenue: Decimal = ZERO
+    outstanding_amount: Decimal = ZERO
+    overdue_amount: Decimal = ZERO
+    customer_count: int = 0
+
+@dataclass(frozen=True)
+class StatsDrift:
+    """Difference between the stored summary and the invoices table"""
+    user_id: int
+    status: str
+    stored_count: int
+    actual_count: int
+    stored_amount: Decimal
+    actual_amount: Decimal
+
+def _build_stats(status_rows, customer_count):
+    """
+    Folds (status, count, amount) rows into a DashboardStats object
+
+    Args:
+        status_rows: Iterable of (status, invoice count, sum of totals)
+        customer_count: Number of customers of the user
+
+    Returns:
+        DashboardStats: The folded statistics
+    """
+    counts = {}
+    amounts = {}
+    for status, count, amount in status_rows:
+        counts[status] = counts.get(status, 0) + (count or 0)
+        amounts[status] = amounts.get(status, ZERO) + (amount or ZERO)
+
+    return DashboardStats(
+        total_invoices=sum(counts.values()),
+        paid_invoices=counts.get('Paid', 0),
+        unpaid_invoices=counts.get('Unpaid', 0),
+        overdue_invoices=counts.get('Overdue', 0),
+        cancelled_invoices=counts.get('Cancelled', 0),
+        revenue=amounts.get('Paid', ZERO),
+        outstanding_amount=sum(amounts.get(status, ZERO) for status in OPEN_STATUSES),
+        overdue_amount=amounts.get('Overdue', ZERO),
+        customer_count=customer_count or 0
+    )
+
+def get_dashboard_stats(user_id):
+    """
+    Reads the dashboard statistics of a user from the invoice summary table
+
+    Args:
+        user_id: ID of the user
+
+    Returns:
+        DashboardStats: Counts per status, revenue, outstanding and overdue amounts
+    """
+    status_rows = db.session.execute(
+        select(UserInvoiceStats.status, UserInvoiceStats.invoice_count, UserInvoiceStats.amount_total)
+        .where(UserInvoiceStats.user_id == user_id)
+    ).all()
+
+    customer_count = db.session.scalar(
+        select(func.count(Customer.id)).where(Customer.user_id == user_id)
+    )
+
+    return _build_stats(status_rows, customer_count)
+
+def _aggregate_invoices(user_id=None, connection=None):
+    """Recomputes (user_id, status) -> (count, amount) from the invoices table"""
+    query = (
+        select(Invoice.user_id, Invoice.status, func.count(Invoice.id), func.sum(Invoice.total))
+        .group_by(Invoice.user_id, Invoice.status)
+    )
+    if user_id is not None:
+        query = query.where(Invoice.user_id == user_id)
+
+    return {
+        (row_user_id, status): (count, amount or ZERO)
+        for row_user_id, status, count, amount in (connection or db.session).execute(query)
+    }
+
+def _stored_stats(user_id=None, connection=None):
+    """Reads (user_id, status) -> (count, amount) from the summary table"""
+    query = select(
+        UserInvoiceStats.user_id,
+        UserInvoiceStats.status,
+        UserInvoiceStats.invoice_count,
+        UserInvoiceStats.amount_total
+    )
+    if user_id is not None:
+        query = query.where(UserInvoiceStats.user_id == user_id)
+
+    return {
+        (row_user_id, status): (count, amount)
+        for row_user_id, status, count, amount in (connection or db.session).execute(query)
+    }
+
+def verify_invoice_stats(user_id=None, tolerance=0, connection=None):
+    """
+    Compares the summary table with a fresh aggregate of the invoices table
+
+    Args:
+        user_id: Restrict the check to one user (all users when None)
+        tolerance: Allowed absolute difference between amounts, exact by default
+        connection: Connection to use instead of the session
+
+    Returns:
+        list: StatsDrift entries, empty when the summary is accurate
+    """
+    actual = _aggregate_invoices(user_id, connection)
+    stored = _stored_stats(user_id, connection)
+
+    drift = []
+    for key in sorted(set(actual) | set(stored), key=lambda k: (k[0], k[1] or '')):
+        stored_count, stored_amount = stored.get(key, (0, ZERO))
+        actual_count, actual_amount = actual.get(key, (0, ZERO))
+        if stored_count != actual_count or abs(stored_amount - actual_amount) > tolerance:
+            drift.append(StatsDrift(
+                user_id=key[0],
+                status=key[1],
+                stored_count=stored_count,
+                actual_count=actual_count,
+                stored_amount=stored_amount,
+                actual_amount=actual_amount
+            ))
+    return drift
+
+def rebuild_invoice_stats(user_id=None, connection=None):
+    """
+    Recomputes the summary table from scratch
+
+    Args:
+        user_id: Restrict the rebuild to one user (all users when None)
+        connection: Connection whose transaction the caller commits; the
+            session is used and committed when None
+
+    Returns:
+        list: StatsDrift entries that were corrected by the rebuild
+    """
+    executor = connection or db.session
+    drift = verify_invoice_stats(user_id, connection=connection)
+
+    delete_query = UserInvoiceStats.__table__.delete()
+    if user_id is not None:
+        delete_query = delete_query.where(UserInvoiceStats.user_id == user_id)
+    executor.execute(delete_query)
+
+    now = datetime.utcnow()
+    rows = [
+        {
+            'user_id': row_user_id,
+            'status': status,
+            'invoice_count': count,
+            'amount_total': amount,
+            'updated_at': now
+        }
+        for (row_user_id, status), (count, amount) in _aggregate_invoices(user_id, connection).items()
+    ]
+    if rows:
+        executor.execute(UserInvoiceStats.__table__.insert(), rows)
+
+    if connection is None:
+        db.session.commit()
+    return drift
+
+def upsert_insert(connection):
+    """Returns the dialect specific INSERT construct that supports ON CONFLICT"""
+    if connection.dialect.name == 'postgresql':
+        return postgresql.insert
+    return sqlite.insert
+
+def apply_stats_deltas(connection, deltas):
+    """
+    Adds count and amount deltas to the summary table in the current transaction
+
+    Args:
+        connection: Connection bound to the transaction that changed the invoices
+        deltas: Dict of (user_id, status) -> [count delta, amount delta]
+    """
+    table = UserInvoiceStats.__table__
+    insert = upsert_insert(connection)
+    now = datetime.utcnow()
+
+    for (user_id, status), (count, amount) in deltas.items():
+        if not count and not amount:
+            continue
+        statement = insert(table).values(
+            user_id=user_id,
+            status=status,
+            invoice_count=count,
+            amount_total=amount,
+            updated_at=now
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.user_id, table.c.status],
+            set_={
+                'invoice_count': table.c.invoice_count + statement.excluded.invoice_count,
+                'amount_total': table.c.amount_total + statement.excluded.amount_total,
+                'updated_at': statement.excluded.updated_at
+            }
+        )
+        connection.execute(statement)
+
+def previous_value(state, key):
+    """Returns the committed value of an attribute before the current flush"""
+    history = state.attrs[key].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return state.attrs[key].value
+
+def _add_delta(deltas, user_id, status, count, amount):
+    delta = deltas.setdefault((user_id, status or 'Unpaid'), [0, ZERO])
+    delta[0] += count
+    # Unflushed attributes hold whatever was assigned, which may still be a float
+    delta[1] += to_decimal(amount) if amount else ZERO
+
+@event.listens_for(db.session, 'after_flush')
+def _track_invoice_changes(session, flush_context):
+    """Keeps user_invoice_stats in step with every flushed invoice change"""
+    deltas = {}
+
+    for obj in session.new:
+        if isinstance(obj, Invoice):
+            _add_delta(deltas, obj.user_id, obj.status, 1, obj.total)
+
+    for obj in session.deleted:
+        if isinstance(obj, Invoice):
+            state = inspect(obj)
+            _add_delta(
+                deltas,
+                previous_value(state, 'user_id'),
+                previous_value(state, 'status'),
+                -1,
+                -(previous_value(state, 'total') or ZERO)
+            )
+
+    for obj in session.dirty:
+        if not isinstance(obj, Invoice) or obj in session.deleted:
+            continue
+        state = inspect(obj)
+        if not any(state.attrs[key].history.has_changes() for key in ('user_id', 'status', 'total')):
+            continue
+        _add_delta(
+            deltas,
+            previous_value(state, 'user_id'),
+            previous_value(state, 'status'),
+            -1,
+            -(previous_value(state, 'total') or ZERO)
+        )
+        _add_delta(deltas, obj.user_id, obj.status, 1, obj.total)
+
+    if deltas:
+        apply_stats_deltas(session.connection(), deltas)
@@ -0,0 +1,96 @@
+from datetime import date, datetime
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from app import db
+from app import User
+from cache import create_cache
+
+# Columns kept in the cache; the password hash is only read at login and stays in the database
+CACHED_FIELDS = tuple(
+    column.key for column in inspect(User).column_attrs if column.key != 'password_hash'
+)
+
+_caches = {}
+
+def get_user_cache():
+    """Returns the identity cache configured for the current app"""
+    config = current_app.config
+    key = (config['USER_CACHE_BACKEND'], config['USER_CACHE_PATH'])
+    if key not in _caches:
+        _caches[key] = create_cache(
+            config['USER_CACHE_BACKEND'],
+            config['USER_CACHE_TTL'],
+            max_entries=config['USER_CACHE_SIZE'],
+            path=config['USER_CACHE_PATH']
+        )
+    return _caches[key]
+
+def _cache_key(user_id):
+    return f"user:{user_id}"
+
+def _dump(user):
+    values = {}
+    for name in CACHED_FIELDS:
+        value = getattr(user, name)
+        values[name] = value.isoformat() if isinstance(value, (date, datetime)) else value
+    return values
+
+def _restore(values):
+    """Builds a User from cached values and attaches it to the session without a query"""
+    columns = inspect(User).columns
+    user = User()
+    for name in CACHED_FIELDS:
+        value = values.get(name)
+        if isinstance(value, str) and columns[name].type.python_type is datetime:
+            value = datetime.fromisoformat(value)
+        setattr(user, name, value)
+    make_transient_to_detached(user)
+    # The uncached password hash is left unloaded and fetched if anything reads it
+    return db.session.merge(user, load=False)
+
+def load_user(user_id):
+    """
+    Returns the User for a session's user id, from the identity cache when possible
+
+    A hit builds the User from the cached columns and merges it into the
+    session without a SELECT, so it behaves like a loaded object: changes
+    to it are flushed and relationships still lazy load. A miss loads the
+    row and caches it for USER_CACHE_TTL seconds.
+
+    Args:
+        user_id: User id stored in the session (str)
+
+    Returns:
+        User: The user, or None if it does not exist
+    """
+    user_id = int(user_id)
+    cache = get_user_cache()
+    values = cache.get(_cache_key(user_id))
+    if values is not None:
+        return _restore(values)
+
+    user = db.session.get(User, user_id)
+    if user is not None:
+        cache.set(_cache_key(user_id), _dump(user))
+    return user
+
+def invalidate_user(user_id):
+    """Drops the cached identity of a user after its row changed"""
+    get_user_cache().delete(_cache_key(user_id))
+
+@event.listens_for(db.session, 'after_flush')
+def _track_user_changes(session, flush_context):
+    """Remembers the users written in this transaction, whatever code path changed them"""
+    user_ids = {obj.id for obj in session.dirty | session.deleted if isinstance(obj, User)}
+    if user_ids:
+        session.info.setdefault('changed_user_ids', set()).update(user_ids)
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_changed_users(session):
+    for user_id in session.info.pop('changed_user_ids', ()):
+        invalidate_user(user_id)
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_changed_users(session):
+    session.info.pop('changed_user_ids', None)